@@ -35,6 +35,23 @@ ssh_login = 'ssh -i $HOME/Dropbox/dg-beta.pem ubuntu@'
 start_dropbox = ".dropbox-dist/dropboxd"
 start_gtrends = "python {base_dir}/gtrends_ioi.py".format(base_dir=BASE_DIR)
 
+# With a coordinator (google_trends/coordinator.py) running, start a worker on
+# every instance over ssh instead of opening iTerm tabs; the coordinator hands
+# out keywords, tracks quota per account and collects the results.
+# e.g. GTRENDS_COORDINATOR=http://10.0.0.5:8770 python AWS_init.py
+COORDINATOR = os.environ.get("GTRENDS_COORDINATOR")
+start_worker = ("nohup python3 {base_dir}/google_trends/trends.py --coordinator {coordinator} "
+                "--username $GMAIL_USER --password $GMAIL_PASS --throttle random "
+                "--worker-id ec2-{name} > gtrends_worker.log 2>&1 &")
+
+if COORDINATOR:
+    for name, ip in aws_pair:
+        command = start_worker.format(base_dir=BASE_DIR, coordinator=COORDINATOR, name=name)
+        print("Starting worker ec2-{0} on {1}".format(name, ip))
+        os.system("{login}{ip} '{command}'".format(login=ssh_login, ip=ip, command=command))
+    print("Workers started, see {0}/status".format(COORDINATOR))
+    raise SystemExit
+
 
 logins = [ssh_login + t[1] for t in aws_pair]
 
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+asyncio counterpart of trends.get_trends().
+
+    async for keyword_data in async_get_trends(keywords, username, password,
+                                               quarterly="2014-06", concurrency=8):
+        ...
+
+Keywords go through the same query plans (quarterly_steps, single_steps),
+parsing and merging as get_trends(); only the I/O differs. Requests use
+aiohttp when it is installed, otherwise the requests session from the login
+runs in a small thread pool, so the event loop is never blocked. The
+--throttle spacing is shared by all keywords of one call and awaited with
+asyncio.sleep. Cancelling the consuming task, or closing the iterator,
+cancels every keyword in flight.
+
+Python 3.6+ only; trends.py does not import this module.
+"""
+
+import random, asyncio, functools, logging
+from concurrent.futures import ThreadPoolExecutor
+
+import arrow
+
+from google_class import FormatException, TransientException
+from disambiguate import ENTITY_QUERY_URL, unpack_keyword, entity_keyword_data, unresolved_keyword_data
+from entity_types import PRIMARY_TYPES, BACKUP_TYPES
+from metrics import METRICS
+from retry import DEFAULT_ATTEMPTS, DEFAULT_BACKOFF, DEFAULT_BACKOFF_CAP, request_timeout
+from proxy import route
+from categories import validate_category
+from windows import DEFAULT_OVERLAP_MONTHS
+from journal import WindowJournal
+from trends import DEFAULT_TRENDS_URL, DEFAULT_LOGIN_URL, DEFAULT_AUTH_URL
+from trends import quarterly_steps, single_steps, add_interest, _check_response
+
+DEFAULT_CONCURRENCY = 4     # keywords in flight per async_get_trends() call
+CSV_CONTENT_TYPE = 'text/csv; charset=UTF-8'
+logger = logging.getLogger(__name__)
+
+
+
+class AsyncThrottle(object):
+    """ asyncio version of trends.throttle_rate(): spaces the requests of
+        every keyword sharing it `seconds` apart ('random': 2~3 seconds) """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.next_slot = 0.0
+
+    def interval(self):
+        if self.seconds == "random":
+            return float(random.randint(2, 3))
+        try:
+            return max(float(self.seconds or 0), 0.0)
+        except ValueError:
+            return 0.0
+
+    async def wait(self):
+        interval = self.interval()
+        if not interval:
+            return
+        now = asyncio.get_event_loop().time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + interval
+        with METRICS.timed("throttle"):
+            await asyncio.sleep(slot - now)
+
+
+
+class AsyncClient(object):
+    """ Non-blocking GETs with the cookies from authenticate_with_google().
+
+        Uses aiohttp if available, otherwise runs the blocking requests
+        `session` in a thread pool of `pool_size` workers. """
+
+    def __init__(self, session, cookies, pool_size=4):
+        self.session = session
+        self.cookies = cookies
+        self.pool_size = pool_size
+        self._http = None
+        self._executor = None
+        try:
+            import aiohttp
+            self._aiohttp = aiohttp
+        except ImportError:
+            self._aiohttp = None
+
+    async def get(self, url, params):
+        """ Returns (status, content type, body bytes, headers). Connection
+            errors and 429/5xx responses raise TransientException. """
+        request_url, request_params = route(url, params) # via the caching proxy, if any
+        if self._aiohttp:
+            status, content_type, body, headers = await self._get_aiohttp(request_url, request_params, params)
+        else:
+            status, content_type, body, headers = await self._get_threaded(request_url, request_params, params)
+
+        if status == 429 or status >= 500:
+            raise TransientException("HTTP status {0}".format(status),
+                                     params=params, body=body.decode("utf-8", "replace"))
+        return status, content_type, body, headers
+
+    async def _get_aiohttp(self, url, params, orig_params):
+        aiohttp = self._aiohttp
+        if self._http is None:
+            from transport import ACCEPT_ENCODING
+            connect, read = request_timeout()
+            self._http = aiohttp.ClientSession(
+                cookies=self.cookies, headers={"Accept-Encoding": ACCEPT_ENCODING},
+                connector=aiohttp.TCPConnector(limit_per_host=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read))
+        try:
+            async with self._http.get(url, params=params) as response:
+                body = await response.read()
+                return response.status, response.headers.get("content-type", ""), body, response.headers
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise TransientException("{0}: {1}".format(type(e).__name__, e), params=orig_params)
+
+    async def _get_threaded(self, url, params, orig_params):
+        import requests
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.pool_size)
+        call = functools.partial(self.session.get, url, params=params, cookies=self.cookies,
+                                 allow_redirects=True, timeout=request_timeout())
+        try:
+            response = await asyncio.get_event_loop().run_in_executor(self._executor, call)
+        except requests.RequestException as e:
+            raise TransientException("{0}: {1}".format(type(e).__name__, e), params=orig_params)
+        return response.status_code, response.headers.get("content-type", ""), response.content, response.headers
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+
+async def retry_async(fn, attempts=DEFAULT_ATTEMPTS, backoff=DEFAULT_BACKOFF,
+                      cap=DEFAULT_BACKOFF_CAP):
+    "asyncio version of retry.retry_call(), fn returns an awaitable."
+    for attempt in range(attempts):
+        try:
+            return await fn()
+        except TransientException as e:
+            if attempt == attempts - 1:
+                raise
+            delay = random.uniform(0, min(cap, backoff * 2 ** attempt))
+            METRICS.inc("retries_total", error=type(e).__name__)
+            logger.warning("{0}: {1} Retrying in {2:.1f}s ({3}/{4})".format(
+                type(e).__name__, str(e).strip(), delay, attempt + 1, attempts - 1))
+            await asyncio.sleep(delay)
+
+
+async def _trends_response(client, url, params):
+    "asyncio version of trends._request_once(), returns the response lines."
+    with METRICS.timed("trend_request"):
+        status, content_type, body, headers = await client.get(url, params)
+    METRICS.inc("requests_total", endpoint="trendsReport")
+    METRICS.inc("bytes_received_total", len(body), endpoint="trendsReport")
+    if "X-Cache" in headers:
+        METRICS.cache("proxy", headers["X-Cache"] != "MISS")
+
+    text = body.decode("utf-8")
+    if content_type == CSV_CONTENT_TYPE:
+        return text.splitlines()
+    return _check_response(content_type, text, params)
+
+
+async def run_steps_async(steps, client, throttle):
+    "asyncio version of trends.run_steps(), `throttle` is an AsyncThrottle."
+    reply, error = None, None
+    while True:
+        op, arg = steps.throw(error) if error else steps.send(reply)
+        reply, error = None, None
+        if op == 'get':
+            try:
+                reply = await retry_async(lambda: _trends_response(client, arg['url'], arg['params']))
+            except asyncio.CancelledError:
+                steps.close()
+                raise
+            except Exception as e:
+                error = e
+        elif op == 'throttle':
+            await throttle.wait()
+        else:
+            steps.close()
+            return arg
+
+
+async def _lookup(client, job, primary_types, backup_types, entity_index=None, url=ENTITY_QUERY_URL):
+    "asyncio version of disambiguate_keywords() for a single keyword."
+    cik, keyword, filing_date = unpack_keyword(job)
+    kw_data = entity_index.resolve(keyword, primary_types, backup_types) if entity_index else None
+    if kw_data is None:
+        with METRICS.timed("entity_lookup"):
+            status, content_type, body, headers = await retry_async(lambda: client.get(url, {"q": keyword}))
+        METRICS.inc("requests_total", endpoint="entitiesQuery")
+        METRICS.inc("bytes_received_total", len(body), endpoint="entitiesQuery")
+        kw_data = entity_keyword_data(keyword, body, primary_types, backup_types, entity_index)
+    if cik is not None:
+        kw_data.cik = cik
+        kw_data.filing_date = filing_date
+    return kw_data
+
+
+async def _keyword_trends(job, client, throttle, domain, start_date, end_date, quarterly,
+                          category, trends_url, primary_types, backup_types,
+                          dead_letter, journal, merge, overlap_months, entity_index, grid):
+    "One keyword through the same path as an iteration of get_trends()."
+    try:
+        keywords = [await _lookup(client, job, primary_types, backup_types, entity_index)]
+    except TransientException as e:
+        if dead_letter is None:
+            raise
+        dead_letter.add([unresolved_keyword_data(job)], category, e)
+        return []
+    fn_args = {'keywords': keywords, 'category': category, 'ggplot': None,
+               'cookies': client.cookies, 'session': None,
+               'domain': domain, 'throttle': throttle.seconds, 'trends_url': trends_url}
+    try:
+        if quarterly or keywords[0].cik:
+            filing_date = quarterly[:7] if quarterly else keywords[0].filing_date
+            steps = quarterly_steps(filing_date=filing_date, journal=journal, merge=merge,
+                                    overlap_months=overlap_months, grid=grid, **fn_args)
+        else:
+            steps = single_steps(start_date=start_date, end_date=end_date, **fn_args)
+        all_data = await run_steps_async(steps, client, throttle)
+    except (FormatException, TransientException) as e:
+        if dead_letter is None:
+            raise
+        dead_letter.add(keywords, category, e)
+        return []
+
+    with METRICS.timed("parse"):
+        add_interest(keywords, all_data)
+    METRICS.inc("keywords_total")
+    return keywords
+
+
+async def _jobs(keyword_gen):
+    "Accepts plain and async iterables of keywords."
+    if hasattr(keyword_gen, "__aiter__"):
+        async for job in keyword_gen:
+            yield job
+    else:
+        for job in keyword_gen:
+            yield job
+
+
+async def async_get_trends(keyword_gen, username=None, password=None,
+            start_date=None,
+            end_date=None,
+            throttle=1,
+            quarterly=None,
+            category=None,
+            trends_url=DEFAULT_TRENDS_URL,
+            login_url=DEFAULT_LOGIN_URL,
+            auth_url=DEFAULT_AUTH_URL,
+            primary_types=PRIMARY_TYPES,
+            backup_types=BACKUP_TYPES,
+            dead_letter=None,
+            journal=None,
+            pool_size=4,
+            merge='anchor',
+            overlap_months=DEFAULT_OVERLAP_MONTHS,
+            concurrency=DEFAULT_CONCURRENCY,
+            auth=None,
+            entity_index=None,
+            grid=False):
+    """ Async iterator of KeywordData, see get_trends() for the arguments.
+
+        Arguments (in addition to get_trends()):
+            keyword_gen -- an iterable or async iterable of keywords/cik rows
+            concurrency -- keywords processed at the same time; results are
+                yielded in completion order
+            auth -- (session, cookies, domain) from authenticate_with_google(),
+                to share one login between several streams
+
+        Raises CategoryException for unknown categories before logging in.
+    """
+    validate_category(category)
+    if grid and journal is None:
+        journal = WindowJournal(None) # grid cells are still shared within this call
+    start_date = start_date or arrow.utcnow().replace(months=-2)
+    end_date = end_date or arrow.utcnow()
+
+    METRICS.set_account(username)
+    if auth is None:
+        from google_auth import authenticate_with_google
+        login = functools.partial(authenticate_with_google, username, password,
+                                  login_url=login_url, auth_url=auth_url, pool_size=pool_size)
+        auth = await asyncio.get_event_loop().run_in_executor(None, login)
+    session, cookies, domain = auth
+
+    client = AsyncClient(session, cookies, pool_size)
+    throttle = AsyncThrottle(throttle)
+    task_args = (client, throttle, domain, start_date, end_date, quarterly, category,
+                 trends_url, primary_types, backup_types, dead_letter, journal,
+                 merge, overlap_months, entity_index, grid)
+
+    jobs = _jobs(keyword_gen)
+    pending = set()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < concurrency:
+                try:
+                    job = await jobs.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(_keyword_trends(job, *task_args)))
+            if not pending:
+                break
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                for kw in task.result():
+                    yield kw
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        await client.close()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Benchmarks for the parse / interpolate / merge / disambiguate hot paths.
+
+Fixtures are generated in memory (no network calls, no Google account):
+trendsReport CSV responses for 2, 5 and 10-year windows around a filing
+date, with either all-daily or mixed daily/weekly quarterly windows, and
+1, 100 and 10k keywords.
+
+Each stage is timed (best of --repeat runs) and then run once more under
+tracemalloc to get its peak memory. Results can be saved as a JSON baseline
+and later runs compared against it:
+
+    python3 benchmark.py --save bench_baseline.json
+    python3 benchmark.py --compare bench_baseline.json --threshold 0.25
+
+--startup measures interpreter startup instead: `import trends` and
+`trends.py --help` in fresh subprocesses, checked against --startup-budget,
+with the slowest imports listed from `python -X importtime`.
+"""
+
+from __future__ import print_function, absolute_import
+import os, sys, json, time, random, argparse, platform, tracemalloc, subprocess
+from datetime import date, timedelta
+
+from trends import _process_response, _check_data, parse_ioi_row, quarterly_queries
+from interpolate import interpolate_ioi, change_in_ioi
+from disambiguate import partial_ratio
+from google_class import KeywordData
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENTITY_LIST = os.path.join(HERE, os.pardir, "input-files", "entity_list.txt")
+KEYWORD_SIZES = [1, 100, 10000]
+WINDOW_YEARS = [2, 5, 10]
+MIXES = ["daily", "weekly"]
+FILING_DATE = "2009-06"
+DEFAULT_THRESHOLD = 0.25
+STARTUP_BUDGET = 0.5    # seconds for `trends.py --help`
+STARTUP_CASES = [
+    ("startup|import trends", ["-c", "import trends"]),
+    ("startup|trends.py --help", ["trends.py", "--help"]),
+]
+
+
+
+###################################################
+#### Fixtures
+
+def _month_add(d, months):
+    m = d.month - 1 + months
+    return date(d.year + m // 12, m % 12 + 1, 1)
+
+
+def _daily_rows(start, end, rng):
+    days = (end - start).days
+    return ["{0},{1}".format(start + timedelta(days=i), rng.randint(0, 100))
+            for i in range(days + 1)]
+
+
+def _weekly_rows(start, end, rng):
+    # Google's weekly windows begin on Sundays, not the 1st of the month
+    s = start + timedelta(days=(6 - start.weekday()) % 7)
+    rows = []
+    while s <= end:
+        e = s + timedelta(days=6)
+        rows.append("{0} - {1},{2}".format(s, e, rng.randint(0, 100)))
+        s += timedelta(days=7)
+    return rows
+
+
+def _monthly_rows(start, end, rng):
+    rows = []
+    d = date(start.year, start.month, 1)
+    while d <= end:
+        rows.append("{0},{1}".format(d.strftime("%Y-%m"), rng.randint(0, 100)))
+        d = _month_add(d, 1)
+    return rows
+
+
+def fake_response(topic, start, months, weekly=False, rng=random):
+    """Builds the lines of a trendsReport?export=1 CSV response for a window
+    of `months` months starting at `start`. Google returns daily data for
+    short windows, weekly data for windows up to a few years and monthly
+    data beyond that."""
+    end = min(_month_add(start, months), date.today()) - timedelta(days=1)
+    if months > 60:
+        header, rows = "Month", _monthly_rows(start, end, rng)
+    elif weekly or months > 4:
+        header, rows = "Week", _weekly_rows(start, end, rng)
+    else:
+        header, rows = "Day", _daily_rows(start, end, rng)
+
+    return (["Web Search interest: " + topic,
+             "Worldwide; {0} - {1}".format(start.strftime("%b %Y"), end.strftime("%b %Y")),
+             "",
+             "Interest over time",
+             "{0},{1}".format(header, topic)]
+            + rows +
+            ["",
+             "Top subregions for " + topic,
+             "Subregion," + topic,
+             "New York,100",
+             ""])
+
+
+class _FixtureResponse(object):
+    headers = {"content-type": "text/csv; charset=UTF-8"}
+    status_code = 200
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.text = "\n".join(lines)
+        self.content = self.text.encode("utf-8")
+
+    def iter_lines(self):
+        return (l.encode("utf-8") for l in self.lines)
+
+    def close(self):
+        pass
+
+
+class FixtureSession(object):
+    """Stands in for a requests.Session, answering trendsReport queries
+    from generated fixtures. `weekly_share` of the quarterly windows come
+    back weekly, which exercises the realignment path of quarterly_queries."""
+
+    def __init__(self, weekly_share=0.0, seed=0):
+        self.weekly_share = weekly_share
+        self.rng = random.Random(seed)
+        self.requests = 0
+
+    def get(self, url, params=None, **kwargs):
+        self.requests += 1
+        start, months = params["date"].split(" ")
+        start = date(int(start[3:]), int(start[:2]), 1)
+        weekly = self.rng.random() < self.weekly_share
+        return _FixtureResponse(fake_response(params["q"], start, int(months[:-1]),
+                                              weekly=weekly, rng=self.rng))
+
+
+def make_keywords(n):
+    with open(ENTITY_LIST) as f:
+        names = [l.strip() for l in f if l.strip()]
+    return ["{0} {1}".format(names[i % len(names)], i // len(names)).strip()
+            for i in range(n)]
+
+
+def make_fixture(n_keywords, years, mix, seed=0):
+    """Pre-generates everything the stages consume, so only the code under
+    test is timed."""
+    rng = random.Random(seed)
+    weekly_share = 0.3 if mix == "weekly" else 0.0
+    filing = date(int(FILING_DATE[:4]), int(FILING_DATE[5:7]), 1)
+    begin = _month_add(filing, -6 * years)
+    keywords = make_keywords(n_keywords)
+
+    responses = []
+    for kw in keywords:
+        for q in range(0, 12 * years, 3):
+            weekly = rng.random() < weekly_share
+            responses.append(fake_response(kw, _month_add(begin, q), 3, weekly, rng))
+
+    window_rows = [r for lines in responses for r in _process_response(lines)[1:]]
+    series = []
+    for lines in responses[:max(1, len(responses) // 4)]:
+        rows = [r for r in _process_response(lines)[1:] if r[1] != '']
+        series.append(tuple(zip(*rows)))
+
+    return {
+        "keywords": keywords,
+        "years": years,
+        "weekly_share": weekly_share,
+        "responses": responses,
+        "window_rows": window_rows,
+        "series": series,
+    }
+
+
+
+###################################################
+#### Stages
+
+def stage_process_response(fx):
+    kw = [KeywordData("benchmark")]
+    for lines in fx["responses"]:
+        _check_data(kw, _process_response(lines))
+
+
+def stage_parse_ioi_row(fx):
+    for row in fx["window_rows"]:
+        parse_ioi_row(row)
+
+
+def stage_interpolate_ioi(fx):
+    for dates, ioi in fx["series"]:
+        interpolate_ioi(dates, ioi)
+
+
+def stage_change_in_ioi(fx):
+    for dates, ioi in fx["series"]:
+        change_in_ioi(dates, ioi)
+
+
+def stage_merge(fx):
+    years = fx["years"]
+    session = FixtureSession(fx["weekly_share"])
+    for kw in fx["keywords"]:
+        keyword = KeywordData(kw)
+        keyword.topic = keyword.title = kw
+        quarterly_queries([keyword], category=None, cookies={}, session=session,
+                          domain="google.com", throttle=0, filing_date=FILING_DATE,
+                          ggplot=None, month_offset=[-6 * years, 6 * years])
+
+
+def stage_partial_ratio(fx):
+    with open(ENTITY_LIST) as f:
+        titles = [l.strip() for l in f if l.strip()]
+    for kw in fx["keywords"]:
+        max(partial_ratio(kw, t) for t in titles)
+
+
+STAGES = [
+    ("process_response", stage_process_response),
+    ("parse_ioi_row", stage_parse_ioi_row),
+    ("interpolate_ioi", stage_interpolate_ioi),
+    ("change_in_ioi", stage_change_in_ioi),
+    ("merge", stage_merge),
+    ("partial_ratio", stage_partial_ratio),
+]
+# stages whose cost does not depend on the window length or mix
+KEYWORD_ONLY_STAGES = {"partial_ratio"}
+
+
+
+###################################################
+#### Runner
+
+def measure(fn, fx, repeat):
+    "Returns (best wall-clock seconds, peak traced memory in KiB)."
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(fx)
+        best = min(best, time.perf_counter() - t0)
+
+    # memory is measured separately, tracemalloc distorts timings
+    tracemalloc.start()
+    fn(fx)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 1024.0
+
+
+def case_name(stage, n_keywords, years=None, mix=None):
+    if years is None:
+        return "{0}|k={1}".format(stage, n_keywords)
+    return "{0}|k={1}|y={2}|mix={3}".format(stage, n_keywords, years, mix)
+
+
+def run(keyword_sizes, window_years, mixes, stages, repeat=1):
+    results = {}
+    for k in keyword_sizes:
+        for years in window_years:
+            for mix in mixes:
+                fx = make_fixture(k, years, mix)
+                for name, fn in STAGES:
+                    if name not in stages:
+                        continue
+                    if name in KEYWORD_ONLY_STAGES:
+                        case = case_name(name, k)
+                        if case in results:
+                            continue
+                    else:
+                        case = case_name(name, k, years, mix)
+                    seconds, peak_kb = measure(fn, fx, repeat)
+                    results[case] = {"seconds": round(seconds, 6),
+                                     "peak_kb": round(peak_kb, 1)}
+                    print("{0:<48} {1:>10.4f}s {2:>12.1f} KiB".format(case, seconds, peak_kb))
+    return results
+
+
+def startup_time(argv, repeat):
+    "Best wall-clock time of a fresh interpreter running `argv`."
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.check_call([sys.executable] + argv, cwd=HERE,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def slowest_imports(module="trends", top=15):
+    """Parses `python -X importtime` output and returns the `top` imports
+    by cumulative time as (microseconds, package)."""
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    rows = []
+    for line in err.decode("utf-8", "replace").splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, package = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), package.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def run_startup(repeat=3):
+    results = {}
+    for case, argv in STARTUP_CASES:
+        seconds = startup_time(argv, repeat)
+        results[case] = {"seconds": round(seconds, 6), "peak_kb": 0}
+        print("{0:<48} {1:>10.4f}s".format(case, seconds))
+
+    print("\nSlowest imports (cumulative):")
+    for us, package in slowest_imports():
+        print("{0:>10.1f} ms  {1}".format(us / 1000.0, package))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns a list of (case, metric, baseline, current) for every case that
+    got slower or hungrier than the baseline by more than `threshold`."""
+    regressions = []
+    for case, current in sorted(results.items()):
+        old = baseline.get(case)
+        if not old:
+            continue
+        for metric in ("seconds", "peak_kb"):
+            if old[metric] > 0 and current[metric] > old[metric] * (1 + threshold):
+                regressions.append((case, metric, old[metric], current[metric]))
+    return regressions
+
+
+def _csv_ints(s):
+    return [int(x) for x in s.split(",") if x.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmark.py")
+    parser.add_argument("--keywords", dest="keywords", default=KEYWORD_SIZES, type=_csv_ints,
+                        help="Comma-separated keyword counts, e.g. 1,100,10000")
+    parser.add_argument("--years", dest="years", default=WINDOW_YEARS, type=_csv_ints,
+                        help="Comma-separated window lengths in years, e.g. 2,5,10")
+    parser.add_argument("--mix", dest="mixes", default=",".join(MIXES),
+                        help="Comma-separated window mixes: daily,weekly")
+    parser.add_argument("--stages", dest="stages", default=",".join(s for s, _ in STAGES),
+                        help="Comma-separated stages to run")
+    parser.add_argument("--repeat", dest="repeat", default=3, type=int,
+                        help="Timing repetitions per case (best is kept)")
+    parser.add_argument("--save", dest="save", default=None,
+                        help="Write results as a JSON baseline to this path")
+    parser.add_argument("--compare", dest="compare", default=None,
+                        help="Baseline JSON to check for regressions")
+    parser.add_argument("--startup", dest="startup", action="store_true",
+                        help="Measure import/startup time instead of the pipeline stages")
+    parser.add_argument("--startup-budget", dest="startup_budget", default=STARTUP_BUDGET, type=float,
+                        help="Maximum seconds allowed for `trends.py --help`")
+    parser.add_argument("--threshold", dest="threshold", default=DEFAULT_THRESHOLD, type=float,
+                        help="Allowed relative slowdown before flagging, e.g. 0.25")
+    args = parser.parse_args()
+
+    if args.startup:
+        results = run_startup(args.repeat)
+        help_seconds = results["startup|trends.py --help"]["seconds"]
+        if help_seconds > args.startup_budget:
+            print("OVER BUDGET: trends.py --help took {0:.3f}s (budget {1:.3f}s)".format(
+                help_seconds, args.startup_budget))
+            sys.exit(1)
+    else:
+        results = run(args.keywords, args.years, args.mixes.split(","),
+                      set(args.stages.split(",")), repeat=args.repeat)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "results": results}, f, indent=2, sort_keys=True)
+        print("Saved baseline: {}".format(args.save))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for case, metric, old, new in regressions:
+            print("REGRESSION {0} {1}: {2} -> {3} ({4:+.0%})".format(
+                case, metric, old, new, new / old - 1))
+        if regressions:
+            sys.exit(1)
+        print("No regressions beyond {0:.0%}".format(args.threshold))
+
+
+if __name__ == "__main__":
+    main()
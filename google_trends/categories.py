@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Index of Google Trends category codes from categories.txt.
+
+categories.txt (written by create_cat_list.py) is a tab-indented tree of
+"<code>: <name>" lines, where a code is the dash-separated path of category
+ids, e.g. 0-7-107 for All categories -> Finance -> Investing. It is parsed
+once into {code: [name, parent, [children]]} and kept next to it as
+categories.json, so --category can be checked before any request is made.
+
+    python3 categories.py --search bank
+    python3 categories.py --expand 0-7     # 0-7 and all its sub-categories
+"""
+
+import os, sys, json, argparse
+
+from google_class import CategoryException
+
+CATEGORIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "categories.txt")
+_INDEX = {}     # path -> CategoryIndex, loaded once per process
+
+
+
+class CategoryIndex(object):
+    """ Category tree keyed by code """
+
+    def __init__(self, nodes):
+        self.nodes = nodes      # code -> [name, parent code, [child codes]]
+
+    @classmethod
+    def parse(cls, lines):
+        "Builds the tree from categories.txt lines; depth is given by the leading tabs."
+        nodes = {}
+        stack = []      # codes of the current node's ancestors
+        for line in lines:
+            if not line.strip():
+                continue
+            depth = len(line) - len(line.lstrip("\t"))
+            code, name = line.strip().split(": ", 1)
+            del stack[depth:]
+            parent = stack[-1] if stack else None
+            nodes[code] = [name, parent, []]
+            if parent is not None:
+                nodes[parent][2].append(code)
+            stack.append(code)
+        return cls(nodes)
+
+    def __contains__(self, code):
+        return code in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def name(self, code):
+        return self.nodes[code][0]
+
+    def parent(self, code):
+        return self.nodes[code][1]
+
+    def children(self, code):
+        return list(self.nodes[code][2])
+
+    def path(self, code):
+        "Names from the root down to `code`, e.g. ['All categories', 'Finance']."
+        names = []
+        while code is not None:
+            names.insert(0, self.name(code))
+            code = self.parent(code)
+        return names
+
+    def descendants(self, code):
+        "`code` followed by all of its sub-categories, depth first."
+        self.validate(code)
+        codes, todo = [], [code]
+        while todo:
+            code = todo.pop()
+            codes.append(code)
+            todo.extend(reversed(self.nodes[code][2]))
+        return codes
+
+    def search(self, text):
+        "Codes whose name contains `text` (case-insensitive), in file order."
+        text = text.lower()
+        return sorted((c for c, node in self.nodes.items() if text in node[0].lower()),
+                      key=lambda c: [int(i) for i in c.split("-")])
+
+    def validate(self, code):
+        """ Raises CategoryException for codes that are not in the tree,
+            suggesting categories with the same last id. """
+        if code in self.nodes:
+            return code
+        last = code.split("-")[-1]
+        similar = [c for c in self.nodes if c.split("-")[-1] == last]
+        hint = " Did you mean {0}?".format(", ".join(similar[:5])) if similar else ""
+        raise CategoryException("Unknown category '{0}', see categories.txt.{1}".format(code, hint))
+
+    def dump(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.nodes, f, separators=(",", ":"))
+        os.rename(tmp, path)
+
+
+
+def load(path=CATEGORIES_FILE):
+    """ Returns the CategoryIndex for `path`, from its .json cache when that
+        is newer than the text file, otherwise parsing it and refreshing the cache. """
+    if path in _INDEX:
+        return _INDEX[path]
+
+    cache = os.path.splitext(path)[0] + ".json"
+    index = None
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        try:
+            with open(cache) as f:
+                index = CategoryIndex(json.load(f))
+        except ValueError:
+            index = None
+    if index is None:
+        with open(path) as f:
+            index = CategoryIndex.parse(f.readlines())
+        try:
+            index.dump(cache)
+        except (IOError, OSError):
+            pass # read-only install, parse again next time
+    _INDEX[path] = index
+    return index
+
+
+def validate_category(category, path=CATEGORIES_FILE):
+    "Raises CategoryException if `category` is set and not a known code."
+    if category:
+        load(path).validate(category)
+    return category
+
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="categories.py")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--search", dest="search", help="List categories whose name contains this text.")
+    group.add_argument("--expand", dest="expand", help="List a category code and all its sub-categories.")
+    group.add_argument("--check", dest="check", help="Exit with an error if this category code is unknown.")
+    group.add_argument("--build", dest="build", action="store_true", help="Rebuild categories.json.")
+    parser.add_argument("--file", dest="path", default=CATEGORIES_FILE)
+    args = parser.parse_args()
+
+    if args.build:
+        with open(args.path) as f:
+            index = CategoryIndex.parse(f.readlines())
+        index.dump(os.path.splitext(args.path)[0] + ".json")
+        print("{0} categories".format(len(index)))
+        return
+
+    index = load(args.path)
+    try:
+        if args.search:
+            codes = index.search(args.search)
+        elif args.expand:
+            codes = index.descendants(args.expand)
+        else:
+            codes = [index.validate(args.check)]
+    except CategoryException as e:
+        print(e)
+        sys.exit(1)
+    for code in codes:
+        print("{0}\t{1}".format(code, " > ".join(index.path(code)[1:]) or index.name(code)))
+
+
+if __name__ == "__main__":
+    main()
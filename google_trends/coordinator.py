@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Multi-node work coordinator.
+
+One coordinator owns the job list and the output directory; workers on any
+number of nodes lease small batches of keywords over plain HTTP, run them
+through get_trends() and post the CSV results back. Leases that are not
+completed in time are handed to another worker, and requests are counted
+per Google account across all nodes so no account overruns its daily quota.
+
+    # on the coordinator box
+    python3 coordinator.py --cik-file cik-ipos.csv --output ~/gtrends/cik-ipo/finance \
+        --port 8770 --daily-budget 450 --category 0-7
+
+    # on every worker
+    python3 trends.py --coordinator http://coordinator:8770 \
+        --username $GMAIL_USER --password ... --category 0-7 --throttle random
+"""
+
+import os, sys, json, time, uuid, argparse, threading, logging
+
+from proxy import http_server_classes
+from scheduler import QuotaLedger, QuotaScheduler, DEFAULT_DAILY_BUDGET
+from metrics import METRICS
+from categories import validate_category
+from log import setup_logging
+from output import AtomicWriter, scan
+from google_class import CategoryException
+
+DEFAULT_PORT = 8770
+DEFAULT_LEASE_SIZE = 5
+DEFAULT_LEASE_TTL = 1800    # seconds, a quarterly keyword takes a few minutes
+MAX_ATTEMPTS = 3
+logger = logging.getLogger(__name__)
+
+
+
+def job_id(job):
+    "Jobs are cik rows [cik, keyword, date(, priority)] or plain keywords."
+    return job[0] if isinstance(job, (list, tuple)) else job
+
+
+def load_jobs(cik_file=None, batch_file=None):
+    if cik_file:
+        with open(cik_file) as f:
+            return [l.strip().split("|") for l in f if l.strip()]
+    with open(batch_file) as f:
+        return [l.strip().replace(",", "") for l in f if l.strip()]
+
+
+
+
+class Coordinator(object):
+    """ Job queue with leases and per-account quota accounting """
+
+    def __init__(self, jobs, output_dir, daily_budget=DEFAULT_DAILY_BUDGET,
+                 ledger_path=None, lease_ttl=DEFAULT_LEASE_TTL, quarterly=None, category=None):
+        self.output_dir = output_dir
+        self.lease_ttl = lease_ttl
+        self.daily_budget = int(daily_budget)
+        self.ledger = QuotaLedger(ledger_path)
+        self.estimator = QuotaScheduler(None, daily_budget, quarterly=quarterly, category=category)
+        self.lock = threading.Lock()
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        done = scan(output_dir)     # half-written results go back in the queue
+        self.writer = AtomicWriter(output_dir)
+        ordered = self.estimator.ordered(jobs)
+        self.pending = [j for j in ordered if self._filename(j) not in done]
+        self.leases = {}        # lease id -> {worker, account, jobs, costs, expires}
+        self.attempts = {}      # job id -> failed attempts
+        self.failed = []
+        # job ids with a result, however many workers ran them
+        self.completed = set(job_id(j) for j in ordered if self._filename(j) in done)
+
+    @staticmethod
+    def _filename(job):
+        return job_id(job).rstrip() + ".csv"
+
+    def _expire(self):
+        now = time.time()
+        for lease_id, lease in list(self.leases.items()):
+            if lease["expires"] < now:
+                logger.warning("Lease {0} of {1} expired, requeueing {2} job(s)".format(
+                    lease_id, lease["worker"], len(lease["jobs"])))
+                self.pending = list(lease["jobs"].values()) + self.pending
+                del self.leases[lease_id]
+                METRICS.inc("leases_expired_total")
+
+    def _leased_cost(self, account):
+        "Planned requests of the account's leased jobs that have not reported back."
+        return sum(sum(l["costs"].values()) for l in self.leases.values() if l["account"] == account)
+
+    def _release(self, lease_id, job):
+        "Drops a job (and its planned cost) from a lease, and the lease once it is empty."
+        lease = self.leases[lease_id]
+        entry = lease["jobs"].pop(job, None)
+        lease["costs"].pop(job, None)
+        if not lease["jobs"]:
+            del self.leases[lease_id]
+        return entry
+
+    def lease(self, worker, account, size=DEFAULT_LEASE_SIZE):
+        with self.lock:
+            self._expire()
+            # jobs leased on other nodes will spend their share of the budget too
+            remaining = self.daily_budget - self.ledger.spent(account) - self._leased_cost(account)
+            jobs, costs = [], {}
+            while self.pending and len(jobs) < size:
+                job_cost = self.estimator.planned_cost(self.pending[0])
+                if sum(costs.values()) + job_cost > remaining:
+                    break
+                jobs.append(self.pending.pop(0))
+                costs[job_id(jobs[-1])] = job_cost
+
+            if not jobs:
+                finished = not self.pending and not self.leases
+                # otherwise the budget is only held by open leases, ask again later
+                exhausted = bool(self.pending) and (self.daily_budget - self.ledger.spent(account)
+                                                    < self.estimator.planned_cost(self.pending[0]))
+                return {"lease": None, "jobs": [], "done": finished,
+                        "quota_exhausted": exhausted and not finished}
+
+            lease_id = uuid.uuid4().hex[:12]
+            self.leases[lease_id] = {"worker": worker, "account": account,
+                                     "jobs": dict((job_id(j), j) for j in jobs),
+                                     "costs": costs,
+                                     "expires": time.time() + self.lease_ttl}
+            METRICS.inc("leases_total", account=account)
+            return {"lease": lease_id, "jobs": jobs, "ttl": self.lease_ttl, "done": False}
+
+    def complete(self, lease_id, job, filename, body, requests=0):
+        self.writer.write(os.path.basename(filename), body)
+
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease:
+                lease["expires"] = time.time() + self.lease_ttl
+                self.ledger.spend(lease["account"], int(requests))
+            # an expired lease's job may be queued or leased again, the result still counts
+            self.pending = [j for j in self.pending if job_id(j) != job]
+            for other_id in list(self.leases):
+                self._release(other_id, job)
+            self.completed.add(job)
+        return {"ok": True}
+
+    def fail(self, lease_id, job, error=None, retryable=True, requests=0):
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if not lease or job not in lease["jobs"]:
+                return {"ok": False}
+            self.ledger.spend(lease["account"], int(requests))
+            entry = self._release(lease_id, job)
+            self.attempts[job] = self.attempts.get(job, 0) + 1
+            if retryable and self.attempts[job] < MAX_ATTEMPTS:
+                self.pending.append(entry)
+            else:
+                self.failed.append({"job": entry, "error": error})
+        return {"ok": True}
+
+    def status(self):
+        with self.lock:
+            return {"pending": len(self.pending),
+                    "leased": sum(len(l["jobs"]) for l in self.leases.values()),
+                    "completed": len(self.completed),
+                    "failed": self.failed,
+                    "leases": dict((k, {"worker": l["worker"], "account": l["account"],
+                                        "jobs": list(l["jobs"]), "expires": l["expires"]})
+                                   for k, l in self.leases.items()),
+                    "quota": self.ledger.used}
+
+
+
+def make_handler(coordinator):
+    BaseHTTPRequestHandler = http_server_classes()[1]
+
+    class CoordinatorHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.startswith("/status"):
+                return self._reply(coordinator.status())
+            self._reply({"error": "not found"}, 404)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                msg = json.loads(self.rfile.read(length).decode("utf-8"))
+                if self.path == "/lease":
+                    reply = coordinator.lease(msg["worker"], msg["account"],
+                                              msg.get("size", DEFAULT_LEASE_SIZE))
+                elif self.path == "/complete":
+                    reply = coordinator.complete(msg["lease"], msg["job"], msg["filename"],
+                                                 msg["body"], msg.get("requests", 0))
+                elif self.path == "/fail":
+                    reply = coordinator.fail(msg["lease"], msg["job"], msg.get("error"),
+                                             msg.get("retryable", True), msg.get("requests", 0))
+                else:
+                    return self._reply({"error": "not found"}, 404)
+            except (ValueError, KeyError) as e:
+                return self._reply({"error": repr(e)}, 400)
+            self._reply(reply)
+
+        def _reply(self, obj, status=200):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return CoordinatorHandler
+
+
+
+
+class CoordinatorClient(object):
+    """ Worker side: leases jobs and posts results back.
+
+        jobs() is a keyword generator for get_trends(); complete() is called
+        for every KeywordData that comes out of it. Jobs that were handed out
+        but never completed (dead-lettered) are reported as failed when the
+        next lease is requested, and those of the last lease by close().
+    """
+
+    def __init__(self, url, worker, account, lease_size=DEFAULT_LEASE_SIZE):
+        self.url = url.rstrip("/")
+        self.worker = worker
+        self.account = account
+        self.lease_size = lease_size
+        self.lease_id = None
+        self.outstanding = set()
+        self._requests = METRICS.total("requests_total")
+
+    def _post(self, path, msg):
+        import requests
+        response = requests.post(self.url + path, data=json.dumps(msg),
+                                 headers={"Content-Type": "application/json"}, timeout=60)
+        response.raise_for_status()
+        return response.json()
+
+    def _spent(self):
+        now = METRICS.total("requests_total")
+        spent, self._requests = now - self._requests, now
+        return spent
+
+    def _fail_outstanding(self, error):
+        for job in list(self.outstanding):
+            self._post("/fail", {"lease": self.lease_id, "job": job,
+                                 "error": "{0} by {1}".format(error, self.worker),
+                                 "requests": self._spent()})
+        self.outstanding = set()
+
+    def close(self):
+        "Reports the jobs of the last lease that did not complete, e.g. on a QuotaException."
+        try:
+            self._fail_outstanding("stopped before completion")
+        except Exception as e:
+            logger.warning("Could not report unfinished jobs to the coordinator ({0!r}), "
+                           "they are requeued when the lease expires.".format(e))
+
+    def jobs(self):
+        while True:
+            self._fail_outstanding("not completed")
+
+            reply = self._post("/lease", {"worker": self.worker, "account": self.account,
+                                          "size": self.lease_size})
+            if reply.get("done"):
+                return
+            if not reply["jobs"]:
+                if reply.get("quota_exhausted"):
+                    logger.warning("Daily quota for {0} used up on the coordinator.".format(self.account))
+                    return
+                time.sleep(30) # everything is leased or the budget is held by leases, wait
+                continue
+
+            self.lease_id = reply["lease"]
+            for job in reply["jobs"]:
+                self.outstanding.add(job_id(job))
+                yield job[:3] if isinstance(job, list) else job
+
+    def complete(self, keyword_data, filename, body):
+        job = keyword_data.cik if keyword_data.cik is not None else keyword_data.orig_keyword
+        self._post("/complete", {"lease": self.lease_id, "job": job, "filename": filename,
+                                 "body": body, "requests": self._spent()})
+        self.outstanding.discard(job)
+
+
+
+
+def serve(coordinator, port=DEFAULT_PORT, host="0.0.0.0"):
+    ThreadingHTTPServer = http_server_classes()[0]
+    server = ThreadingHTTPServer((host, int(port)), make_handler(coordinator))
+    logger.info("Coordinator on http://{0}:{1}: {2} pending, {3} already done".format(
+        host, port, len(coordinator.pending), len(coordinator.completed)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        coordinator.writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="coordinator.py")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--cik-file", dest="cik_file", help="Pipe delimited [cik|keyword|date(|priority)] rows.")
+    group.add_argument("--file", dest="batch_input_path", help="Newline-separated keywords.")
+    parser.add_argument("--output", dest="output_path", required=True,
+                        help="Directory results are written to.")
+    parser.add_argument("--port", dest="port", default=DEFAULT_PORT, type=int)
+    parser.add_argument("--host", dest="host", default="0.0.0.0")
+    parser.add_argument("--daily-budget", dest="daily_budget", default=DEFAULT_DAILY_BUDGET, type=int,
+                        help="Requests per Google account per day, across all nodes.")
+    parser.add_argument("--ledger", dest="ledger", default=None,
+                        help="JSON file of requests used per account per day (default: in --output).")
+    parser.add_argument("--lease-ttl", dest="lease_ttl", default=DEFAULT_LEASE_TTL, type=int,
+                        help="Seconds before an unfinished lease is handed to another worker.")
+    parser.add_argument("--quarterly", dest="quarterly", default=None,
+                        help="Same --quarterly date the workers use, for cost estimates.")
+    parser.add_argument("--category", dest="category", default=None)
+    parser.add_argument("--log-file", dest="log_file", default=None,
+                        help="Append log messages to this file instead of stderr.")
+    args = parser.parse_args()
+    setup_logging("INFO", args.log_file)
+    try:
+        validate_category(args.category)
+    except CategoryException as e:
+        logger.error("--category: {0}".format(e))
+        sys.exit(1)
+
+    jobs = load_jobs(args.cik_file, args.batch_input_path)
+    ledger = args.ledger or os.path.join(args.output_path, ".quota_ledger.json")
+    coordinator = Coordinator(jobs, args.output_path, args.daily_budget, ledger,
+                              args.lease_ttl, args.quarterly, args.category)
+    serve(coordinator, args.port, args.host)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,20 +7,27 @@ import unicodedata
 import arrow
 
 from difflib import SequenceMatcher
-from google_class import KeywordData, QuotaException
+from google_class import KeywordData, QuotaException, TransientException
+from retry import retry_call, http_call, request_timeout
+from proxy import route
+from metrics import METRICS
+from profiling import timed_function
 
 PY3 = sys.version_info[0] == 3
 ENTITY_QUERY_URL = "http://www.google.com/trends/entitiesQuery"
 NUM_KEYWORDS_PER_REQUEST = 1
+MATCH_THRESHOLD = 70    # partial_ratio a title must beat to be picked as the topic
 ## WARNING: 1 keyword per request, otherwise Google Trends returns
 ## RELATIVE search frequencies of keywords.
 
 
 
+@timed_function
 def disambiguate_keywords(keyword_generator, session, cookies,
                           primary_types, backup_types,
                           url=ENTITY_QUERY_URL,
-                          keywords_to_return=NUM_KEYWORDS_PER_REQUEST):
+                          keywords_to_return=NUM_KEYWORDS_PER_REQUEST,
+                          entity_index=None):
     """ Extracts a subset of the keywords from the
         generator and maps these keywords to the most
         likely associated topic.
@@ -31,8 +38,12 @@ def disambiguate_keywords(keyword_generator, session, cookies,
             cookies -- The cookies to use when sending requests
             keywords_to_return -- The maximum number of keywords to return
             url -- The URL to request query disambiguation from
+            entity_index -- Optional EntityIndex. Keywords it can match are
+                resolved without a request; responses are added to it.
 
-        Returns a sequence of KeywordData Objects.
+        Returns a sequence of KeywordData Objects. A lookup that fails after
+        its retries raises TransientException with the keyword's KeywordData
+        in its `keywords`.
     """
 
     data = []
@@ -40,58 +51,18 @@ def disambiguate_keywords(keyword_generator, session, cookies,
         for keyword in keyword_generator:
 
             # special cases: --cik-ipos, --ipo-quarters flags.
-            cik_filings = len(keyword) == 3
-            if cik_filings:
-                cik, keyword, filing_date = keyword
-
-
-            entity_data = session.get(url, params={"q": keyword})
-            try:
-                entities = json.loads(entity_data.content.decode('utf-8'))["entityList"]
-
-                if 'company' in primary_types:
-                    firms = [e for e in entities if e['type'].lower() in primary_types
-                            or 'company' in e['type'].lower() or 'business' in e['type'].lower()]
-                else:
-                    firms = [e for e in entities if e['type'].lower() in primary_types]
-
-                if not firms:
-                    firms = [e for e in entities if e['type'].lower() in backup_types]
-
-                # fuzzy string matching to pick best match
-                if firms:
-                    fuzz_scores = [partial_ratio(keyword, dic['title']) for dic in firms]
-                    if max(fuzz_scores) > 70:
-                        # May potentially have 2 exact matches, e.g. Groupon
-                        # Isolate max scores, then pick 1st entry.
-                        maxfirms = [tup for tup in zip(fuzz_scores, firms)
-                                    if tup[0] == max(fuzz_scores)]
-                        meanings = maxfirms[0][1]
-                        # select dictionary associated to 1st max entry
-                    else:
-                        meanings = None
-                else:
-                    meanings = None
-
-            except ValueError: # thrown when content is not JSON
-                raise QuotaException("The request quota has been reached. " +
-                                    "This may be the daily quota (~500 queries?)" +
-                                    "or the rate limiting quota.")
-
-            if not meanings:
-                fixed_keyword = keyword
-                kw_data = KeywordData(fixed_keyword, keyword)
-                kw_data.topic = fixed_keyword
-                kw_data.title = fixed_keyword
-                kw_data.desc = "Search term"
-            else:
-                entity_dict = meanings
-                kw_data = KeywordData(keyword)
-                kw_data.topic = entity_dict["mid"]
-                kw_data.title = entity_dict["title"]
-                kw_data.desc = entity_dict["type"]
-
-            if cik_filings:
+            cik, keyword, filing_date = unpack_keyword(keyword)
+
+            kw_data = entity_index.resolve(keyword, primary_types, backup_types) if entity_index else None
+            if kw_data is None:
+                try:
+                    kw_data = _request_keyword_data(keyword, session, cookies, url,
+                                                    primary_types, backup_types, entity_index)
+                except TransientException as e:
+                    # out of retries: let the caller dead-letter this keyword
+                    e.keywords = [unresolved_keyword_data((cik, keyword, filing_date))]
+                    raise
+            if cik is not None:
                 kw_data.cik = cik
                 kw_data.filing_date = filing_date
 
@@ -108,6 +79,108 @@ def disambiguate_keywords(keyword_generator, session, cookies,
 
 
 
+def _request_keyword_data(keyword, session, cookies, url, primary_types, backup_types, entity_index=None):
+    "Looks a keyword up on entitiesQuery, see entity_keyword_data()."
+    request_url, request_params = route(url, {"q": keyword})
+    with METRICS.timed("entity_lookup"):
+        entity_data = retry_call(lambda: http_call(
+            lambda: session.get(request_url, params=request_params, cookies=cookies,
+                                timeout=request_timeout()),
+            params={"q": keyword}))
+    METRICS.inc("requests_total", endpoint="entitiesQuery")
+    METRICS.inc("bytes_received_total", len(entity_data.content), endpoint="entitiesQuery")
+
+    return entity_keyword_data(keyword, entity_data.content, primary_types, backup_types,
+                               entity_index)
+
+
+
+def unpack_keyword(keyword):
+    "Returns (cik, keyword, filing_date) for cik rows, (None, keyword, None) for plain keywords."
+    if isinstance(keyword, (list, tuple)) and len(keyword) == 3:
+        return tuple(keyword)
+    return None, keyword, None
+
+
+def unresolved_keyword_data(keyword):
+    "KeywordData of a keyword whose lookup failed, with its cik and filing date."
+    cik, keyword, filing_date = unpack_keyword(keyword)
+    kw_data = KeywordData(keyword)
+    kw_data.cik = cik
+    kw_data.filing_date = filing_date
+    return kw_data
+
+
+def entity_keyword_data(keyword, content, primary_types, backup_types, entity_index=None):
+    """ Maps a keyword to its most likely topic from an entitiesQuery
+        response body, falling back to the plain search term. The
+        response's entities are added to `entity_index`, if given.
+
+        Returns a KeywordData object. """
+    try:
+        entities = json.loads(content.decode('utf-8'))["entityList"]
+    except ValueError: # thrown when content is not JSON
+        METRICS.inc("quota_errors_total", endpoint="entitiesQuery")
+        raise QuotaException("The request quota has been reached. " +
+                            "This may be the daily quota (~500 queries?)" +
+                            "or the rate limiting quota.")
+
+    if entity_index is not None:
+        entity_index.add(entities)
+    meanings = best_match(keyword, filter_entities(entities, primary_types, backup_types))
+    return topic_keyword_data(keyword, meanings)
+
+
+def filter_entities(entities, primary_types, backup_types):
+    "Entities of the primary types, or of the backup types if there are none."
+    if 'company' in primary_types:
+        firms = [e for e in entities if e['type'].lower() in primary_types
+                or 'company' in e['type'].lower() or 'business' in e['type'].lower()]
+    else:
+        firms = [e for e in entities if e['type'].lower() in primary_types]
+
+    if not firms:
+        firms = [e for e in entities if e['type'].lower() in backup_types]
+    return firms
+
+
+def best_match(keyword, firms, score=None):
+    """ The entity whose title matches `keyword` best, if it scores above
+        MATCH_THRESHOLD, otherwise None. `score(keyword, entity)` defaults
+        to partial_ratio() on the title. """
+    if not firms:
+        return None
+    # fuzzy string matching to pick best match
+    score = score or (lambda kw, dic: partial_ratio(kw, dic['title']))
+    fuzz_scores = [score(keyword, dic) for dic in firms]
+    if max(fuzz_scores) > MATCH_THRESHOLD:
+        # May potentially have 2 exact matches, e.g. Groupon
+        # Isolate max scores, then pick 1st entry.
+        maxfirms = [tup for tup in zip(fuzz_scores, firms)
+                    if tup[0] == max(fuzz_scores)]
+        # select dictionary associated to 1st max entry
+        return maxfirms[0][1]
+    return None
+
+
+def topic_keyword_data(keyword, meanings):
+    "KeywordData for an entity dict, or for the plain search term if None."
+    if not meanings:
+        fixed_keyword = keyword
+        kw_data = KeywordData(fixed_keyword, keyword)
+        kw_data.topic = fixed_keyword
+        kw_data.title = fixed_keyword
+        kw_data.desc = "Search term"
+    else:
+        entity_dict = meanings
+        kw_data = KeywordData(keyword)
+        kw_data.topic = entity_dict["mid"]
+        kw_data.title = entity_dict["title"]
+        kw_data.desc = entity_dict["type"]
+    return kw_data
+
+
+
 
 
 def fuzz_ratio(s1,  s2):
@@ -122,6 +195,7 @@ def fuzz_ratio(s1,  s2):
 
 
 
+@timed_function
 def partial_ratio(s1, s2):
 
     if s1 is None:
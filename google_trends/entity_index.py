@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Local index of the entities seen in entitiesQuery responses.
+
+Every (mid, title, type) returned by Google is appended to a JSON lines file
+and indexed by the character trigrams of its title. Before a keyword is
+looked up online, the titles sharing enough trigrams with it are scored with
+the same type filtering (PRIMARY_TYPES, then BACKUP_TYPES) and partial_ratio
+threshold as disambiguate_keywords(); if one clears it, the keyword is
+resolved locally and no request is made. "Goldman Sachs Group" and
+"Goldman Sachs & Co" both find the entity first seen for "Goldman Sachs".
+
+    python3 entity_index.py --lookup "Goldman Sachs Group"
+    python3 entity_index.py --stats
+"""
+
+import os, re, sys, json, argparse, unicodedata
+from collections import defaultdict
+
+from disambiguate import filter_entities, best_match, topic_keyword_data, partial_ratio
+from entity_types import PRIMARY_TYPES, BACKUP_TYPES
+from metrics import METRICS
+
+DEFAULT_INDEX = os.path.join(os.path.expanduser("~"), ".gtrends_entities.jsonl")
+NGRAM = 3
+MIN_OVERLAP = 0.5       # share of the shorter string's trigrams a candidate must contain
+MAX_CANDIDATES = 50     # titles scored per lookup, by trigram overlap
+MAX_SCORES = 100000     # cached partial_ratio scores before the cache is reset
+
+
+
+def normalize(text):
+    "Lower case ASCII letters and digits, runs of anything else as one space."
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.split(r"[^0-9a-z]+", text.lower())).strip()
+
+
+def ngrams(text, n=NGRAM):
+    "Set of character n-grams of the normalized, space padded text."
+    text = " {0} ".format(normalize(text))
+    return set(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+
+
+class EntityIndex(object):
+    """ Entities by mid, with a trigram -> mids inverted index on titles """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entities = {}      # mid -> {"mid", "title", "type"}, latest wins
+        self.postings = defaultdict(set)
+        self.scores = {}        # (keyword, title) -> partial_ratio
+        if path:
+            dirname = os.path.dirname(os.path.abspath(path))
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            if os.path.exists(path):
+                self._load()
+
+    def __len__(self):
+        return len(self.entities)
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue # torn final line from a killed process
+                self._insert({"mid": e["mid"], "title": e["title"], "type": e["type"]})
+
+    def _insert(self, entity):
+        mid = entity["mid"]
+        known = self.entities.get(mid)
+        if known == entity:
+            return False
+        if known is not None:
+            for gram in ngrams(known["title"]):
+                self.postings[gram].discard(mid)
+        self.entities[mid] = entity
+        for gram in ngrams(entity["title"]):
+            self.postings[gram].add(mid)
+        return True
+
+    def add(self, entities):
+        "Adds an entitiesQuery entityList; new or changed entities are appended to the file."
+        new = []
+        for e in entities:
+            if "mid" not in e or "title" not in e or "type" not in e:
+                continue
+            entity = {"mid": e["mid"], "title": e["title"], "type": e["type"]}
+            if self._insert(entity):
+                new.append(entity)
+        if new and self.path:
+            with open(self.path, "a") as f:
+                for entity in new:
+                    f.write(json.dumps(entity) + "\n")
+        METRICS.inc("entity_index_added_total", len(new))
+
+    def candidates(self, keyword):
+        """ Entities whose title shares at least MIN_OVERLAP of the shorter
+            string's trigrams with `keyword`, closest first. """
+        grams = ngrams(keyword)
+        overlap = defaultdict(int)
+        for gram in grams:
+            for mid in self.postings.get(gram, ()):
+                overlap[mid] += 1
+
+        ranked = []
+        for mid, shared in overlap.items():
+            entity = self.entities[mid]
+            shorter = min(len(grams), len(ngrams(entity["title"])))
+            if shared >= MIN_OVERLAP * shorter:
+                ranked.append((-float(shared) / shorter, entity["title"], mid))
+        ranked.sort()
+        return [self.entities[r[-1]] for r in ranked[:MAX_CANDIDATES]]
+
+    def score(self, keyword, entity):
+        "partial_ratio() of keyword and title, computed once per pair."
+        key = (keyword, entity["title"])
+        if key not in self.scores:
+            if len(self.scores) >= MAX_SCORES:
+                self.scores.clear()
+            self.scores[key] = partial_ratio(keyword, entity["title"])
+        return self.scores[key]
+
+    def match(self, keyword, primary_types=PRIMARY_TYPES, backup_types=BACKUP_TYPES):
+        "The entity disambiguate_keywords() would pick among the indexed ones, or None."
+        firms = filter_entities(self.candidates(keyword), primary_types, backup_types)
+        return best_match(keyword, firms, score=self.score)
+
+    def resolve(self, keyword, primary_types=PRIMARY_TYPES, backup_types=BACKUP_TYPES):
+        "KeywordData for a locally matched keyword, or None if it needs a lookup."
+        entity = self.match(keyword, primary_types, backup_types)
+        METRICS.cache("entity_index", entity is not None)
+        if entity is None:
+            return None
+        return topic_keyword_data(keyword, entity)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="entity_index.py")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--lookup", dest="lookup", help="Show the entity a keyword resolves to locally.")
+    group.add_argument("--candidates", dest="candidates", help="List indexed entities scored for a keyword.")
+    group.add_argument("--stats", dest="stats", action="store_true", help="Number of indexed entities.")
+    parser.add_argument("--index", dest="path", default=DEFAULT_INDEX)
+    args = parser.parse_args()
+
+    index = EntityIndex(args.path)
+    if args.stats:
+        print("{0} entities, {1} trigrams".format(len(index), len(index.postings)))
+    elif args.lookup:
+        entity = index.match(args.lookup)
+        if entity is None:
+            print("no local match")
+            sys.exit(1)
+        print("{mid}\t{title}\t{type}".format(**entity))
+    else:
+        for entity in index.candidates(args.candidates):
+            print("{0}\t{mid}\t{title}\t{type}".format(index.score(args.candidates, entity), **entity))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Event-window attention statistics for --cik-file runs.
+
+For every keyword with a filing date, the merged daily series is compared
+around that date while it is still in memory, and one row per keyword is
+appended to a summary table (event_windows.csv in the output directory):
+
+    cik, keyword, mid, title, filing_date, category,
+    baseline_mean, baseline_sd, baseline_days,
+    <window>_days, <window>_mean, <window>_abn, <window>_car, <window>_z, ...
+
+Windows are day offsets from the filing date, inclusive, e.g. the default
+"pre=-30:-1,event=0:1,post=2:30". For each window, `abn` is the mean
+interest minus the baseline mean, `car` the cumulative abnormal interest
+(sum of daily interest minus the baseline mean) and `z` the abnormal mean in
+baseline standard deviations. Days without data are left out of every
+statistic. All windows of a keyword are read off the same prefix sums, so
+each costs O(1) however long it is.
+"""
+
+import os, csv, math, logging
+from array import array
+
+import arrow
+
+from windows import aget
+from matrix import _day, _count
+
+DEFAULT_WINDOWS = "pre=-30:-1,event=0:1,post=2:30"
+DEFAULT_BASELINE = "-180:-31"
+EVENTS_FILENAME = "event_windows.csv"
+ID_COLUMNS = ["cik", "keyword", "mid", "title", "filing_date", "category"]
+BASELINE_COLUMNS = ["baseline_mean", "baseline_sd", "baseline_days"]
+WINDOW_STATS = ("days", "mean", "abn", "car", "z")
+logger = logging.getLogger(__name__)
+
+
+
+def _offset_name(n):
+    return "m{0}".format(-n) if n < 0 else str(n)
+
+
+def parse_range(spec):
+    "'-30:-1' -> (-30, -1). Raises ValueError."
+    start, end = [int(x) for x in spec.split(":")]
+    if start > end:
+        raise ValueError("window {0} ends before it starts".format(spec))
+    return start, end
+
+
+def parse_windows(spec):
+    """ 'pre=-30:-1,0:5' -> [('pre', -30, -1), ('d0_5', 0, 5)].
+        Raises ValueError for malformed or duplicate windows. """
+    windows = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, days = item.rpartition("=")
+        start, end = parse_range(days)
+        name = name.strip() or "d{0}_{1}".format(_offset_name(start), _offset_name(end))
+        if name in [w[0] for w in windows]:
+            raise ValueError("window {0} given twice".format(name))
+        windows.append((name, start, end))
+    if not windows:
+        raise ValueError("no windows in '{0}'".format(spec))
+    return windows
+
+
+def event_date(filing_date):
+    "datetime.date of a --cik-file filing date (YYYY-MM-DD, YYYY-MM or M-D-YYYY)."
+    try:
+        return arrow.get(filing_date, "YYYY-MM-DD").date()
+    except (arrow.parser.ParserError, ValueError, TypeError):
+        return aget(filing_date).date()
+
+
+
+class EventSeries(object):
+    """ Daily interest indexed by offset from the event date, with prefix sums
+        of values, squares and observed days """
+
+    def __init__(self, interest, event):
+        points = []
+        for date, count in interest:
+            value = _count(count)
+            if value is not None:
+                points.append(((_day(date) - event).days, value))
+        self.first = min(p[0] for p in points) if points else 0
+        size = (max(p[0] for p in points) - self.first + 1) if points else 0
+
+        values = array("d", [0.0]) * size
+        seen = array("B", [0]) * size
+        for offset, value in points:
+            values[offset - self.first] = value
+            seen[offset - self.first] = 1
+
+        # sums[i] covers the first i days
+        self.sums = array("d", [0.0]) * (size + 1)
+        self.squares = array("d", [0.0]) * (size + 1)
+        self.counts = array("l", [0]) * (size + 1)
+        for i in range(size):
+            self.sums[i + 1] = self.sums[i] + values[i]
+            self.squares[i + 1] = self.squares[i] + values[i] * values[i]
+            self.counts[i + 1] = self.counts[i] + seen[i]
+
+    def totals(self, start, end):
+        "(observed days, sum, sum of squares) for offsets start..end inclusive."
+        size = len(self.counts) - 1
+        lo = min(max(start - self.first, 0), size)
+        hi = min(max(end - self.first + 1, 0), size)
+        if hi <= lo:
+            return 0, 0.0, 0.0
+        return (self.counts[hi] - self.counts[lo], self.sums[hi] - self.sums[lo],
+                self.squares[hi] - self.squares[lo])
+
+
+
+def event_stats(keyword_data, windows, baseline=parse_range(DEFAULT_BASELINE), event=None):
+    """ Summary statistics of one keyword around its filing date, as a
+        {column: value} dict; statistics that cannot be computed are None.
+
+        windows -- [(name, start, end)] from parse_windows()
+        baseline -- (start, end) offsets the abnormal attention is measured against
+        event -- date to use instead of keyword_data.filing_date
+    """
+    event = event or event_date(keyword_data.filing_date)
+    series = EventSeries(keyword_data.interest, event)
+
+    n, total, squares = series.totals(*baseline)
+    mu = total / n if n else None
+    sd = math.sqrt(max(squares / n - mu * mu, 0.0)) if n else None
+    row = {"baseline_mean": mu, "baseline_sd": sd, "baseline_days": n}
+
+    for name, start, end in windows:
+        n, total, squares = series.totals(start, end)
+        mean = total / n if n else None
+        abn = mean - mu if n and mu is not None else None
+        row[name + "_days"] = n
+        row[name + "_mean"] = mean
+        row[name + "_abn"] = abn
+        row[name + "_car"] = total - n * mu if abn is not None else None
+        row[name + "_z"] = abn / sd if abn is not None and sd else None
+    return row
+
+
+
+class EventSummary(object):
+    """ The summary table: one row per keyword, appended as keywords finish.
+        Keywords already in the file (by cik) are not written again. """
+
+    def __init__(self, path, windows=parse_windows(DEFAULT_WINDOWS),
+                 baseline=parse_range(DEFAULT_BASELINE)):
+        self.path = path
+        self.windows = windows
+        self.baseline = baseline
+        self.columns = ID_COLUMNS + BASELINE_COLUMNS + ["{0}_{1}".format(w[0], s)
+                                                        for w in windows for s in WINDOW_STATS]
+        self.done = set()
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path) as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                if header != self.columns:
+                    raise ValueError("{0} was written with other windows, use another --event-file".format(path))
+                self.done = set(r[0] for r in reader if r)
+            self.f = open(path, "a")
+            self.writer = csv.writer(self.f)
+        else:
+            dirname = os.path.dirname(os.path.abspath(path))
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self.f = open(path, "w")
+            self.writer = csv.writer(self.f)
+            self.writer.writerow(self.columns)
+
+    def add(self, keyword_data, category=None):
+        "Computes and appends the row of a keyword; keywords without a filing date are skipped."
+        if not keyword_data.filing_date or str(keyword_data.cik) in self.done:
+            return None
+        try:
+            stats = event_stats(keyword_data, self.windows, self.baseline)
+        except (arrow.parser.ParserError, ValueError, TypeError) as e:
+            logger.warning("{0}: bad filing date {1!r} ({2})".format(
+                keyword_data.cik, keyword_data.filing_date, e))
+            return None
+        stats.update({"cik": keyword_data.cik, "keyword": keyword_data.keyword,
+                      "mid": keyword_data.topic, "title": keyword_data.title,
+                      "filing_date": keyword_data.filing_date, "category": category or ""})
+        self.writer.writerow([_cell(stats[c]) for c in self.columns])
+        self.f.flush()
+        self.done.add(str(keyword_data.cik))
+        return stats
+
+    def close(self):
+        self.f.close()
+
+
+def _cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return "{0:.6g}".format(value)
+    return value
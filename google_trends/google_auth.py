@@ -1,30 +1,28 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import requests, sys, os, re, time
-import colorama
+import requests, sys, os, re, time, logging
 from google_class import AuthException
+from metrics import METRICS
+from transport import make_session, DEFAULT_POOL_SIZE
+from retry import request_timeout
 
-requests.packages.urllib3.disable_warnings()
 py3 = sys.version_info[0] == 3
 if not py3:
     from urlparse import urlparse
 else:
     from urllib.parse import urlparse
 
-try:
-    from IPython import embed
-except ImportError:
-    pass
-
 DEFAULT_LOGIN_URL = "https://accounts.google.com.au/ServiceLogin"
 DEFAULT_AUTH_URL = "https://accounts.{domain}/ServiceLoginAuth"
 BASE_DIR = os.path.join(os.path.expanduser("~"), "Dropbox", "gtrends-beta")
+logger = logging.getLogger(__name__)
 
 
 
 
-def authenticate_with_google(username, password, login_url=DEFAULT_LOGIN_URL, auth_url=DEFAULT_AUTH_URL):
+def authenticate_with_google(username, password, login_url=DEFAULT_LOGIN_URL, auth_url=DEFAULT_AUTH_URL,
+                             pool_size=DEFAULT_POOL_SIZE):
     """ Authenticates with Google using their user login portal.
         This is necessary rather than using something like OAuth since they don't have a trends API.
 
@@ -33,13 +31,27 @@ def authenticate_with_google(username, password, login_url=DEFAULT_LOGIN_URL, au
             --password:  Password of Google account holder
             --login_url: Address to use for stage-1 authentication
             --auth_url:  Address to use for stage-2 authentication
+            --pool_size: Connections kept per host by the returned session
         Returns a set of cookies to use for subsequent requests.
     """
 
+    logger.info('Starting new session: [{}]'.format(username))
+    METRICS.set_account(username)
+    with METRICS.timed("login"):
+        sess, cookies, domain = _login(username, password, login_url, auth_url, pool_size)
+    METRICS.inc("logins_total")
+    return sess, cookies, domain
+
+
+
+def _login(username, password, login_url, auth_url, pool_size=DEFAULT_POOL_SIZE):
+    "Performs the login page, auth post and homepage cookie requests."
+    # login page is fetched with verify=False, silence urllib3 about it
+    requests.packages.urllib3.disable_warnings()
     # first get the cookie from the login page
-    print("="*60 + '\n' + 'Starting new session: [{}]'.format(red(username)))
-    sess = requests.Session()
-    login_response = requests.get(login_url, allow_redirects=True, verify=False)
+    # one session for everything, so the login connection is reused too
+    sess = make_session(pool_size)
+    login_response = sess.get(login_url, allow_redirects=True, verify=False, timeout=request_timeout())
     galx = login_response.cookies["GALX"]
     gaps = login_response.cookies["GAPS"]
     domain = urlparse(login_response.url).netloc.replace("accounts.", "")
@@ -56,17 +68,18 @@ def authenticate_with_google(username, password, login_url=DEFAULT_LOGIN_URL, au
 
     response = sess.post(auth_url.format(domain=domain),
                         files={"junk" : ""}, data=post_data, cookies=post_cookies,
-                        allow_redirects=True, verify=False)
+                        allow_redirects=True, verify=False, timeout=request_timeout())
 
 
     if response.status_code==200:
-        print("Google login successful: status code [{}]".format(green(response.status_code)))
+        logger.info("Google login successful: status code [{}]".format(response.status_code))
     else:
         raise AuthException("Google login was unsuccessful, " +
                             "status code: {0}".format(response.status_code))
 
     # make a request to the homepage to get the pref and nid cookies
-    cookie_resp = sess.get("https://www.{domain}".format(domain=domain), verify=True, allow_redirects=True)
+    cookie_resp = sess.get("https://www.{domain}".format(domain=domain), verify=True, allow_redirects=True,
+                           timeout=request_timeout())
 
 
     cookies = {"I4SUserLocale" : "en_US"}
@@ -79,8 +92,7 @@ def authenticate_with_google(username, password, login_url=DEFAULT_LOGIN_URL, au
             cookies[key] = cookie_resp.cookies[key]
 
     if "NID" not in cookies or "SID" not in cookies:
-        print(red("=> Warning! Missing essential SID & NID cookies\n") +
-              cyan("=> Trying selenium + phantom.js approach"))
+        logger.warning("Missing essential SID & NID cookies, trying selenium + phantom.js approach")
 
         cookies = phone_verify_for_cookies(username=username, password=password)
 
@@ -109,14 +121,14 @@ def phone_verify_for_cookies(username, password):
     logpath = BASE_DIR + '/phantomjs/{}.log'.format(username)
     driver = webdriver.PhantomJS(service_log_path=logpath)
     login_url = 'https://accounts.google.com/ServiceLogin'
-    print("Loading login page: {}".format(login_url))
+    logger.info("Loading login page: {}".format(login_url))
     driver.get(login_url)
 
     # get login forms & fill in
     email, passwd, signin = map(driver.find_element_by_id, ['Email', 'Passwd', 'signIn'])
     email.send_keys(username)
     passwd.send_keys(password)
-    print(cyan('Authenticating to get SID and NID cookies...'))
+    logger.info('Authenticating to get SID and NID cookies...')
     signin.click() # login
 
     cookies = {}
@@ -124,12 +136,12 @@ def phone_verify_for_cookies(username, password):
         cookies[cookie['name']] = cookie['value']
 
     if "NID" in cookies.keys() and "SID" in cookies.keys():
-        print(green("SID and NID cookies success!"))
+        logger.info("SID and NID cookies success!")
         return cookies
 
 
     try:    # Mobile Verification
-        print("Couldn't verify by Passwd, trying mobile verification")
+        logger.warning("Couldn't verify by Passwd, trying mobile verification")
         driver.find_element_by_id("submitChallenge").click()
         driver.save_screenshot(BASE_DIR + '/phantomjs/pic_{}.png'.format(username))
         time.sleep(1)
@@ -145,11 +157,11 @@ def phone_verify_for_cookies(username, password):
         for cookie in driver.get_cookies():
             cookies[cookie['name']] = cookie['value']
     except:
-        print("Couldn't verify by mobile verification either...")
+        logger.error("Couldn't verify by mobile verification either...")
 
 
     if "NID" in cookies.keys() and "SID" in cookies.keys():
-        print(green("SID and NID cookies success!"))
+        logger.info("SID and NID cookies success!")
         return cookies
     else:
         raise AuthException(red("=> Didn't get the required SID and NID login cookies. Aborting.\n\nAssuming that login details are correct, check that the account is allowed to login from the IP address this script is launched from.\nRemote servers (AWS EC2) will require phone authentication before Google will allow access to the account."))
@@ -208,6 +220,7 @@ class ColoredString(object):
 
     @property
     def color_str(self):
+        import colorama # only needed once something is actually printed
         style = 'BRIGHT' if self.bold else 'NORMAL'
         c = '%s%s%s%s%s' % (getattr(colorama.Fore, self.color), getattr(colorama.Style, style), self.s, colorama.Fore.RESET, getattr(colorama.Style, 'NORMAL'))
 
@@ -3,16 +3,43 @@
 
 
 from sys import version_info
+from runs import RunSeries
 py3 = version_info.major == 3
 
 class AuthException(Exception):
     """ Indicates a failure occurred while logging in"""
     pass
 
-class FormatException(Exception):
+class RequestException(Exception):
+    """ Base for failed requests, keeps the request parameters and raw body
+        so the failure can be written to the dead-letter file. `keywords` is
+        set when the failure happened before the caller had its KeywordData,
+        i.e. on the entitiesQuery lookup. """
+
+    def __init__(self, message, params=None, body=None, keywords=None):
+        super(RequestException, self).__init__(message)
+        self.params = params
+        self.body = body
+        self.keywords = keywords
+
+class FormatException(RequestException):
     """ Indicates that there is some problem with the format of the trends data """
     pass
 
+class TransientException(RequestException):
+    """ Indicates a failure that may succeed if the request is retried
+        (connection errors, timeouts, 5xx and 429 responses) """
+    pass
+
+class CategoryException(ValueError):
+    """ Indicates a category code that is not in categories.txt """
+    pass
+
+class DeadlineException(TransientException):
+    """ Indicates that a keyword ran past its --keyword-deadline; retryable
+        on a later run since journalled windows are kept """
+    pass
+
 class QuotaException(Exception):
     """ Indicates that the quota has been exceeded """
     pass
@@ -24,8 +51,11 @@ class KeywordData(Exception):
         """ Creates some keyword data with the original query """
         self.keyword = keyword
         self.orig_keyword = orig_keyword if orig_keyword else keyword
-        self.interest = []
+        self.interest = RunSeries()     # (date, count) rows, run-length encoded
         self.regional_interest = []
+        self.city_interest = []
+        self.top_queries = []
+        self.rising_queries = []
         # obtained by disambiguation:
         self.title = None
         self.topic = None
@@ -34,12 +64,24 @@ class KeywordData(Exception):
         self.cik = None
         self.filing_date = None
         self.querycounts = None
+        # [date, weekly, merged, daily] rows kept with --ggplot for render.py
+        self.plot_series = None
 
     def add_interest_data(self, date, count):
         self.interest.append((date, count))
 
-    def add_regional_interest(self, date, count):
-        self.regional_interest.append((date, count))
+    def add_regional_interest(self, region, count):
+        self.regional_interest.append((region, count))
+
+    def add_city_interest(self, city, count):
+        self.city_interest.append((city, count))
+
+    def add_related_query(self, query, value, rising=False):
+        # value is 0-100 for top searches, '+250%' or 'Breakout' for rising
+        if rising:
+            self.rising_queries.append((query, value))
+        else:
+            self.top_queries.append((query, value))
 
 
     def __unicode__(self):
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Hedged requests for tail latency.
+
+With --hedge, a trendsReport request that has not answered within the p95 of
+recent request latencies gets a duplicate, and whichever answer arrives
+first is used. Hedges are capped at `max_ratio` of all requests (5% by
+default) because every duplicate spends quota, and no hedging happens until
+`min_samples` latencies have been seen. Duplicates also keep to the --throttle
+spacing: every request sent through the policy waits until `min_interval`
+seconds have passed since the previous one was sent.
+"""
+
+import time, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from metrics import METRICS
+
+HEDGE = None                # HedgePolicy, set by set_hedging()
+DEFAULT_PERCENTILE = 0.95
+DEFAULT_MAX_RATIO = 0.05
+MIN_SAMPLES = 20
+WINDOW = 200                # latencies kept for the percentile
+
+
+
+def set_hedging(enabled, percentile=DEFAULT_PERCENTILE, max_ratio=DEFAULT_MAX_RATIO, min_interval=0):
+    global HEDGE
+    HEDGE = HedgePolicy(percentile, max_ratio, min_interval=min_interval) if enabled else None
+
+
+def hedged(fn):
+    "Calls fn() through the hedging policy if one is set, else directly."
+    return HEDGE.call(fn) if HEDGE else fn()
+
+
+
+class HedgePolicy(object):
+    """ Sends a duplicate of slow calls, within a budget of hedges """
+
+    def __init__(self, percentile=DEFAULT_PERCENTILE, max_ratio=DEFAULT_MAX_RATIO,
+                 min_samples=MIN_SAMPLES, min_interval=0):
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.min_interval = float(min_interval)
+        self.last_sent = 0.0
+        self.latencies = deque(maxlen=WINDOW)
+        self.calls = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(4)
+
+    def threshold(self):
+        "Seconds after which a call is hedged, None while there are too few samples."
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * self.percentile), len(ordered) - 1)]
+
+    def _may_hedge(self):
+        with self.lock:
+            if self.hedges + 1 > self.max_ratio * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def _gap(self):
+        "Seconds until the throttle allows the next request."
+        with self.lock:
+            return self.last_sent + self.min_interval - time.time()
+
+    def _sent(self):
+        with self.lock:
+            self.last_sent = time.time()
+
+    def _timed(self, fn):
+        t0 = time.time()
+        result = fn()
+        with self.lock:
+            self.latencies.append(time.time() - t0)
+        return result
+
+    def call(self, fn):
+        with self.lock:
+            self.calls += 1
+        gap = self._gap()
+        if gap > 0:
+            time.sleep(gap)     # only right after a hedge, --throttle covers the rest
+        self._sent()
+        threshold = self.threshold()
+        if threshold is None:
+            return self._timed(fn)
+
+        first = self.pool.submit(self._timed, fn)
+        done, _ = wait([first], timeout=threshold)
+        if not done and self._gap() > 0:
+            # the duplicate goes through the same throttle as every request
+            done, _ = wait([first], timeout=self._gap())
+        if done or not self._may_hedge():
+            return first.result()
+
+        METRICS.inc("hedged_requests_total")
+        self._sent()
+        second = self.pool.submit(fn)
+        pending = set([first, second])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        METRICS.inc("hedge_wins_total")
+                    return future.result()
+        return first.result()   # both failed: raise the original error
@@ -1,13 +1,12 @@
 
 import arrow
-try:
-	from IPython import embed
-except:
-	pass
+from profiling import timed_function
+from google_class import FormatException
 
 
 
 
+@timed_function
 def interpolate_ioi(dates, IoT):
     """ takes a list of dates and interest-over-time and
     interpolates IoT between the dates. Called by change_in_ioi()"""
@@ -86,6 +85,7 @@ def interpolate_ioi(dates, IoT):
 
 
 
+@timed_function
 def conform_interest_over_time(IoI):
     """ Removes 0's from a list of IoI to calculate percentage changes.
     Called by change_in_ioi(). """
@@ -127,6 +127,7 @@ def conform_interest_over_time(IoI):
 
 
 
+@timed_function
 def change_in_ioi(dates, IoT):
     """Computes changes in interest over time (IoT) (log base 10).
 
@@ -152,8 +153,62 @@ def change_in_ioi(dates, IoT):
         try:
             delta_IoT.append(1+log10(1+relative_effect))
         except ValueError:
-            from IPython import embed; embed()
+            raise FormatException("Cannot compute change in IoI from {0} to {1}".format(f1, f2),
+                                  body=list(zip(dates, IoT)))
 
     return dates_new, delta_IoT
 
 
+
+
+
+
+
+
+@timed_function
+def stitch_overlap(all_data):
+    """Chains overlapping query windows onto one scale, without an anchor query.
+
+    all_data -- list of windows, each a list of [date, IoT] rows where every
+                window overlaps the previous one by a few days
+    Each window is interpolated to daily values and multiplied by the ratio of
+    the already stitched series to the window over their common days, then the
+    whole series is rescaled so its peak is 100. When either side of the
+    overlap is all zeros (e.g. next to a missing quarter) there is no ratio:
+    the window starts a new chain on its own scale, and its first date is
+    returned in `restarts`.
+    Raises FormatException if a window shares no days with the series so far.
+    Returns (list of [date, IoT] rows, list of restart dates)."""
+
+    stitched = {}
+    dates = []
+    restarts = []
+    ratio = 1.0
+    for window in all_data:
+        window = [x for x in window if x[1] != '']
+        if len(window) < 2:
+            continue
+        wdates, wioi = interpolate_ioi(*zip(*window))
+        common = [d for d in wdates if d in stitched]
+        if stitched and not common:
+            raise FormatException("Window from {0} does not overlap the series before it".format(
+                wdates[0].date()))
+        prev_sum = sum(stitched[d] for d in common)
+        curr_sum = sum(float(i) for d, i in zip(wdates, wioi) if d in stitched)
+        if prev_sum > 0 and curr_sum > 0:
+            ratio = prev_sum / curr_sum
+        elif any(float(i) for i in wioi) and any(stitched.values()):
+            # nothing to scale by, and both chains have data
+            ratio = 1.0
+            restarts.append(wdates[0])
+        # otherwise one chain is all zeros and any ratio keeps it at zero
+
+        for date, ioi in zip(wdates, wioi):
+            if date not in stitched:
+                stitched[date] = float(ioi) * ratio
+                dates.append(date)
+
+    peak = max(stitched.values()) if stitched else 0
+    scale = 100.0 / peak if peak > 0 else 1.0
+    rows = [[str(date.date()), round(stitched[date] * scale, 2)] for date in sorted(dates)]
+    return rows, restarts
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Per-window checkpoint journal for quarterly_queries().
+
+Every completed query window is appended to a JSON lines file as
+(topic, category, window start, window end) -> (rows, label), where label is
+the window's missing_queries entry ('daily', 'weekly', 'missing' or
+'overall' for the long-term anchor query). When a keyword is interrupted,
+e.g. by a QuotaException on its seventh window, the next run replays the
+journalled windows and only requests the ones still missing.
+
+With a path of None, windows are only kept in memory for the current run.
+
+Later entries for the same key win, which is how a window trimmed by the
+weekly realignment of the following window gets updated. Windows padded with
+zeros are RunSeries and are stored as their runs.
+"""
+
+import os, json
+import arrow
+
+from metrics import METRICS
+from runs import RunSeries
+
+ARROW_TAG = "@"     # dates stored as Arrow objects (padded zero windows)
+
+
+
+def _day(date):
+    return arrow.get(date).format("YYYY-MM-DD")
+
+
+def _encode_row(row):
+    date, value = row[0], row[1]
+    if hasattr(date, "isoformat"):
+        date = ARROW_TAG + date.isoformat()
+    return [date, value]
+
+
+def _decode_row(row):
+    date, value = row
+    if isinstance(date, str) and date.startswith(ARROW_TAG):
+        date = arrow.get(date[len(ARROW_TAG):])
+    return [date, value]
+
+
+def _encode(entry, rows):
+    "Stores rows, or the runs of a RunSeries, in a journal entry."
+    if isinstance(rows, RunSeries):
+        entry["runs"] = [_encode_row([start, value]) + [days] for start, days, value in rows.runs]
+    else:
+        entry["rows"] = [_encode_row(r) for r in rows]
+    return entry
+
+
+def _decode(entry):
+    if "runs" in entry:
+        runs = [_decode_row(r[:2]) + r[2:] for r in entry["runs"]]
+        return RunSeries([start, days, value] for start, value, days in runs)
+    return [_decode_row(r) for r in entry["rows"]]
+
+
+def _copy(rows):
+    if isinstance(rows, RunSeries):
+        return RunSeries(list(r) for r in rows.runs)
+    return [list(r) for r in rows]
+
+
+
+
+class WindowJournal(object):
+    """ Append-only store of completed query windows """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.sections = {}      # key -> extra response sections (overall query)
+        if path is None:
+            return
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        if os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def key(topic, category, start, end):
+        return (topic, category or "", _day(start), _day(end))
+
+    def _load(self):
+        lines = 0
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # torn final line from a killed process
+                lines += 1
+                key = tuple(entry["key"])
+                self.entries[key] = (_decode(entry), entry["label"])
+                if entry.get("extras"):
+                    self.sections[key] = entry["extras"]
+        if lines > 2 * len(self.entries):
+            self.compact()
+
+    def get(self, topic, category, start, end):
+        "Returns (rows, label) for a journalled window, or None."
+        entry = self.entries.get(self.key(topic, category, start, end))
+        METRICS.cache("window_journal", entry is not None)
+        if entry is None:
+            return None
+        rows, label = entry
+        return _copy(rows), label
+
+    def extras(self, topic, category, start, end):
+        "Related/regional sections journalled with a window, or None."
+        return self.sections.get(self.key(topic, category, start, end))
+
+    def put(self, topic, category, start, end, rows, label, extras=None):
+        key = self.key(topic, category, start, end)
+        entry = _encode({"key": key, "label": label}, rows)
+        if extras:
+            entry["extras"] = extras
+            self.sections[key] = extras
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        self.entries[key] = (_decode(entry), label)
+
+    def compact(self):
+        "Rewrites the journal keeping only the latest entry per window."
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for key, (rows, label) in self.entries.items():
+                entry = _encode({"key": key, "label": label}, rows)
+                if key in self.sections:
+                    entry["extras"] = self.sections[key]
+                f.write(json.dumps(entry) + "\n")
+        os.rename(tmp, self.path)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Logging setup for the command line tools.
+
+Modules log through `logging.getLogger(__name__)`; nothing is printed to
+stdout except data. setup_logging() sends records through a queue to a
+listener thread that writes them to stderr or a file, so a slow terminal or
+a Dropbox-synced log file never holds up the query loop.
+
+Levels used: DEBUG for parsing details, INFO for per-keyword and per-window
+progress, WARNING for retries, skipped keywords and budget stops, ERROR for
+failures that end the run.
+"""
+
+import sys, atexit, logging
+import logging.handlers
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_listener = None
+
+
+
+def setup_logging(level="INFO", path=None, quiet=False):
+    """ Configures the root logger once per process.
+
+        level -- name or number of the lowest level to write
+        path -- log file to append to, stderr if None
+        quiet -- only warnings and errors, whatever `level` says
+    """
+    global _listener
+    if isinstance(level, str):
+        level = getattr(logging, level.upper(), logging.INFO)
+    if quiet:
+        level = max(level, logging.WARNING)
+
+    if path:
+        handler = logging.FileHandler(path)
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.setLevel(level)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    if hasattr(logging.handlers, "QueueHandler"):
+        queue = Queue(-1)
+        root.addHandler(logging.handlers.QueueHandler(queue))
+        _listener = logging.handlers.QueueListener(queue, handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_stop)
+    else:
+        root.addHandler(handler) # Python 2: no queue handlers, write directly
+    # chatty third party loggers
+    logging.getLogger("urllib3").setLevel(max(level, logging.WARNING))
+    logging.getLogger("requests").setLevel(max(level, logging.WARNING))
+
+
+def _stop():
+    "Flushes queued records at exit."
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+In-memory results: a keyword x day matrix instead of CSV files.
+
+    from matrix import trends_matrix
+    m = trends_matrix(keywords, username=..., password=..., quarterly="2014-06")
+    m.keywords[0]["title"], m.dates[0], m.value(0, 0)
+
+    import numpy as np
+    values, mask = m.to_numpy()     # zero-copy views of m.values / m.mask
+
+Values are float64 in row-major order (one row per keyword, one column per
+day from the first to the last date of the batch); mask is 1 where a keyword
+has data for that day and 0 (value NaN) where it does not. Both are
+array.array buffers, so they can be shared with numpy or anything else that
+speaks the buffer protocol without copying; numpy itself is optional.
+"""
+
+from array import array
+from datetime import timedelta
+
+MISSING = float("nan")
+# per-keyword metadata: (key, KeywordData attribute); topic is the entity mid
+METADATA = (("keyword", "keyword"), ("orig_keyword", "orig_keyword"), ("mid", "topic"),
+            ("title", "title"), ("desc", "desc"), ("cik", "cik"),
+            ("filing_date", "filing_date"), ("querycounts", "querycounts"))
+
+
+
+def _day(date):
+    "datetime.date for dates, datetimes and Arrow objects."
+    return date.date() if hasattr(date, "date") else date
+
+
+def _count(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None # '' for blank rows of an incomplete period
+
+
+
+class TrendsMatrix(object):
+    """ Keyword x day interest matrix with a missing-day mask """
+
+    def __init__(self, keywords, dates, values, mask):
+        self.keywords = keywords    # per-row metadata dicts, see METADATA
+        self.dates = dates          # datetime.date per column
+        self.values = values        # array('d'), len(keywords) * len(dates)
+        self.mask = mask            # array('B'), 1 = observed
+
+    @classmethod
+    def from_keywords(cls, keyword_data):
+        "Builds the matrix from KeywordData objects, e.g. the output of get_trends()."
+        keyword_data = list(keyword_data)
+        # filled run by run, see runs.py
+        series = [[(_day(d), n, _count(c)) for d, n, c in kw.interest.runs] for kw in keyword_data]
+        if any(series):
+            first = min(d for s in series for d, n, c in s)
+            last = max(d + timedelta(days=n - 1) for s in series for d, n, c in s)
+            dates = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+        else:
+            dates = []
+
+        ncols = len(dates)
+        values = array("d", [MISSING]) * (len(series) * ncols)
+        mask = array("B", [0]) * (len(series) * ncols)
+        for row, s in enumerate(series):
+            offset = row * ncols
+            for d, n, c in s:
+                if c is None:
+                    continue
+                col = offset + (d - dates[0]).days
+                values[col:col + n] = array("d", [c]) * n
+                mask[col:col + n] = array("B", [1]) * n
+
+        keywords = [dict((key, getattr(kw, name, None)) for key, name in METADATA)
+                    for kw in keyword_data]
+        return cls(keywords, dates, values, mask)
+
+    @property
+    def shape(self):
+        return (len(self.keywords), len(self.dates))
+
+    def value(self, row, col):
+        "Interest of keyword `row` on day `col`, or None if missing."
+        i = row * len(self.dates) + col
+        return self.values[i] if self.mask[i] else None
+
+    def row(self, row):
+        "[(date, interest or None)] for one keyword."
+        return [(d, self.value(row, col)) for col, d in enumerate(self.dates)]
+
+    def buffers(self):
+        """ 2-D memoryviews of (values, mask), shaped (keywords, days).
+            No copies are made. """
+        rows, cols = self.shape
+        if not rows * cols:
+            return memoryview(self.values), memoryview(self.mask)
+        return (memoryview(self.values).cast("B").cast("d", [rows, cols]),
+                memoryview(self.mask).cast("B", [rows, cols]))
+
+    def to_numpy(self):
+        """ (values, mask) as numpy arrays sharing memory with this matrix:
+            float64 (keywords, days) and bool (keywords, days). """
+        import numpy as np
+        shape = self.shape
+        values = np.frombuffer(self.values, dtype=np.float64).reshape(shape)
+        mask = np.frombuffer(self.mask, dtype=np.uint8).reshape(shape).view(np.bool_)
+        return values, mask
+
+    def __array__(self, dtype=None):
+        values = self.to_numpy()[0]
+        return values if dtype is None else values.astype(dtype)
+
+
+
+def trends_matrix(keyword_gen, **kwargs):
+    """ Runs get_trends() (same arguments) and returns the whole batch as a
+        TrendsMatrix, without writing or parsing any CSV. """
+    from trends import get_trends
+    return TrendsMatrix.from_keywords(get_trends(keyword_gen, **kwargs))
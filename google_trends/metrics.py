@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Per-stage timing and quota instrumentation.
+
+A single process-wide registry (METRICS) collects counters and latency
+histograms labelled by stage and account. It can be flushed periodically to
+a JSON file and/or served in Prometheus text format on a local port:
+
+    python3 trends.py ... --metrics-file metrics.json --metrics-port 9464
+"""
+
+import os, json, time, atexit, threading
+from contextlib import contextmanager
+
+PREFIX = "gtrends_"
+# latency buckets in seconds, throttle sleeps and login can take a while
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DEFAULT_FLUSH_INTERVAL = 30
+
+
+
+class Histogram(object):
+    """ Cumulative latency histogram with fixed buckets """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def as_dict(self):
+        cumulative, running = [], 0
+        for bound, n in zip(list(self.buckets) + ["+Inf"], self.counts):
+            running += n
+            cumulative.append([bound, running])
+        return {"buckets": cumulative, "sum": round(self.sum, 6), "count": self.count}
+
+
+
+class Metrics(object):
+    """ Thread-safe registry of counters and histograms.
+
+        Label values are passed as keyword arguments; `account` defaults to
+        the account currently set with set_account().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.account = "anonymous"
+        self.started = time.time()
+
+    def set_account(self, account):
+        self.account = account or "anonymous"
+
+    def _key(self, name, labels):
+        labels.setdefault("account", self.account)
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        "Overwrites a counter maintained elsewhere (e.g. urllib3 pool counts)."
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timed(self, stage, **labels):
+        "Records the wall-clock time of the enclosed block under `stage`."
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.time() - t0, stage=stage, **labels)
+
+    def total(self, name):
+        "Sum of a counter across all of its labels."
+        with self.lock:
+            return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    def cache(self, cache, hit):
+        "Counts a cache lookup, hit rates are derived from these."
+        self.inc("cache_hits_total" if hit else "cache_misses_total", cache=cache)
+
+    def snapshot(self):
+        with self.lock:
+            counters = [{"name": n, "labels": dict(l), "value": v}
+                        for (n, l), v in sorted(self.counters.items())]
+            histograms = [dict({"name": n, "labels": dict(l)}, **h.as_dict())
+                          for (n, l), h in sorted(self.histograms.items())]
+
+        hits, misses = {}, {}
+        for c in counters:
+            cache = c["labels"].get("cache")
+            if c["name"] == "cache_hits_total":
+                hits[cache] = hits.get(cache, 0) + c["value"]
+            elif c["name"] == "cache_misses_total":
+                misses[cache] = misses.get(cache, 0) + c["value"]
+        hit_rates = {cache: round(float(hits.get(cache, 0)) /
+                                  (hits.get(cache, 0) + misses.get(cache, 0)), 4)
+                     for cache in set(hits) | set(misses)}
+
+        return {"timestamp": time.time(),
+                "uptime_seconds": round(time.time() - self.started, 3),
+                "counters": counters,
+                "histograms": histograms,
+                "cache_hit_rates": hit_rates}
+
+    def prometheus(self):
+        "Renders the registry in the Prometheus text exposition format."
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join('{0}="{1}"'.format(
+                k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+        lines, typed = [], set()
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append("# TYPE {0}{1} counter".format(PREFIX, name))
+                    typed.add(name)
+                lines.append("{0}{1}{2} {3}".format(PREFIX, name, fmt_labels(labels), value))
+
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append("# TYPE {0}{1} histogram".format(PREFIX, name))
+                    typed.add(name)
+                for bound, n in hist.as_dict()["buckets"]:
+                    lines.append("{0}{1}_bucket{2} {3}".format(
+                        PREFIX, name, fmt_labels(labels, [("le", bound)]), n))
+                lines.append("{0}{1}_sum{2} {3}".format(PREFIX, name, fmt_labels(labels), hist.sum))
+                lines.append("{0}{1}_count{2} {3}".format(PREFIX, name, fmt_labels(labels), hist.count))
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        "Writes a snapshot atomically so readers never see a partial file."
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.rename(tmp, path)
+
+
+METRICS = Metrics()
+
+
+
+
+def start_json_flusher(path, interval=DEFAULT_FLUSH_INTERVAL, metrics=METRICS):
+    """ Flushes a JSON snapshot to `path` every `interval` seconds from a
+        daemon thread, and once more at interpreter exit. """
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    stop = threading.Event()
+
+    def flush_loop():
+        while not stop.wait(interval):
+            metrics.write_json(path)
+
+    def final_flush():
+        stop.set()
+        metrics.write_json(path)
+
+    thread = threading.Thread(target=flush_loop, name="metrics-flusher")
+    thread.daemon = True
+    thread.start()
+    atexit.register(final_flush)
+    return thread
+
+
+def start_http_server(port, host="127.0.0.1", metrics=METRICS):
+    """ Serves /metrics (Prometheus text) and /metrics.json on a local port """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/metrics.json"):
+                body = json.dumps(metrics.snapshot()).encode("utf-8")
+                content_type = "application/json"
+            elif self.path.startswith("/metrics"):
+                body = metrics.prometheus().encode("utf-8")
+                content_type = "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass # keep scrapes out of the progress output
+
+    server = HTTPServer((host, int(port)), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http")
+    thread.daemon = True
+    thread.start()
+    return server
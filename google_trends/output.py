@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Output writers for trends.py results.
+
+--output-format jsonl writes one self-describing JSON record per keyword
+instead of a CSV block, flushed as soon as the keyword is done, so a
+downstream consumer can read results from a pipe while the batch runs:
+
+    python3 trends.py ... --output-format jsonl | ingest
+
+CSV files are written by AtomicWriter: each file goes to a temp file and is
+renamed into place, then recorded with its checksum in a manifest
+(.complete.jsonl). fsync is batched: every `fsync_every` files the data
+files, the directory and then the manifest are synced, so a manifest entry
+is only durable once its file is. At startup scan() renames files that are
+missing from the manifest or fail their checksum to <name>.incomplete, and
+their keywords are queried again.
+
+Several workers may share an output directory. Every AtomicWriter holds a
+shared flock on .writers.lock for as long as it is open, and scan() only
+cleans up when it can take that lock exclusively, i.e. when no other writer
+has files in flight there.
+"""
+
+import os, io, json, time, hashlib, logging, threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # no advisory locks (Windows): scan() assumes it is alone
+
+from metrics import METRICS
+
+JSONL_FILENAME = "results.jsonl"
+JSONL_BUFFER = 1 << 16      # bytes buffered between per-record flushes
+MANIFEST = ".complete.jsonl"
+LOCK_FILE = ".writers.lock"
+DEFAULT_FSYNC_EVERY = 20    # files per fsync batch
+DEFAULT_FSYNC_INTERVAL = 30 # seconds a written file may wait for its batch
+logger = logging.getLogger(__name__)
+
+
+
+def _iso(date):
+    if hasattr(date, "date"):   # datetime, Arrow
+        date = date.date()
+    return date.isoformat() if hasattr(date, "isoformat") else str(date)
+
+
+def _value(count):
+    try:
+        return float(count)
+    except (TypeError, ValueError):
+        return None
+
+
+def record_id(kw):
+    "Identifies a keyword's record, like the CSV filename: cik, else the keyword."
+    return kw.cik if kw.cik is not None else kw.orig_keyword
+
+
+def keyword_record(kw, category=None, sparse=False):
+    """ JSON-serialisable record of one KeywordData. With `sparse`, the series
+        is a list of [first date, days, value] runs instead of dates/values. """
+    record = {
+        "id": record_id(kw),
+        "keyword": kw.orig_keyword,
+        "mid": kw.topic,
+        "title": kw.title,
+        "desc": kw.desc,
+        "cik": kw.cik,
+        "filing_date": kw.filing_date,
+        "category": category,
+        "querycounts": [[_iso(d), label] for d, label in (kw.querycounts or [])],
+    }
+    if sparse:
+        record["runs"] = [[_iso(d), n, _value(c)] for d, n, c in kw.interest.runs]
+    else:
+        record["dates"] = [_iso(d) for d, c in kw.interest]
+        record["values"] = [_value(c) for d, c in kw.interest]
+    for name in ("regional_interest", "city_interest", "top_queries", "rising_queries"):
+        rows = getattr(kw, name, None)
+        if rows:
+            record[name] = [list(r) for r in rows]
+    return record
+
+
+
+class JsonlWriter(object):
+    """ Writes one JSON record per line to a stream, flushing after every
+        record. Buffering in between is bounded by the stream's buffer. """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    @classmethod
+    def open(cls, path):
+        "Appends to `path` with a JSONL_BUFFER sized buffer."
+        torn = False
+        if os.path.exists(path) and os.path.getsize(path):
+            with io.open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+        writer = cls(io.open(path, "a", buffering=JSONL_BUFFER, encoding="utf-8"))
+        if torn:
+            writer.stream.write(u"\n") # keep a killed run's partial line on its own
+        return writer
+
+    def write(self, record):
+        line = json.dumps(record, default=str, separators=(",", ":"), ensure_ascii=False)
+        self.stream.write(line + u"\n")
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+
+def jsonl_done(path):
+    "Ids of the records already in a JSONL results file, for resuming."
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with io.open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                continue # torn final line from a killed process
+    return done
+
+
+
+
+def checksum(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _tmp_path(path):
+    dirname, name = os.path.split(path)
+    return os.path.join(dirname, "." + name + ".tmp")
+
+
+def atomic_write(path, text):
+    "Writes `text` through a temp file and a rename, so `path` is never partial."
+    tmp = _tmp_path(path)
+    with io.open(tmp, "w", encoding="utf-8", newline="") as f:
+        f.write(text)
+    os.rename(tmp, path)
+
+
+def _fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass # directories can't be fsynced on some platforms
+    finally:
+        os.close(fd)
+
+
+
+class AtomicWriter(object):
+    """ Crash-safe writer of output files into one directory.
+
+        write() puts a file in place atomically; sync() makes the batch
+        durable and records it in the manifest. Call close() at exit, which
+        also lets other workers' scan() clean up the directory again. """
+
+    def __init__(self, output_dir, fsync_every=DEFAULT_FSYNC_EVERY,
+                 fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        self.output_dir = output_dir
+        self.manifest_path = os.path.join(output_dir, MANIFEST)
+        self.fsync_every = max(int(fsync_every), 1)
+        self.fsync_interval = fsync_interval
+        self.pending = []           # (filename, sha1, bytes) not yet synced
+        self.oldest = None
+        self.lock = threading.Lock()
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.dir_lock = _lock_dir(output_dir, exclusive=False)
+
+    def write(self, filename, text):
+        data = text.encode("utf-8")
+        path = os.path.join(self.output_dir, filename)
+        tmp = _tmp_path(path)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.rename(tmp, path)
+        METRICS.inc("bytes_written_total", len(data))
+        with self.lock:
+            self.pending.append((filename, checksum(data), len(data)))
+            self.oldest = self.oldest or time.time()
+            due = (len(self.pending) >= self.fsync_every or
+                   time.time() - self.oldest >= self.fsync_interval)
+        if due:
+            self.sync()
+
+    def sync(self):
+        with self.lock:
+            pending, self.pending, self.oldest = self.pending, [], None
+        if not pending:
+            return
+        with METRICS.timed("fsync"):
+            for filename, _, _ in pending:
+                _fsync_path(os.path.join(self.output_dir, filename))
+            _fsync_path(self.output_dir) # the renames
+            _append_manifest(self.manifest_path, pending)
+        METRICS.inc("fsync_batches_total")
+
+    def close(self):
+        self.sync()
+        if self.dir_lock is not None:
+            self.dir_lock.close()
+            self.dir_lock = None
+
+
+def _lock_dir(output_dir, exclusive):
+    """ Opens and flock()s the directory's LOCK_FILE: shared for writers,
+        waiting for a scan to finish, or exclusive without waiting for scan().
+        Returns the open file to close as the unlock, or None if locks are
+        unavailable or an exclusive lock could not be had. """
+    if fcntl is None:
+        return None
+    f = open(os.path.join(output_dir, LOCK_FILE), "a")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive else fcntl.LOCK_SH)
+    except (IOError, OSError):
+        f.close()
+        return None
+    return f
+
+
+def _append_manifest(path, entries):
+    with open(path, "a") as f:
+        for filename, sha1, size in entries:
+            f.write(json.dumps({"file": filename, "sha1": sha1, "bytes": size}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_manifest(path):
+    entries = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # torn final line
+                entries[entry["file"]] = entry["sha1"]
+    return entries
+
+
+def _looks_complete(data):
+    "Pre-manifest CSV outputs: header, at least one row and a final newline."
+    return data.startswith(b"Date,") and data.endswith(b"\n") and data.count(b"\n") >= 2
+
+
+def scan(output_dir, suffix=".csv", skip=()):
+    """ Startup check of an output directory. Returns the names of complete
+        outputs. Files that are not in the manifest or fail their checksum are
+        renamed to <name>.incomplete so their keywords are queried again, and
+        leftover temp files are removed. Directories written before the
+        manifest existed are adopted if their files look complete.
+
+        While another worker's AtomicWriter is open on the directory, its
+        temp files and not yet manifested outputs are left alone: unmanifested
+        files are then neither renamed nor returned as complete.
+
+        skip -- names of files in the directory that are not keyword outputs,
+                e.g. the event window table; they are left alone """
+    if not os.path.isdir(output_dir):
+        return set()
+    lock = _lock_dir(output_dir, exclusive=True)
+    alone = lock is not None or fcntl is None
+    if not alone:
+        logger.info("Other workers are writing to {0}, leaving their files alone".format(output_dir))
+    try:
+        return _scan(output_dir, suffix, skip, alone)
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+def _scan(output_dir, suffix, skip, alone):
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    manifest = _read_manifest(manifest_path)
+    legacy = not os.path.exists(manifest_path)
+
+    complete, adopted = set(), []
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        if name.startswith(".") and name.endswith(".tmp"):
+            if alone:
+                os.remove(path)
+            continue
+        if not name.endswith(suffix) or name in skip or not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        if manifest.get(name) == checksum(data):
+            complete.add(name)
+        elif legacy and alone and _looks_complete(data):
+            complete.add(name)
+            adopted.append((name, checksum(data), len(data)))
+        elif alone:
+            os.rename(path, path + ".incomplete")
+            METRICS.inc("outputs_requeued_total")
+            logger.warning("Incomplete output {0}, its keyword will be queried again".format(name))
+
+    if adopted:
+        _append_manifest(manifest_path, adopted)
+    return complete
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Opt-in profiling hooks.
+
+--profile N       cProfile each keyword's trip through get_trends() and keep
+                  the N slowest, written to --profile-dir with an index.json
+                  (keyword, mid, category, request count, seconds).
+--function-times  Lightweight mode: only wall-clock time per hot function
+                  (functions decorated with @timed_function), cheap enough
+                  to leave on for whole batches.
+"""
+
+import os, re, json, time, heapq, atexit, threading
+from functools import wraps
+
+from metrics import METRICS
+
+DEFAULT_PROFILE_DIR = "profiles"
+FUNCTION_TIMES = {}     # function name -> [calls, total seconds, max seconds]
+_lock = threading.Lock()
+_enabled = False
+
+
+
+def timed_function(fn):
+    """ Records calls and wall-clock time of `fn` when function timing is
+        enabled, otherwise costs a single flag check per call. """
+    name = fn.__name__
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return fn(*args, **kwargs)
+        t0 = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.time() - t0
+            with _lock:
+                stats = FUNCTION_TIMES.setdefault(name, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+    return wrapper
+
+
+def enable_function_times(path=None):
+    """ Turns on @timed_function recording. If `path` is given the timings
+        are written there as JSON when the interpreter exits. """
+    global _enabled
+    _enabled = True
+    if path:
+        atexit.register(write_function_times, path)
+
+
+def function_times():
+    "Returns {function: {calls, total_seconds, mean_seconds, max_seconds}}."
+    with _lock:
+        return {name: {"calls": n,
+                       "total_seconds": round(total, 6),
+                       "mean_seconds": round(total / n, 6) if n else 0,
+                       "max_seconds": round(peak, 6)}
+                for name, (n, total, peak) in FUNCTION_TIMES.items()}
+
+
+def write_function_times(path):
+    with open(path, "w") as f:
+        json.dump(function_times(), f, indent=2, sort_keys=True)
+
+
+
+
+class KeywordProfiler(object):
+    """ Profiles one keyword at a time and keeps the `keep` slowest.
+
+        Usage, for each keyword:
+            profiler.start()
+            ... disambiguate, query, merge ...
+            profiler.stop(keywords, category)
+    """
+
+    def __init__(self, keep=10, output_dir=DEFAULT_PROFILE_DIR):
+        self.keep = int(keep)
+        self.output_dir = output_dir
+        self.slowest = []       # min-heap of (seconds, seq, record)
+        self.seq = 0
+        self._profile = None
+
+    def start(self):
+        import cProfile # only with --profile
+        self._profile = cProfile.Profile()
+        self._requests = METRICS.total("requests_total")
+        self._t0 = time.time()
+        self._profile.enable()
+
+    def cancel(self):
+        if self._profile:
+            self._profile.disable()
+        self._profile = None
+
+    def stop(self, keywords, category=None):
+        if not self._profile:
+            return
+        self._profile.disable()
+        seconds = time.time() - self._t0
+        record = {"keyword": keywords[0].keyword,
+                  "mid": keywords[0].topic,
+                  "title": keywords[0].title,
+                  "cik": keywords[0].cik,
+                  "category": category,
+                  "requests": METRICS.total("requests_total") - self._requests,
+                  "seconds": round(seconds, 3)}
+
+        self.seq += 1
+        entry = (seconds, self.seq, record, self._profile)
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, entry)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+        self._profile = None
+
+    def write(self):
+        "Dumps the kept profiles (.prof + readable .txt) and an index.json."
+        if not self.slowest:
+            return
+        import pstats
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        index = []
+        ranked = sorted(self.slowest, key=lambda e: e[0], reverse=True)
+        for rank, (seconds, _, record, profile) in enumerate(ranked, 1):
+            slug = re.sub(r'[^\w.-]+', '_', record["keyword"])[:60]
+            base = os.path.join(self.output_dir, "{0:03d}_{1}".format(rank, slug))
+            profile.dump_stats(base + ".prof")
+            with open(base + ".txt", "w") as f:
+                stats = pstats.Stats(profile, stream=f)
+                stats.sort_stats("cumulative").print_stats(40)
+            index.append(dict(record, rank=rank, profile=os.path.basename(base) + ".prof"))
+
+        with open(os.path.join(self.output_dir, "index.json"), "w") as f:
+            json.dump(index, f, indent=2)
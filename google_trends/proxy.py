@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Local caching proxy shared by all trends.py workers on a host.
+
+Start one daemon per box, then point every worker at it:
+
+    python3 proxy.py --port 8765 --cache-dir ~/.gtrends_cache --min-interval 2
+    python3 trends.py ... --proxy http://127.0.0.1:8765
+
+Workers send their entitiesQuery and trendsReport GETs to /fetch?url=<upstream>
+along with their own cookies. The daemon
+  - serves repeated requests from its cache (memory, plus --cache-dir on disk)
+    for --ttl seconds,
+  - coalesces identical in-flight requests so only one goes upstream,
+  - spaces upstream requests host-wide by --min-interval seconds,
+so N workers cost the quota of one set of unique requests.
+"""
+
+import os, sys, json, time, hashlib, argparse, threading, logging
+
+from log import setup_logging
+from retry import request_timeout
+
+PY3 = sys.version_info[0] == 3
+if PY3:
+    from urllib.parse import urlencode, urlparse, parse_qs
+else:
+    from urllib import urlencode
+    from urlparse import urlparse, parse_qs
+
+DEFAULT_PORT = 8765
+DEFAULT_MIN_INTERVAL = 1.0
+DEFAULT_TTL = 24 * 3600     # seconds a cached response is served; the last weeks of data still change
+PROXY_URL = None    # set in workers by set_proxy()
+logger = logging.getLogger(__name__)
+
+
+
+###################################################
+#### Worker side
+
+def set_proxy(url):
+    "Routes subsequent route() calls through the proxy at `url` (None disables)."
+    global PROXY_URL
+    PROXY_URL = url.rstrip("/") if url else None
+
+
+def route(url, params):
+    """ Returns the (url, params) to request: unchanged without a proxy,
+        otherwise the proxy's /fetch endpoint wrapping the upstream URL. """
+    if not PROXY_URL:
+        return url, params
+    upstream = url + "?" + urlencode(sorted((params or {}).items()))
+    return PROXY_URL + "/fetch", {"url": upstream}
+
+
+
+###################################################
+#### Daemon side
+
+class RateLimiter(object):
+    """ Spaces calls at least `min_interval` seconds apart across threads """
+
+    def __init__(self, min_interval):
+        self.min_interval = float(min_interval)
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+
+class ResponseCache(object):
+    """ In-memory cache of upstream bodies, optionally persisted to a
+        directory (one JSON file per request) so restarts stay warm.
+        Entries older than `ttl` seconds are fetched again (0: never). """
+
+    def __init__(self, cache_dir=None, ttl=DEFAULT_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = float(ttl)
+        self.memory = {}
+        self.lock = threading.Lock()
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def expired(self, entry):
+        return self.ttl > 0 and time.time() - entry.get("fetched", 0) > self.ttl
+
+    def get(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+        if entry is None and self.cache_dir and os.path.exists(self._path(key)):
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+            with self.lock:
+                self.memory[key] = entry
+        if entry is not None and self.expired(entry):
+            with self.lock:
+                self.memory.pop(key, None)
+            return None
+        return entry
+
+    def put(self, key, entry):
+        entry = dict(entry, fetched=time.time())
+        with self.lock:
+            self.memory[key] = entry
+        if self.cache_dir:
+            tmp = self._path(key) + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(entry, f)
+            os.rename(tmp, self._path(key))
+
+
+def cacheable(entry):
+    "Only successful data responses are cached, never quota or error pages."
+    return entry["status"] == 200 and "text/html" not in entry["content_type"]
+
+
+
+class CachingProxy(object):
+    """ Fetches upstream URLs with caching, single-flight and rate limiting """
+
+    def __init__(self, cache_dir=None, min_interval=DEFAULT_MIN_INTERVAL, pool_size=4, ttl=DEFAULT_TTL):
+        from transport import make_session
+        self.session = make_session(pool_size)
+        self.cache = ResponseCache(cache_dir, ttl)
+        self.limiter = RateLimiter(min_interval)
+        self.inflight = {}      # key -> (Event, result holder)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "upstream": 0}
+
+    def fetch(self, url, cookie_header=None):
+        """ Returns (entry, how) where entry is {status, content_type, body}
+            and how is 'HIT', 'MISS' or 'COALESCED'. """
+        key = url
+        entry = self.cache.get(key)
+        if entry is not None:
+            self._count("hits")
+            return entry, "HIT"
+
+        with self.lock:
+            if key in self.inflight:
+                event, holder = self.inflight[key]
+                leader = False
+            else:
+                event, holder = threading.Event(), {}
+                self.inflight[key] = (event, holder)
+                leader = True
+
+        if not leader:
+            event.wait()
+            self._count("coalesced")
+            if "error" in holder:
+                raise holder["error"]
+            return holder["entry"], "COALESCED"
+
+        try:
+            self.limiter.wait()
+            self._count("upstream")
+            headers = {"Cookie": cookie_header} if cookie_header else {}
+            response = self.session.get(url, headers=headers, allow_redirects=True,
+                                        timeout=request_timeout())
+            entry = {"status": response.status_code,
+                     "content_type": response.headers.get("content-type", ""),
+                     "body": response.text}
+            if cacheable(entry):
+                self.cache.put(key, entry)
+            holder["entry"] = entry
+            self._count("misses")
+            return entry, "MISS"
+        except Exception as e:
+            holder["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            event.set()
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+
+
+def http_server_classes():
+    """ (ThreadingHTTPServer, BaseHTTPRequestHandler) for the daemons here and
+        in coordinator.py; workers only route() and never import http.server. """
+    if PY3:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    else:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    return ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def make_handler(proxy):
+    BaseHTTPRequestHandler = http_server_classes()[1]
+
+    class ProxyHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            if parsed.path == "/stats":
+                return self._send(200, "application/json", json.dumps(proxy.stats))
+            if parsed.path != "/fetch":
+                return self._send(404, "text/plain", "not found")
+
+            url = parse_qs(parsed.query).get("url", [None])[0]
+            if not url:
+                return self._send(400, "text/plain", "missing url parameter")
+            try:
+                entry, how = proxy.fetch(url, self.headers.get("Cookie"))
+            except Exception as e:
+                return self._send(502, "text/plain", "upstream error: {0!r}".format(e))
+            self._send(entry["status"], entry["content_type"], entry["body"], how)
+
+        def _send(self, status, content_type, body, cache_status=None):
+            body = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            if cache_status:
+                self.send_header("X-Cache", cache_status)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return ProxyHandler
+
+
+def serve(port=DEFAULT_PORT, host="127.0.0.1", cache_dir=None,
+          min_interval=DEFAULT_MIN_INTERVAL, pool_size=4, ttl=DEFAULT_TTL):
+    proxy = CachingProxy(cache_dir, min_interval, pool_size, ttl)
+    ThreadingHTTPServer = http_server_classes()[0]
+    server = ThreadingHTTPServer((host, int(port)), make_handler(proxy))
+    logger.info("Caching proxy on http://{0}:{1} (cache: {2}, ttl: {3}s, min interval: {4}s)".format(
+        host, port, cache_dir or "memory", ttl, min_interval))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Proxy stats: {0}".format(proxy.stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="proxy.py")
+    parser.add_argument("--port", dest="port", default=DEFAULT_PORT, type=int,
+                        help="Local port to listen on.")
+    parser.add_argument("--host", dest="host", default="127.0.0.1",
+                        help="Interface to bind, keep it local.")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=None,
+                        help="Persist cached responses here (default: memory only).")
+    parser.add_argument("--min-interval", dest="min_interval", default=DEFAULT_MIN_INTERVAL, type=float,
+                        help="Minimum seconds between upstream requests, host-wide.")
+    parser.add_argument("--ttl", dest="ttl", default=DEFAULT_TTL, type=float,
+                        help="Seconds a cached response is served before it is fetched again (0: forever).")
+    parser.add_argument("--pool-size", dest="pool_size", default=4, type=int,
+                        help="Upstream connections kept per host.")
+    parser.add_argument("--log-file", dest="log_file", default=None,
+                        help="Append log messages to this file instead of stderr.")
+    args = parser.parse_args()
+    setup_logging("INFO", args.log_file)
+    serve(args.port, args.host, args.cache_dir, args.min_interval, args.pool_size, args.ttl)
+
+
+if __name__ == "__main__":
+    main()
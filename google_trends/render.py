@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Batch rendering of --ggplot series.
+
+trends.py --ggplot writes the weekly (long-term), daily (quarterly) and merged
+series of every keyword to <output>/series/ and calls render_batch() once the
+queries are done. Plots can also be (re)rendered separately:
+
+    python3 render.py ~/gtrends/cik-ipo/finance/series --processes 4
+
+Every series file becomes a PNG in plots/ next to the series directory.
+pandas and ggplot are only imported here, in the worker processes.
+"""
+
+import os, csv, argparse, logging
+from multiprocessing import Pool
+
+from log import setup_logging
+
+COLORS = [
+        '#77bde0',  # blue: daily series
+        '#b47bc6',  # purple: merged series
+        '#d55f5f'   # red: weekly series
+        ]
+HEADER = ["Date", "Weekly series", "Merged series", "Daily series"]
+logger = logging.getLogger(__name__)
+
+
+
+def write_series(path, kw):
+    "Writes kw.plot_series with the keyword and its entity type in the header."
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER + [kw.keyword, kw.desc])
+        [writer.writerow(row) for row in kw.plot_series]
+
+
+def render_one(job):
+    "Renders one series file to a PNG, returns the PNG path."
+    path, output_dir = job
+    import matplotlib
+    matplotlib.use("Agg")
+    import pandas as pd
+    from ggplot import ggplot, geom_line, ggtitle, ggsave, ylab, xlab, aes
+
+    with open(path) as f:
+        header = next(csv.reader(f))
+    keyword, entity_type = (header[4:6] + [None, None])[:2]
+    ddat = pd.read_csv(path, usecols=range(len(HEADER)))
+    ddat['Date'] = pd.to_datetime(ddat['Date'], format='%Y-%m-%d')   # whole column at once
+
+    g = ggplot(aes(x='Date', y='Daily series'), data=ddat) + \
+        geom_line(aes(x='Date', y='Daily series'), alpha=0.5, color=COLORS[0]) + \
+        geom_line(aes(x='Date', y='Merged series'), alpha=0.9, color=COLORS[1]) + \
+        geom_line(aes(x='Date', y='Weekly series'), alpha=0.5, color=COLORS[2], size=1.5) + \
+        ggtitle("Interest over time for '{}' ({})".format(keyword, entity_type)) + \
+        ylab("Interest Over Time") + xlab("Date")
+
+    png = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + ".png")
+    ggsave(filename=png, plot=g, width=15, height=5)
+    return png
+
+
+def render_batch(series_dir, output_dir=None, processes=None, overwrite=False):
+    """ Renders every series file in series_dir across `processes` worker
+        processes (default: one per CPU). Existing PNGs are kept unless
+        overwrite is set. Returns the list of PNGs written. """
+    output_dir = output_dir or os.path.join(os.path.dirname(os.path.abspath(series_dir)), "plots")
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    jobs = []
+    for name in sorted(os.listdir(series_dir)):
+        png = os.path.join(output_dir, os.path.splitext(name)[0] + ".png")
+        if name.endswith(".csv") and (overwrite or not os.path.exists(png)):
+            jobs.append((os.path.join(series_dir, name), output_dir))
+    if not jobs:
+        return []
+
+    pool = Pool(processes)
+    try:
+        pngs = pool.map(render_one, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    logger.info("Rendered {0} plot(s) to {1}".format(len(pngs), output_dir))
+    return pngs
+
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="render.py")
+    parser.add_argument("series_dir", help="Directory of series written by trends.py --ggplot.")
+    parser.add_argument("--output", dest="output_dir", default=None,
+                        help="Directory for the PNGs (default: plots/ next to series_dir).")
+    parser.add_argument("--processes", dest="processes", default=None, type=int,
+                        help="Worker processes (default: one per CPU).")
+    parser.add_argument("--overwrite", dest="overwrite", action="store_true",
+                        help="Re-render plots that already exist.")
+    args = parser.parse_args()
+    setup_logging("INFO")
+    render_batch(args.series_dir, args.output_dir, args.processes, args.overwrite)
+
+
+if __name__ == "__main__":
+    main()
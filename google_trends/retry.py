@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Unattended error handling: retries with backoff for transient failures and
+a dead-letter file for keywords that could not be processed, so a headless
+batch keeps going instead of stopping at an interactive prompt.
+
+Every HTTP call takes its (connect, read) timeout from request_timeout(),
+set once with set_timeouts(), so a stalled connection fails as a
+TransientException instead of hanging the worker.
+"""
+
+import os, sys, json, time, random, logging
+
+from google_class import TransientException, DeadlineException
+from metrics import METRICS
+
+DEFAULT_ATTEMPTS = 4
+DEFAULT_BACKOFF = 2.0       # seconds, doubled on every attempt
+DEFAULT_BACKOFF_CAP = 60.0
+MAX_BODY_CHARS = 100000     # keep the dead-letter file readable
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 30.0
+TIMEOUT = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)   # set by set_timeouts()
+logger = logging.getLogger(__name__)
+
+
+
+def set_timeouts(connect=DEFAULT_CONNECT_TIMEOUT, read=DEFAULT_READ_TIMEOUT):
+    "Sets the (connect, read) timeout in seconds used by every request."
+    global TIMEOUT
+    TIMEOUT = (float(connect), float(read))
+
+
+def request_timeout(deadline=None):
+    """ The timeout to pass to requests. With a deadline (time.time() value)
+        the read timeout is cut to the time left, and DeadlineException is
+        raised once it has passed. """
+    if deadline is None:
+        return TIMEOUT
+    left = deadline - time.time()
+    if left <= 0:
+        raise DeadlineException("Keyword deadline passed")
+    return (min(TIMEOUT[0], left), min(TIMEOUT[1], left))
+
+
+def retry_call(fn, attempts=DEFAULT_ATTEMPTS, backoff=DEFAULT_BACKOFF,
+               cap=DEFAULT_BACKOFF_CAP, retry_on=(TransientException,), deadline=None):
+    """ Calls fn() and retries on `retry_on` exceptions, sleeping a random
+        amount up to backoff * 2**attempt (full jitter) between attempts.
+        The last exception is re-raised when the attempts run out, or when
+        the next attempt would start after `deadline`. """
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except DeadlineException:
+            raise
+        except retry_on as e:
+            if attempt == attempts - 1:
+                raise
+            delay = random.uniform(0, min(cap, backoff * 2 ** attempt))
+            if deadline is not None and time.time() + delay >= deadline:
+                raise DeadlineException("Keyword deadline passed after {0}: {1}".format(
+                    type(e).__name__, str(e).strip()), params=e.params, body=e.body)
+            METRICS.inc("retries_total", error=type(e).__name__)
+            logger.warning("{0}: {1} Retrying in {2:.1f}s ({3}/{4})".format(
+                type(e).__name__, str(e).strip(), delay, attempt + 1, attempts - 1))
+            time.sleep(delay)
+
+
+def http_call(fn, params=None):
+    """ Calls fn() (a requests call) and converts connection errors, timeouts
+        and 429/5xx responses into TransientException. """
+    import requests
+    try:
+        response = fn()
+    except requests.RequestException as e:
+        raise TransientException("{0}: {1}".format(type(e).__name__, e), params=params)
+
+    if response.status_code == 429 or response.status_code >= 500:
+        body = response.text    # reads the body and frees the connection
+        raise TransientException("HTTP status {0}".format(response.status_code),
+                                 params=params, body=body)
+    return response
+
+
+
+
+class DeadLetterQueue(object):
+    """ Appends failed keywords to a JSON lines file with the request
+        parameters, the error and the raw response body. """
+
+    def __init__(self, path):
+        self.path = path
+        self.failures = []
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    def add(self, keywords, category, error):
+        body = getattr(error, "body", None)
+        if isinstance(body, (list, tuple)):
+            body = "\n".join(",".join(map(str, b)) if isinstance(b, (list, tuple)) else str(b)
+                             for b in body)
+        record = {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "keyword": keywords[0].orig_keyword,
+            "topic": keywords[0].topic,
+            "cik": keywords[0].cik,
+            "filing_date": keywords[0].filing_date,
+            "category": category,
+            "error": type(error).__name__,
+            "message": str(error).strip(),
+            "retryable": isinstance(error, TransientException),
+            "params": getattr(error, "params", None),
+            "body": body[:MAX_BODY_CHARS] if body else body,
+        }
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+        self.failures.append(record)
+        METRICS.inc("dead_letters_total", retryable=str(record["retryable"]).lower())
+        logger.warning("Failed '{0}' ({1}), written to {2}".format(
+            record["keyword"], record["error"], self.path))
+
+    def summary(self, stream=sys.stderr):
+        if not self.failures:
+            return
+        retryable = [f for f in self.failures if f["retryable"]]
+        stream.write("\n{0} keyword(s) failed, see {1}\n".format(len(self.failures), self.path))
+        if retryable:
+            stream.write("Retryable (re-run the same command to pick them up):\n")
+            for f in retryable:
+                stream.write("    {0} [{1}] {2}\n".format(f["keyword"], f["cik"] or "", f["message"]))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Run-length daily series.
+
+Most CIK keywords have no interest at all: every quarterly window comes back
+empty and used to be padded with one '0' row per day, merged day by day and
+written as hundreds of `date,0` lines. A RunSeries keeps such a series as
+[first day, number of days, value] runs instead, so an all-zero or constant
+window is one run in memory, in the journal and, with --sparse, on disk.
+
+It behaves like the list of (date, value) rows it stands for: iterating,
+len(), indexing and append() all work on rows, and dense rows are only made
+when something iterates them.
+
+    python3 runs.py --expand ~/gtrends/cik-ipo/0000123456.csv   # dense CSV on stdout
+"""
+
+import sys, csv, argparse
+from datetime import datetime, timedelta
+
+DAYS_COLUMN = "Days"    # second header column of run-length CSV files
+
+
+
+class RunSeries(object):
+    """ Daily series stored as [first day, days, value] runs """
+
+    def __init__(self, runs=None):
+        self.runs = []
+        self.days = 0
+        for start, days, value in runs or []:
+            self.append_run(start, days, value)
+
+    @classmethod
+    def constant(cls, start, end, value):
+        "One run of `value` from start to end, inclusive."
+        return cls([[start, (end - start).days + 1, value]])
+
+    @classmethod
+    def from_rows(cls, rows):
+        series = cls()
+        series.extend(rows)
+        return series
+
+    def append_run(self, start, days, value):
+        "Adds `days` days of `value` from `start`, joining the last run if it continues it."
+        if days <= 0:
+            return
+        if self.runs:
+            last = self.runs[-1]
+            if last[2] == value and type(last[0]) is type(start) \
+                    and last[0] + timedelta(days=last[1]) == start:
+                last[1] += days
+                self.days += days
+                return
+        self.runs.append([start, days, value])
+        self.days += days
+
+    def append(self, row):
+        "Adds a (date, value) row, like list.append."
+        self.append_run(row[0], 1, row[1])
+
+    def extend(self, rows):
+        if isinstance(rows, RunSeries):
+            for start, days, value in rows.runs:
+                self.append_run(start, days, value)
+        else:
+            for row in rows:
+                self.append(row)
+
+    @property
+    def is_constant(self):
+        return len(self.runs) == 1
+
+    def start(self):
+        return self.runs[0][0]
+
+    def end(self):
+        start, days, value = self.runs[-1]
+        return start + timedelta(days=days - 1)
+
+    def between(self, first, last):
+        "The days from first to last, inclusive, as a new RunSeries."
+        series = RunSeries()
+        for start, days, value in self.runs:
+            end = start + timedelta(days=days - 1)
+            lo, hi = max(start, first), min(end, last)
+            if lo <= hi:
+                series.append_run(lo, (hi - lo).days + 1, value)
+        return series
+
+    def dense(self):
+        "The (date, value) rows as a list."
+        return list(self)
+
+    def __iter__(self):
+        for start, days, value in self.runs:
+            yield (start, value)
+            for i in range(1, days):
+                yield (start + timedelta(days=i), value)
+
+    def __len__(self):
+        return self.days
+
+    def __bool__(self):
+        return self.days > 0
+    __nonzero__ = __bool__
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.dense()[index]
+        if index < 0:
+            index += self.days
+        if not 0 <= index < self.days:
+            raise IndexError("RunSeries index out of range")
+        for start, days, value in self.runs:
+            if index < days:
+                return (start + timedelta(days=index) if index else start, value)
+            index -= days
+
+    def __eq__(self, other):
+        if isinstance(other, RunSeries):
+            return self.runs == other.runs
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return "RunSeries({0} days in {1} runs)".format(self.days, len(self.runs))
+
+
+
+def _parse_day(text):
+    return datetime.strptime(text[:10], "%Y-%m-%d").date()
+
+
+def read_csv(f):
+    """ (header, RunSeries) of an output CSV, in either the run-length
+        (Date, Days, ...) or the dense (Date, ...) layout. """
+    reader = csv.reader(f)
+    header = next(reader)
+    series = RunSeries()
+    if len(header) > 1 and header[1] == DAYS_COLUMN:
+        for row in reader:
+            if row:
+                series.append_run(_parse_day(row[0]), int(row[1]), row[2])
+        return [header[0]] + header[2:], series
+    for row in reader:
+        if row:
+            series.append((_parse_day(row[0]), row[1]))
+    return header, series
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="runs.py")
+    parser.add_argument("--expand", dest="path", required=True,
+                        help="Run-length output CSV to write out day by day on stdout.")
+    args = parser.parse_args()
+    with open(args.path) as f:
+        header, series = read_csv(f)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(header)
+    for date, value in series:
+        writer.writerow([str(date), value])
+
+
+if __name__ == "__main__":
+    main()
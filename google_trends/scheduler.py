@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Quota budget scheduler.
+
+Orders a batch by priority (optional 4th column of --cik-file) or by filing
+date, estimates each keyword's request cost, and stops cleanly before the
+account's daily budget (~500 queries) is exhausted. Requests actually spent
+are recorded per account and day in a small JSON ledger, and the work left
+over is written out as a plan file in --cik-file format, so the next run can
+pick up exactly where this one stopped.
+"""
+
+import os, json, math, time, logging
+
+from metrics import METRICS
+from windows import aget, quarter_windows, overall_period, overlap_windows, grid_windows, DEFAULT_OVERLAP_MONTHS
+
+DEFAULT_DAILY_BUDGET = 500
+PLAN_FILENAME = "remaining_plan.csv"
+ENTITY_LOOKUP_COST = 1
+# share of quarterly windows that come back weekly and need a re-query
+WEEKLY_REQUERY_RATE = 0.2
+logger = logging.getLogger(__name__)
+
+
+
+class QuotaLedger(object):
+    """ Requests spent per account per day, persisted as JSON """
+
+    def __init__(self, path):
+        self.path = path
+        self.used = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.used = json.load(f)
+
+    @staticmethod
+    def today():
+        return time.strftime("%Y-%m-%d")
+
+    def spent(self, account):
+        return self.used.get(account, {}).get(self.today(), 0)
+
+    def spend(self, account, n):
+        if not n:
+            return
+        days = self.used.setdefault(account, {})
+        days[self.today()] = days.get(self.today(), 0) + n
+        if self.path:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.used, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.path)
+
+
+
+
+class QuotaScheduler(object):
+    """ Yields keywords in priority order while the planned cost fits in the
+        account's remaining daily budget.
+
+        Arguments:
+            account -- account whose budget is being spent (--username)
+            daily_budget -- requests per account per day
+            ledger -- QuotaLedger shared by runs using the same account
+            quarterly -- True if keywords are run through quarterly_queries
+            journal -- optional WindowJournal, journalled windows cost nothing
+            month_offset -- quarterly window span, as in quarterly_queries
+            order -- 'priority', 'filing-date' or 'input'
+            merge -- 'anchor' or 'overlap', as in quarterly_queries
+            is_done -- predicate for keywords whose output already exists
+            grid -- calendar quarter windows, as in quarterly_queries
+    """
+
+    def __init__(self, account, daily_budget=DEFAULT_DAILY_BUDGET, ledger=None,
+                 quarterly=None, journal=None, category=None, month_offset=[-12, 12],
+                 order="priority", is_done=None, merge="anchor", overlap_months=DEFAULT_OVERLAP_MONTHS,
+                 grid=False):
+        self.account = account
+        self.daily_budget = int(daily_budget)
+        self.ledger = ledger or QuotaLedger(None)
+        self.quarterly = quarterly
+        self.journal = journal
+        self.category = category
+        self.month_offset = month_offset
+        self.order = order
+        self.merge = merge
+        self.overlap_months = overlap_months
+        self.grid = grid
+        self.is_done = is_done or (lambda keyword: False)
+        self.remaining_work = []
+        self.requests_before = None   # requests_total when spend was last recorded
+
+    def remaining_budget(self):
+        return self.daily_budget - self.ledger.spent(self.account)
+
+    def planned_cost(self, keyword):
+        "Estimated number of requests needed for one keyword."
+        filing_date = self.quarterly
+        if isinstance(keyword, (list, tuple)):
+            filing_date = filing_date or keyword[2]
+        if not filing_date:
+            return ENTITY_LOOKUP_COST + 1
+
+        begin_period, start_range, ended_range = quarter_windows(filing_date[:10], self.month_offset)
+        if self.grid and start_range:
+            begin_period, start_range, ended_range = grid_windows(start_range, ended_range)
+        if self.merge == "overlap":
+            # no overall period and no weekly re-queries
+            windows = list(zip(*overlap_windows(start_range, ended_range, self.overlap_months)))
+        else:
+            windows = list(zip(start_range, ended_range)) + [overall_period(begin_period, ended_range)]
+        # the journal is keyed by topic (entity mid) which is unknown before
+        # the lookup, so only keywords queried as plain search terms match
+        topic = keyword[1] if isinstance(keyword, (list, tuple)) else keyword
+        fresh = [w for w in windows if not (self.journal and
+                 self.journal.key(topic, self.category, *w) in self.journal.entries)]
+        requeries = 0 if self.merge == "overlap" else int(math.ceil(len(fresh) * WEEKLY_REQUERY_RATE))
+        return ENTITY_LOOKUP_COST + len(fresh) + requeries
+
+    def ordered(self, keywords):
+        keywords = list(keywords)
+        if self.order == "priority" and any(isinstance(k, (list, tuple)) and len(k) > 3
+                                            for k in keywords):
+            # highest priority first, ties broken by filing date
+            return sorted(keywords, key=lambda k: (-_priority(k), _filing_key(k)))
+        if self.order in ("priority", "filing-date"):
+            return sorted(keywords, key=_filing_key)
+        return keywords
+
+    def schedule(self, keywords):
+        """ Generator of keywords (without the priority column) to feed into
+            get_trends(). Stops at the budget boundary; the unscheduled
+            keywords are left in self.remaining_work. """
+        queue = [k for k in self.ordered(keywords) if not self.is_done(k)]
+        self.remaining_work = [(k, self.planned_cost(k)) for k in queue]
+        self.report()
+
+        self.requests_before = METRICS.total("requests_total")
+        try:
+            while self.remaining_work:
+                keyword, cost = self.remaining_work[0]
+                if cost > self.remaining_budget():
+                    logger.warning("Daily budget reached for {0}: {1} of {2} requests used.".format(
+                        self.account, self.ledger.spent(self.account), self.daily_budget))
+                    break
+                yield keyword[:3] if isinstance(keyword, (list, tuple)) else keyword
+
+                # the keyword is finished once the next one is pulled; until
+                # then it stays in the plan in case the run is stopped
+                self.remaining_work.pop(0)
+                self.record_spend()
+        finally:
+            self.record_spend()
+
+    def record_spend(self):
+        "Adds the requests made since the last call to the ledger."
+        if self.requests_before is None:
+            return
+        requests_now = METRICS.total("requests_total")
+        self.ledger.spend(self.account, requests_now - self.requests_before)
+        self.requests_before = requests_now
+
+    def days_remaining(self):
+        cost = sum(c for _, c in self.remaining_work)
+        return int(math.ceil(float(cost) / self.daily_budget)) if cost else 0
+
+    def report(self):
+        cost = sum(c for _, c in self.remaining_work)
+        logger.info("Scheduled {0} keywords, ~{1} requests; {2} of {3} left today for {4}. "
+                    "~{5} day(s) at the current budget.".format(
+                len(self.remaining_work), cost, self.remaining_budget(),
+                self.daily_budget, self.account, self.days_remaining()))
+
+    def write_plan(self, path):
+        """ Writes the unscheduled keywords in --cik-file format (pipe
+            delimited, priority kept) or one keyword per line for --file. """
+        self.record_spend() # the keyword a QuotaException stopped
+        if not self.remaining_work:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        with open(path, "w") as f:
+            for keyword, cost in self.remaining_work:
+                if isinstance(keyword, (list, tuple)):
+                    f.write("|".join(keyword) + "\n")
+                else:
+                    f.write(keyword + "\n")
+        logger.warning("{0} keywords (~{1} requests, ~{2} day(s)) left, resume with: {3}".format(
+            len(self.remaining_work), sum(c for _, c in self.remaining_work),
+            self.days_remaining(), path))
+
+
+def _priority(keyword):
+    "Priority column of a --cik-file row; missing or non-numeric priorities are 0."
+    try:
+        return float(keyword[3])
+    except (IndexError, ValueError, TypeError):
+        return 0.0
+
+
+def _filing_key(keyword):
+    if isinstance(keyword, (list, tuple)) and len(keyword) > 2:
+        try:
+            return aget(keyword[2]).timestamp
+        except (ValueError, TypeError, RuntimeError):
+            return 0
+    return 0
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Per-series summary index, for screening outputs without opening them.
+
+As each keyword is written, trends.py adds one row to summary.sqlite in the
+output directory: mean, max, share of zero days, first nonzero date and the
+number of missing, weekly and daily quarterly windows, keyed by record id
+(cik, else the keyword) and category. Rows are computed from the series runs
+(see runs.py), so a zero series costs the same as a single day.
+
+    python3 summary.py --index ~/gtrends/cik-ipo/finance/summary.sqlite \
+        --min-mean 5 --max-zero-share 0.5 --order mean
+    python3 summary.py --rebuild ~/gtrends/cik-ipo/finance   # add CSVs not indexed yet
+
+Output is CSV on stdout, one line per matching series.
+"""
+
+import os, sys, csv, time, sqlite3, argparse
+
+from google_class import KeywordData
+from output import record_id, _iso, _value
+from runs import read_csv
+
+SUMMARY_FILENAME = "summary.sqlite"
+DEFAULT_COMMIT_EVERY = 100
+COLUMNS = ("id", "keyword", "cik", "mid", "title", "category", "file",
+           "first_date", "last_date", "days", "mean", "max", "zero_share", "first_nonzero",
+           "missing_windows", "weekly_windows", "daily_windows", "updated")
+ORDERS = ("mean", "max", "zero_share", "first_nonzero", "days", "id")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    id TEXT NOT NULL, keyword TEXT, cik TEXT, mid TEXT, title TEXT,
+    category TEXT NOT NULL DEFAULT '', file TEXT,
+    first_date TEXT, last_date TEXT, days INTEGER, mean REAL, max REAL,
+    zero_share REAL, first_nonzero TEXT,
+    missing_windows INTEGER, weekly_windows INTEGER, daily_windows INTEGER,
+    updated REAL,
+    PRIMARY KEY (id, category));
+CREATE INDEX IF NOT EXISTS series_mean ON series (category, mean);
+CREATE INDEX IF NOT EXISTS series_zero_share ON series (category, zero_share);
+CREATE INDEX IF NOT EXISTS series_mid ON series (mid);
+"""
+
+
+
+def summarize(kw, category=None, filename=None):
+    "Summary row of one KeywordData as a {column: value} dict."
+    days, total, peak, zeros = 0, 0.0, None, 0
+    first_nonzero = None
+    for start, n, count in kw.interest.runs:
+        value = _value(count)
+        if value is None:
+            continue # blank last day of an incomplete period
+        days += n
+        total += value * n
+        peak = value if peak is None else max(peak, value)
+        if value == 0:
+            zeros += n
+        elif first_nonzero is None:
+            first_nonzero = _iso(start)
+
+    labels = [label for d, label in (kw.querycounts or [])]
+    runs = kw.interest.runs
+    return {
+        "id": str(record_id(kw)), "keyword": kw.orig_keyword,
+        "cik": kw.cik, "mid": kw.topic, "title": kw.title,
+        "category": category or "", "file": filename,
+        "first_date": _iso(runs[0][0]) if runs else None,
+        "last_date": _iso(kw.interest.end()) if runs else None,
+        "days": days,
+        "mean": total / days if days else None,
+        "max": peak,
+        "zero_share": float(zeros) / days if days else None,
+        "first_nonzero": first_nonzero,
+        "missing_windows": labels.count("missing") if kw.querycounts else None,
+        "weekly_windows": labels.count("weekly") if kw.querycounts else None,
+        "daily_windows": labels.count("daily") if kw.querycounts else None,
+        "updated": time.time(),
+    }
+
+
+
+class SummaryIndex(object):
+    """ sqlite table of summarize() rows. Adds are committed in batches of
+        `commit_every` and on close(). """
+
+    def __init__(self, path, commit_every=DEFAULT_COMMIT_EVERY):
+        self.path = path
+        self.commit_every = max(int(commit_every), 1)
+        self.pending = 0
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def add(self, kw, category=None, filename=None):
+        self.put(summarize(kw, category, filename))
+
+    def put(self, row):
+        self.db.execute("INSERT OR REPLACE INTO series ({0}) VALUES ({1})".format(
+            ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))), [row[c] for c in COLUMNS])
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def has(self, id, category=None):
+        return self.db.execute("SELECT 1 FROM series WHERE id = ? AND category = ?",
+                               (str(id), category or "")).fetchone() is not None
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        if self.db is not None:
+            self.commit()
+            self.db.close()
+            self.db = None
+
+    def select(self, category=None, min_mean=None, max_mean=None, min_max=None,
+               max_zero_share=None, nonzero_before=None, nonzero_after=None,
+               max_missing=None, min_daily=None, mid=None, order="mean", limit=None):
+        "Rows matching every given filter, highest `order` first (ids and dates ascending)."
+        where, params = [], []
+        for clause, value in (("category = ?", category), ("mean >= ?", min_mean),
+                              ("mean <= ?", max_mean), ("max >= ?", min_max),
+                              ("zero_share <= ?", max_zero_share),
+                              ("first_nonzero <= ?", nonzero_before),
+                              ("first_nonzero >= ?", nonzero_after),
+                              ("missing_windows <= ?", max_missing),
+                              ("daily_windows >= ?", min_daily), ("mid = ?", mid)):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        if order not in ORDERS:
+            raise ValueError("order by one of " + ", ".join(ORDERS))
+        sql = "SELECT {0} FROM series".format(", ".join(COLUMNS))
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY {0} {1}".format(order, "ASC" if order in ("id", "first_nonzero") else "DESC")
+        if limit:
+            sql += " LIMIT {0}".format(int(limit))
+        return self.db.execute(sql, params).fetchall()
+
+
+
+def rebuild(output_dir, index, category=None):
+    """ Adds the series CSVs in output_dir that are not indexed yet, e.g.
+        results collected by the coordinator. Window counts and mids are not
+        in the CSVs and are left empty. Returns the number of files added. """
+    count = 0
+    for name in sorted(os.listdir(output_dir)):
+        if not name.endswith(".csv"):
+            continue
+        stem = name[:-len(".csv")]
+        if index.has(stem, category):
+            continue
+        try:
+            with open(os.path.join(output_dir, name)) as f:
+                header, series = read_csv(f)
+        except (ValueError, IndexError, StopIteration):
+            continue # not a series file
+        kw = KeywordData(header[1] if len(header) > 1 else stem)
+        if stem.isdigit():
+            kw.cik = stem
+        else:
+            kw.orig_keyword = stem
+        kw.desc, kw.title = (header[2:4] + [None, None])[:2]
+        kw.interest = series
+        index.add(kw, category, name)
+        count += 1
+    index.commit()
+    return count
+
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="summary.py")
+    parser.add_argument("--index", dest="index", default=None,
+                        help="summary.sqlite to query (default: the one in --rebuild's directory, or ./summary.sqlite).")
+    parser.add_argument("--rebuild", dest="rebuild", default=None,
+                        help="Output directory whose unindexed CSV files to add first.")
+    parser.add_argument("--category", dest="category", default=None)
+    parser.add_argument("--mid", dest="mid", default=None)
+    parser.add_argument("--min-mean", dest="min_mean", type=float, default=None)
+    parser.add_argument("--max-mean", dest="max_mean", type=float, default=None)
+    parser.add_argument("--min-max", dest="min_max", type=float, default=None)
+    parser.add_argument("--max-zero-share", dest="max_zero_share", type=float, default=None)
+    parser.add_argument("--nonzero-before", dest="nonzero_before", default=None,
+                        help="First nonzero day on or before this YYYY-MM-DD date.")
+    parser.add_argument("--nonzero-after", dest="nonzero_after", default=None,
+                        help="First nonzero day on or after this YYYY-MM-DD date.")
+    parser.add_argument("--max-missing", dest="max_missing", type=int, default=None,
+                        help="At most this many quarterly windows without data.")
+    parser.add_argument("--min-daily", dest="min_daily", type=int, default=None,
+                        help="At least this many quarterly windows with daily data.")
+    parser.add_argument("--order", dest="order", default="mean", choices=ORDERS)
+    parser.add_argument("--limit", dest="limit", type=int, default=None)
+    args = parser.parse_args()
+
+    path = args.index or os.path.join(args.rebuild or ".", SUMMARY_FILENAME)
+    if not args.rebuild and not os.path.exists(path):
+        sys.stderr.write("No summary index at {0}\n".format(path))
+        sys.exit(1)
+    index = SummaryIndex(path)
+    if args.rebuild:
+        count = rebuild(args.rebuild, index, args.category)
+        sys.stderr.write("Indexed {0} series files into {1}\n".format(count, path))
+
+    rows = index.select(args.category, args.min_mean, args.max_mean, args.min_max,
+                        args.max_zero_share, args.nonzero_before, args.nonzero_after,
+                        args.max_missing, args.min_daily, args.mid, args.order, args.limit)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(COLUMNS)
+    for row in rows:
+        writer.writerow(["" if v is None else v for v in row])
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Managed HTTP transport shared by the login, entitiesQuery and trendsReport
+calls: one requests.Session with an explicitly sized connection pool, gzip
+accepted (and checked on every response), and per-host statistics on how
+often warm connections were reused instead of re-handshaking.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS
+
+DEFAULT_POOL_SIZE = 4
+ACCEPT_ENCODING = "gzip, deflate"
+
+
+
+def make_session(pool_size=DEFAULT_POOL_SIZE):
+    """ Returns a requests.Session whose pools keep `pool_size` connections
+        per host, which should match the number of concurrent requests. """
+    sess = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    sess.mount("http://", adapter)
+    sess.mount("https://", adapter)
+    sess.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    sess.hooks["response"].append(_count_encoding)
+    return sess
+
+
+def _count_encoding(response, *args, **kwargs):
+    "Response hook: counts compressed vs. uncompressed bodies per host."
+    host = requests.utils.urlparse(response.url).netloc
+    encoding = response.headers.get("content-encoding", "identity").lower()
+    METRICS.inc("http_responses_total", host=host, encoding=encoding)
+    return response
+
+
+def connection_stats(session):
+    """ Per-host {requests, connections, reuse} from the session's urllib3
+        pools. `connections` counts TCP/TLS handshakes, so reuse close to 1
+        means almost every request went over a warm connection. """
+    stats = {}
+    seen = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = "{0}://{1}".format(pool.scheme, pool.host)
+            entry = stats.setdefault(host, {"requests": 0, "connections": 0})
+            entry["requests"] += pool.num_requests
+            entry["connections"] += pool.num_connections
+    for entry in stats.values():
+        n = entry["requests"]
+        entry["reuse"] = round(1 - float(entry["connections"]) / n, 4) if n else 0.0
+    return stats
+
+
+def publish_stats(session):
+    "Copies connection_stats() into METRICS."
+    for host, entry in connection_stats(session).items():
+        METRICS.set("pool_requests_total", entry["requests"], host=host)
+        METRICS.set("pool_connections_total", entry["connections"], host=host)
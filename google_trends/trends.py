@@ -10,19 +10,44 @@
 #
 # Can be used with command-line invocation or as a call from another package.
 # Non-standard dependencies: argparse, requests, arrow, fuzzywuzzy
+#
+# Keep module-level imports light: requests/colorama (google_auth),
+# selenium and IPython are imported on the code path that uses them, and
+# http.server (--metrics-port), sqlite3 (summary index) and cProfile
+# (--profile) behind their flags, so `--help` and cached runs start
+# quickly. pandas and ggplot are only used by render.py, after the queries.
 #############################################################
 
 
 from __future__     import print_function, absolute_import
 from time           import sleep
-import os, sys, csv, random, math
-import requests, arrow, argparse
+import os, sys, csv, random, math, time, atexit, socket, logging
+import arrow, argparse
+from io             import StringIO
 
-from google_auth    import authenticate_with_google
-from google_class   import FormatException, QuotaException, KeywordData
+from google_class   import FormatException, QuotaException, TransientException, CategoryException, DeadlineException, KeywordData
 from disambiguate   import disambiguate_keywords
-from interpolate    import interpolate_ioi, conform_interest_over_time, change_in_ioi
+from interpolate    import interpolate_ioi, conform_interest_over_time, change_in_ioi, stitch_overlap
 from entity_types   import PRIMARY_TYPES, BACKUP_TYPES
+from metrics        import METRICS, start_json_flusher, start_http_server
+from profiling      import KeywordProfiler, timed_function, enable_function_times
+from retry          import DeadLetterQueue, retry_call, http_call, request_timeout, set_timeouts
+from retry          import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from hedge          import hedged, set_hedging
+from journal        import WindowJournal
+from entity_index   import EntityIndex, DEFAULT_INDEX
+from events         import EventSummary, EVENTS_FILENAME, DEFAULT_WINDOWS, DEFAULT_BASELINE
+from events         import parse_windows, parse_range
+from runs           import RunSeries, DAYS_COLUMN
+from windows        import YYYY_MM, quarter_windows, overall_period, overlap_windows, DEFAULT_OVERLAP_MONTHS
+from windows        import grid_windows
+from scheduler      import QuotaScheduler, QuotaLedger, PLAN_FILENAME
+from proxy          import set_proxy, route
+from categories     import validate_category
+from render         import write_series, render_batch
+from log            import setup_logging
+from output         import JsonlWriter, JSONL_FILENAME, keyword_record, jsonl_done
+from output         import AtomicWriter, atomic_write, scan, DEFAULT_FSYNC_EVERY
 
 
 PY3 = sys.version_info[0] == 3
@@ -31,10 +56,15 @@ DEFAULT_AUTH_URL = "https://accounts.{domain}/ServiceLoginAuth"
 DEFAULT_TRENDS_URL = "http://www.{domain}/trends/trendsReport"
 # okay to leave domain off here since it's a GET request, redirects are no problem
 INTEREST_OVER_TIME_HEADER = "Interest over time"
+# other sections of the same export, (title prefix, KeywordData attribute)
+EXTRA_SECTIONS = (("Top subregions", "regional_interest"),
+				  ("Top cities", "city_interest"),
+				  ("Top searches", "top_queries"),
+				  ("Rising searches", "rising_queries"))
 EXPECTED_CONTENT_TYPE = "text/csv; charset=UTF-8"
 NOW = arrow.utcnow()
 BASEDIR = os.path.join(os.path.expanduser("~"), "Dropbox", "gtrends-beta")
-DEBUG = False
+logger = logging.getLogger(__name__)
 
 
 def main():
@@ -44,7 +74,7 @@ def main():
 		# Group 1: mutually exclusive arguments
 		'--keywords': "A comma-separated list of phrases to query. Replaces --batch-input.",
 		'--file': "filepath containing newline-separated trends query terms.",
-		'--cik-file': "File with rows [cik|keyword|date]. Cik: is an arbitrary id number (filename). Input is a pipe delimited csv file.",
+		'--cik-file': "File with rows [cik|keyword|date] or [cik|keyword|date|priority]. Cik: is an arbitrary id number (filename). Input is a pipe delimited csv file.",
 		# Group 2: mutually exclusive arguments
 		'--quarterly': "Loops keyword through multiple quarters from a " \
 						+ "-6 months and +18 months from a specific date",
@@ -58,8 +88,59 @@ def main():
 		'--auth-url': "Authenticate URL: Address of Google's login service.",
 		'--trends-url': "Address of Google's trends querying URL.",
 		'--throttle': "Number of seconds to space out requests, this is to avoid rate limiting.",
-		'--category': "Category for queries, e.g 0-7-107 for finance->investing. See categories.txt",
-		'--ggplot': "Plots merged data series, requires ggplot"
+		'--category': "Category for queries, e.g 0-7-107 for finance->investing. See categories.txt " \
+						+ "or categories.py --search.",
+		'--ggplot': "Keeps the weekly, daily and merged series of quarterly queries in series/ " \
+						+ "and plots them to plots/ after the batch (render.py), requires pandas and ggplot.",
+		'--metrics-file': "Periodically flush per-stage timings and request counters to this JSON file.",
+		'--metrics-port': "Serve metrics in Prometheus text format on this local port.",
+		'--metrics-interval': "Seconds between --metrics-file flushes.",
+		'--profile': "cProfile every keyword and keep the N slowest profiles.",
+		'--profile-dir': "Directory to write --profile results to.",
+		'--function-times': "Record wall-clock time per hot function, written to this JSON file.",
+		'--dead-letter': "JSON lines file for keywords that failed (default: dead_letter.jsonl in --output).",
+		'--journal': "Checkpoint file for completed quarterly windows, used to resume keywords " \
+						+ "(default: .window_journal.jsonl in --output, 'none' to disable).",
+		'--daily-budget': "Requests per account per day. Schedules keywords by priority and stops " \
+						+ "before the budget is exhausted, writing the rest to --plan.",
+		'--order': "Scheduling order with --daily-budget: priority, filing-date or input.",
+		'--ledger': "JSON file of requests used per account per day (default: ~/.gtrends_quota.json).",
+		'--plan': "Where --daily-budget writes the unscheduled keywords (default: " + PLAN_FILENAME + " in --output).",
+		'--pool-size': "HTTP connections kept open per host, match this to the number of concurrent requests.",
+		'--proxy': "Send entity and trends requests through a local caching proxy (proxy.py), e.g. http://127.0.0.1:8765",
+		'--coordinator': "Lease keywords from a coordinator (coordinator.py) and post results back to it, " \
+						+ "instead of reading --keywords/--file/--cik-file.",
+		'--worker-id': "Name this worker reports to the coordinator (default: hostname-pid).",
+		'--merge': "How quarterly windows are put on one scale: 'anchor' rescales them with an " \
+						+ "overall-period query, 'overlap' scales overlapping windows onto each other.",
+		'--overlap-months': "Whole months (1 or 2) each window shares with the previous one with " \
+						+ "--merge overlap. Windows stay three months long, so a larger overlap means more windows.",
+		'--log-level': "Lowest log level written: DEBUG, INFO, WARNING or ERROR.",
+		'--log-file': "Append log messages to this file instead of stderr.",
+		'--quiet': "Only log warnings and errors: no per-keyword or per-window progress.",
+		'--output-format': "csv (one file per keyword) or jsonl (one JSON record per keyword, " \
+						+ "streamed to stdout or appended to results.jsonl in --output).",
+		'--fsync-every': "Output files written between fsyncs. Files are renamed into place " \
+						+ "atomically and recorded in .complete.jsonl once synced.",
+		'--entity-index': "Entities seen in earlier lookups; keywords that match one locally " \
+						+ "skip the entitiesQuery request (default: ~/.gtrends_entities.jsonl, 'none' to disable).",
+		'--event-windows': "With --cik-file: day windows around each filing date to summarize, " \
+						+ "e.g. 'pre=-30:-1,event=0:1,post=2:30' ('default' for these). Writes one row per firm.",
+		'--event-baseline': "Days relative to the filing date that abnormal attention is measured against.",
+		'--event-file': "Summary table for --event-windows (default: event_windows.csv in --output).",
+		'--summary-index': "sqlite index of per-series statistics for screening with summary.py " \
+						+ "(default: summary.sqlite in --output, 'none' to disable).",
+		'--window-grid': "Query calendar quarters instead of quarters counted from each filing date, " \
+						+ "so journalled windows are reused across firms and filing dates. " \
+						+ "Periods not starting on a calendar quarter need one window more.",
+		'--connect-timeout': "Seconds to wait for a connection to Google before retrying.",
+		'--read-timeout': "Seconds to wait for a response before retrying.",
+		'--keyword-deadline': "Seconds a keyword may take in total (windows, retries, backoff) " \
+						+ "before it is dead-lettered as retryable; journalled windows are kept.",
+		'--sparse': "Write series as runs of equal days (Date, Days, value), so series without " \
+						+ "interest take one line. Expand with runs.py --expand.",
+		'--hedge': "Duplicate trend requests slower than the p95 latency and use the first answer " \
+						+ "(at most 5%% of requests)."
 	}
 
 
@@ -82,7 +163,37 @@ def main():
 		('--trends-url',    "trends_url",        DEFAULT_TRENDS_URL),
 		('--throttle',      "throttle",          0),
 		('--category',      "category",          None),
-		('--ggplot',        "ggplot",            None)
+		('--ggplot',        "ggplot",            None),
+		('--metrics-file',  "metrics_file",      None),
+		('--metrics-port',  "metrics_port",      None),
+		('--metrics-interval', "metrics_interval", 30),
+		('--profile',       "profile",           None),
+		('--profile-dir',   "profile_dir",       "profiles"),
+		('--function-times', "function_times",   None),
+		('--dead-letter',   "dead_letter",       None),
+		('--journal',       "journal",           None),
+		('--daily-budget',  "daily_budget",      None),
+		('--order',         "order",             "priority"),
+		('--ledger',        "ledger",            os.path.join(os.path.expanduser("~"), ".gtrends_quota.json")),
+		('--plan',          "plan",              None),
+		('--pool-size',     "pool_size",         4),
+		('--proxy',         "proxy",             None),
+		('--coordinator',   "coordinator",       None),
+		('--worker-id',     "worker_id",         "{0}-{1}".format(socket.gethostname(), os.getpid())),
+		('--merge',         "merge",             "anchor"),
+		('--overlap-months', "overlap_months",   DEFAULT_OVERLAP_MONTHS),
+		('--log-level',     "log_level",         "INFO"),
+		('--log-file',      "log_file",          None),
+		('--output-format', "output_format",     "csv"),
+		('--fsync-every',   "fsync_every",       DEFAULT_FSYNC_EVERY),
+		('--entity-index',  "entity_index",      DEFAULT_INDEX),
+		('--event-windows', "event_windows",     None),
+		('--event-baseline', "event_baseline",   DEFAULT_BASELINE),
+		('--event-file',    "event_file",        None),
+		('--summary-index', "summary_index",     None),
+		('--connect-timeout', "connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+		('--read-timeout',  "read_timeout",      DEFAULT_READ_TIMEOUT),
+		('--keyword-deadline', "keyword_deadline", None)
 	)
 
 	parser = argparse.ArgumentParser(prog="trends.py")
@@ -99,6 +210,10 @@ def main():
 	# General Arguments
 	[parser.add_argument(A[0], help=help_docs[A[0]], dest=A[1], default=A[2])
 		for A in command_line_args[5:]]
+	parser.add_argument('--quiet', help=help_docs['--quiet'], dest="quiet", action="store_true")
+	parser.add_argument('--hedge', help=help_docs['--hedge'], dest="hedge", action="store_true")
+	parser.add_argument('--window-grid', help=help_docs['--window-grid'], dest="window_grid", action="store_true")
+	parser.add_argument('--sparse', help=help_docs['--sparse'], dest="sparse", action="store_true")
 
 
 	def missing_args(args):
@@ -106,14 +221,14 @@ def main():
 		if not (args.password or args.username):
 			sys.stderr.write("ERROR: Use --username and --password flags.\n")
 			sys.exit(5)
-		elif not (args.keywords or args.batch_input_path or args.cik_file):
+		elif not (args.keywords or args.batch_input_path or args.cik_file or args.coordinator):
 			sys.stderr.write("ERROR: Use --keywords or --file, try --help for details.\n")
 			sys.exit(5)
 		elif args.quarterly and not args.start_date and not args.end_date:
 			sys.stderr.write("ERROR: --quarterly requires a starting date." +
 				" Try: --quarterly 2012-01 (day insensitive)")
 		if args.cik_file and (args.start_date == NOW):
-			print('Mixing --cik-file and --start-date, ignoring --start-date.')
+			logger.warning('Mixing --cik-file and --start-date, ignoring --start-date.')
 		else:
 			return None
 
@@ -145,19 +260,57 @@ def main():
 		keywords = list(keywords)
 		random.shuffle(keywords)
 		for keyword in keywords:
-			if os.path.exists(os.path.join(args.output_path, csv_name(keyword))):
+			if is_done(keyword):
 				continue
 			yield keyword
 
+	def is_done(keyword):
+		"Keywords whose results were written by an earlier run."
+		if jsonl:
+			return (keyword[0] if isinstance(keyword, list) else keyword) in done_ids
+		return os.path.exists(os.path.join(args.output_path, csv_name(keyword)))
+
 	def output_results(IO_out, kw):
 		writer = csv.writer(IO_out)
+		if args.sparse:
+			# one row per run of equal days, see runs.py
+			writer.writerow(["Date", DAYS_COLUMN, kw.keyword, kw.desc, kw.title])
+			[writer.writerow([str(s), n, str(c)]) for s, n, c in kw.interest.runs]
+			return
 		# Headers
 		writer.writerow(["Date", kw.keyword, kw.desc, kw.title])
 		# Write IoT Data
 		[writer.writerow([str(s) for s in interest]) for interest in kw.interest]
 
+	def output_sections(kw):
+		"Regional breakdown and related searches, parsed from the same responses."
+		sections = (('regional', ["Region", "Interest"], kw.regional_interest),
+					('cities', ["City", "Interest"], kw.city_interest),
+					('related', ["Query", "Top"], kw.top_queries),
+					('rising', ["Query", "Rising"], kw.rising_queries))
+		for subdir, header, rows in sections:
+			if not rows:
+				continue
+			path = os.path.join(args.output_path, subdir)
+			if not os.path.exists(path):
+				os.makedirs(path)
+			buf = StringIO()
+			writer = csv.writer(buf)
+			writer.writerow(header)
+			[writer.writerow(list(r)) for r in rows]
+			atomic_write(os.path.join(path, csv_name(kw)), buf.getvalue())
+
+	def output_plot_series(kw):
+		"Keeps the --ggplot series for render_batch() after the queries."
+		if not kw.plot_series:
+			return
+		if not os.path.exists(series_dir):
+			os.makedirs(series_dir)
+		write_series(os.path.join(series_dir, csv_name(kw)), kw)
+
 
 	args = parser.parse_args()
+	setup_logging(args.log_level, args.log_file, args.quiet)
 	if not missing_args(args):
 		if args.keywords: # Single input
 			keywords = {k.strip() for k in args.keywords.split(",")}
@@ -169,11 +322,11 @@ def main():
 
 		elif args.cik_file:
 			with open(args.cik_file) as source:
-				keywords = [f.strip().split('|') for f in source.readlines()]
+				keywords = [f.strip().split('|') for f in source.readlines() if f.strip()]
 				try:
-					assert all([len(k)==3 for k in keywords])
+					assert all([len(k) in (3, 4) for k in keywords])
 				except AssertionError:
-					print('--cik-file: Bad format, try using pipe delimited (|) data.')
+					logger.error('--cik-file: Bad format, try using pipe delimited (|) data.')
 					sys.exit(1)
 
 		if not PY3:
@@ -182,10 +335,114 @@ def main():
 			except AttributeError:
 				pass
 
+	try:
+		validate_category(args.category)
+	except CategoryException as e:
+		logger.error('--category: {0}'.format(e))
+		sys.exit(1)
+	if args.merge == 'overlap' and str(args.overlap_months) not in ('1', '2'):
+		logger.error('--overlap-months: expected 1 or 2, got {0}'.format(args.overlap_months))
+		sys.exit(1)
+
+	if args.metrics_file:
+		start_json_flusher(args.metrics_file, interval=float(args.metrics_interval))
+	if args.metrics_port:
+		start_http_server(int(args.metrics_port))
+	if args.function_times:
+		enable_function_times(args.function_times)
+	if args.proxy:
+		set_proxy(args.proxy)
+	set_timeouts(args.connect_timeout, args.read_timeout)
+	set_hedging(args.hedge, min_interval=throttle_interval(args.throttle))
+	profiler = KeywordProfiler(args.profile, args.profile_dir) if args.profile else None
+	if profiler:
+		atexit.register(profiler.write) # also on QuotaException
+
+	output_writer = None
+	if args.output_format == "csv" and not args.coordinator and args.output_path != "terminal":
+		# requeue outputs a killed run left half-written, before anything checks
+		# is_done() and before the side files below are opened in the directory
+		side_files = [EVENTS_FILENAME, PLAN_FILENAME]
+		for path in (args.event_file, args.plan):
+			if path and os.path.abspath(os.path.dirname(path)) == os.path.abspath(args.output_path):
+				side_files.append(os.path.basename(path))
+		scan(args.output_path, skip=side_files)
+		output_writer = AtomicWriter(args.output_path, int(args.fsync_every))
+		atexit.register(output_writer.close)
+
+	dead_letter_path = args.dead_letter or os.path.join(
+		"." if args.output_path == "terminal" else args.output_path, "dead_letter.jsonl")
+	dead_letter = DeadLetterQueue(dead_letter_path)
+	atexit.register(dead_letter.summary)
+
+	journal_path = args.journal
+	if journal_path is None and args.output_path != "terminal":
+		journal_path = os.path.join(args.output_path, ".window_journal.jsonl")
+	journal = WindowJournal(journal_path) if journal_path and journal_path != "none" else None
+	entity_index = EntityIndex(args.entity_index) if args.entity_index != "none" else None
+
+	events = None
+	if args.event_windows:
+		try:
+			windows = parse_windows(DEFAULT_WINDOWS if args.event_windows == "default" else args.event_windows)
+			events = EventSummary(args.event_file or os.path.join(
+							"." if args.output_path == "terminal" else args.output_path, EVENTS_FILENAME),
+							windows, parse_range(args.event_baseline))
+		except ValueError as e:
+			logger.error("--event-windows: {0}".format(e))
+			sys.exit(1)
+		atexit.register(events.close)
+
+	summary = None
+	if args.summary_index != "none" and (args.summary_index or
+			(args.output_path != "terminal" and not args.coordinator)):
+		from summary import SummaryIndex, SUMMARY_FILENAME # sqlite3, only with an index
+		summary = SummaryIndex(args.summary_index or os.path.join(args.output_path, SUMMARY_FILENAME))
+		atexit.register(summary.close)
+
+	jsonl, done_ids = None, set()
+	if args.output_format == "jsonl":
+		if args.output_path == "terminal":
+			jsonl = JsonlWriter(sys.stdout)
+		else:
+			if not os.path.exists(args.output_path):
+				os.makedirs(args.output_path)
+			jsonl_path = os.path.join(args.output_path, JSONL_FILENAME)
+			done_ids = jsonl_done(jsonl_path)
+			jsonl = JsonlWriter.open(jsonl_path)
+	elif args.output_format != "csv":
+		logger.error("--output-format: expected csv or jsonl, got {0}".format(args.output_format))
+		sys.exit(1)
+
+	coordinator = None
+	if args.coordinator:
+		# the coordinator owns the job list, the quota ledger and the outputs
+		from coordinator import CoordinatorClient
+		coordinator = CoordinatorClient(args.coordinator, args.worker_id, args.username)
+		atexit.register(coordinator.close) # the last lease's unfinished jobs
+		keyword_gen = coordinator.jobs()
+	elif args.daily_budget:
+		output_dir = "." if args.output_path == "terminal" else args.output_path
+		scheduler = QuotaScheduler(args.username, int(args.daily_budget),
+						ledger=QuotaLedger(args.ledger),
+						quarterly=args.quarterly, journal=journal,
+						category=args.category, order=args.order,
+						merge=args.merge, overlap_months=int(args.overlap_months),
+						is_done=is_done, grid=args.window_grid)
+		atexit.register(scheduler.write_plan,
+						args.plan or os.path.join(output_dir, PLAN_FILENAME))
+		keyword_gen = scheduler.schedule(keywords)
+	else:
+		# priority column is only used by the scheduler
+		keywords = [k[:3] if isinstance(k, list) else k for k in keywords]
+		keyword_gen = keyword_generator(keywords)
+
+	series_dir = os.path.join("." if args.output_path == "terminal" else args.output_path, "series")
+
 	start_date = YYYY_MM(args.start_date)
 	end_date   = YYYY_MM(args.end_date)
 	trend_generator = get_trends(
-						keyword_generator(keywords),
+						keyword_gen,
 						trends_url=args.trends_url,
 						quarterly=args.quarterly,
 						start_date=start_date,
@@ -194,37 +451,62 @@ def main():
 						password=args.password,
 						throttle=args.throttle,
 						category=args.category,
-						ggplot=args.ggplot)
+						ggplot=args.ggplot,
+						profiler=profiler,
+						dead_letter=dead_letter,
+						journal=journal,
+						entity_index=entity_index,
+						pool_size=int(args.pool_size),
+						merge=args.merge,
+						overlap_months=int(args.overlap_months),
+						keyword_deadline=args.keyword_deadline and float(args.keyword_deadline),
+						grid=args.window_grid)
 
 
 	for keyword_data in trend_generator:
-		if args.output_path == "terminal":
+		write_t0 = time.time()
+		if coordinator:
+			buf = StringIO()
+			output_results(buf, keyword_data)
+			coordinator.complete(keyword_data, csv_name(keyword_data), buf.getvalue())
+		elif jsonl:
+			jsonl.write(keyword_record(keyword_data, args.category, args.sparse)) # sections included
+		elif args.output_path == "terminal":
 			output_results(sys.stdout, keyword_data)
 		else:
-			if not os.path.exists(args.output_path):
-				os.makedirs(args.output_path)
-
-			output_filename = os.path.join(args.output_path, csv_name(keyword_data))
-
-			with open(output_filename, 'w+') as f:
-				output_results(f, keyword_data)
+			buf = StringIO()
+			output_results(buf, keyword_data)
+			output_writer.write(csv_name(keyword_data), buf.getvalue())
+			output_sections(keyword_data)
+		if args.ggplot:
+			output_plot_series(keyword_data)
+		if events:
+			events.add(keyword_data, args.category)
+		if summary:
+			summary.add(keyword_data, args.category, JSONL_FILENAME if jsonl else csv_name(keyword_data))
+		METRICS.observe("stage_seconds", time.time() - write_t0, stage="write")
+		METRICS.inc("keywords_total")
 
 		if keyword_data.cik and keyword_data.querycounts:
 
 			qpath = os.path.join(BASEDIR, 'cik-ipo/query_counts', args.category)
 			if not os.path.exists(qpath):
-				# print("Making dir: {}".format(qpath))
+				logger.debug("Making dir: {}".format(qpath))
 				os.makedirs(qpath)
 
 			qcount_path = os.path.join(qpath, csv_name(keyword_data))
 			with open(qcount_path, 'w+') as f:
-				# print("Writing querycounts to: {}".format(qcount_path))
+				logger.debug("Writing querycounts to: {}".format(qcount_path))
 				writer = csv.writer(f)
 				writer.writerow(['Missing Quarters, '+ args.category])
 				[writer.writerow([str(q) for q in qcount]) for qcount in keyword_data.querycounts]
 
 		else:
-			if DEBUG: print("Warning!: no keyword_data.cik or keyword_data.querycounts")
+			logger.debug("No keyword_data.cik or keyword_data.querycounts")
+
+	if args.ggplot and os.path.exists(series_dir):
+		with METRICS.timed("render"):
+			render_batch(series_dir)
 
 
 
@@ -241,7 +523,16 @@ def get_trends(keyword_gen, username=None, password=None,
 			login_url=DEFAULT_LOGIN_URL,
 			auth_url=DEFAULT_AUTH_URL,
 			primary_types=PRIMARY_TYPES,
-			backup_types=BACKUP_TYPES):
+			backup_types=BACKUP_TYPES,
+			profiler=None,
+			dead_letter=None,
+			journal=None,
+			pool_size=4,
+			merge='anchor',
+			overlap_months=DEFAULT_OVERLAP_MONTHS,
+			keyword_deadline=None,
+			entity_index=None,
+			grid=False):
 	""" Gets a collection of trends. Requires --keywords, --username and --password flags.
 
 		Arguments:
@@ -253,58 +544,107 @@ def get_trends(keyword_gen, username=None, password=None,
 			--categories: A category specification such as 0-7-37 for banking
 			--start_date: The earliest records to include in the query
 			--end_date: The oldest records to include in the query
-
-		Returns a generator of KeywordData
+			--profiler: Optional KeywordProfiler, profiles each keyword's queries
+			--dead_letter: Optional DeadLetterQueue. Keywords that fail with a
+				FormatException or TransientException are written there and
+				skipped; without it the exception is raised.
+			--journal: Optional WindowJournal, checkpoints each quarterly window
+				so an interrupted keyword resumes with only its missing windows.
+			--pool_size: HTTP connections kept per host by the shared session
+			--merge, --overlap_months: see quarterly_queries()
+			--keyword_deadline: Optional seconds per keyword; past it the keyword
+				fails with DeadlineException (a TransientException).
+			--entity_index: Optional EntityIndex, resolves keywords it can match
+				without an entitiesQuery request and learns from the others.
+			--grid: snap quarterly windows to calendar quarters, see
+				quarterly_queries(); without a journal they are shared in memory.
+
+		Returns a generator of KeywordData.
+		Raises CategoryException for unknown categories before logging in.
 	"""
 
+	validate_category(category)
+	if grid and journal is None:
+		journal = WindowJournal(None) # grid cells are still shared within this run
+
+	from google_auth import authenticate_with_google # pulls in requests
+	from transport import publish_stats
 
+	METRICS.set_account(username)
 	session, cookies, domain = authenticate_with_google(username, password,
 													 login_url=login_url,
-													 auth_url=auth_url)
+													 auth_url=auth_url,
+													 pool_size=pool_size)
 
 
 	while True: # For each keyword:
+		if profiler:
+			profiler.start()
 		try:    # try to get correct keywords [KeywordData object(s)].
 			keywords = disambiguate_keywords(keyword_gen, session, cookies,
 											primary_types=primary_types,
-											backup_types=backup_types)
+											backup_types=backup_types,
+											entity_index=entity_index)
 		except StopIteration:
+			if profiler:
+				profiler.cancel()
 			break
+		except TransientException as e:
+			# entitiesQuery failed after its retries, the rest of the batch can go on
+			if dead_letter is None or not e.keywords:
+				raise
+			if profiler:
+				profiler.cancel()
+			dead_letter.add(e.keywords, category, e)
+			continue
 
 		for keyword in keywords:
-			print("="*60, "\n{k}: {c}".format(k=keyword.__unicode__(), c=category))
+			logger.info("{k}: {c}".format(k=keyword.__unicode__(), c=category))
 			if keyword.cik:
-				print('cik:', keyword.cik, '\nfiling date: ', keyword.filing_date)
+				logger.info('cik: {0}, filing date: {1}'.format(keyword.cik, keyword.filing_date))
 
 
 		# from IPython import embed; embed()
 		fn_args = {'keywords': keywords, 'category':category, 'ggplot':ggplot,
 				   'cookies': cookies, 'session': session,
-				   'domain': domain, 'throttle': throttle }
-
-		if quarterly:
-			# Rolling quarterly period queries within start and end dates
-			fn_args['filing_date'] = quarterly[:7]
-			all_data = quarterly_queries(**fn_args)
-		elif keywords[0].cik:
-			# dates obtained from --cik-filing
-			fn_args['filing_date'] = keywords[0].filing_date
-			all_data = quarterly_queries(**fn_args)
-			# querycounts: number of all-zero quarterly queries
-		else:
-			# Single keyword query
-			fn_args['start_date'] = start_date
-			fn_args['end_date'] = end_date
-			all_data = single_query(**fn_args)
-			# querycounts = None # for rolling queries only
+				   'domain': domain, 'throttle': throttle,
+				   'deadline': time.time() + keyword_deadline if keyword_deadline else None}
+
+		try:
+			if quarterly:
+				# Rolling quarterly period queries within start and end dates
+				fn_args['filing_date'] = quarterly[:7]
+				all_data = quarterly_queries(journal=journal, merge=merge,
+											 overlap_months=overlap_months, grid=grid, **fn_args)
+			elif keywords[0].cik:
+				# dates obtained from --cik-filing
+				fn_args['filing_date'] = keywords[0].filing_date
+				all_data = quarterly_queries(journal=journal, merge=merge,
+											 overlap_months=overlap_months, grid=grid, **fn_args)
+				# querycounts: number of all-zero quarterly queries
+			else:
+				# Single keyword query
+				fn_args['start_date'] = start_date
+				fn_args['end_date'] = end_date
+				all_data = single_query(**fn_args)
+				# querycounts = None # for rolling queries only
+		except (FormatException, TransientException) as e:
+			if dead_letter is None:
+				raise
+			if profiler:
+				profiler.cancel()
+			dead_letter.add(keywords, category, e)
+			continue
 
 
 		# from IPython import embed; embed()
 		# assign (date, counts) to each KeywordData object
-		for row in all_data[1:]:
-			date, counts = parse_ioi_row(row)
-			for i in range(len(keywords)):
-				keywords[i].add_interest_data(date, counts[i])
+		with METRICS.timed("parse"):
+			add_interest(keywords, all_data)
+
+		if profiler:
+			profiler.stop(keywords, category)
+		publish_stats(session)
 
 		for kw in keywords:
 			yield kw    # yield KeywordData objects
@@ -331,29 +671,56 @@ def _query_parameters(start_date, end_date, keywords, category):
 	return params
 
 
-def _get_response(url, params, cookies, session):
-	"Calls GET and returns a list of the reponse data."
-	response = session.get(url, params=params, cookies=cookies,
-							 allow_redirects=True,
-							 stream=True)
+@timed_function
+def _get_response(url, params, cookies, session, deadline=None):
+	"""Calls GET and returns a list of the reponse data, retrying transient failures
+	(hedged with --hedge) until `deadline`."""
+	return retry_call(lambda: hedged(lambda: _request_once(url, params, cookies, session, deadline)),
+					  deadline=deadline)
 
-	if response.headers["content-type"] == 'text/csv; charset=UTF-8':
-		if sys.version_info.major==3:
-			return [x.decode('utf-8') for x in response.iter_lines()]
-		else:
-			return list(response.iter_lines())
 
-	elif 'text/html' in response.headers["content-type"]:
-		if "quota" in response.text.strip().lower():
+def _request_once(url, params, cookies, session, deadline=None):
+	"Issues a single trendsReport request, see _get_response()."
+	request_url, request_params = route(url, params) # via the caching proxy, if any
+	timeout = request_timeout(deadline)
+	with METRICS.timed("trend_request"):
+		response = http_call(lambda: session.get(request_url, params=request_params, cookies=cookies,
+								 allow_redirects=True,
+								 stream=True, timeout=timeout), params=params)
+		METRICS.inc("requests_total", endpoint="trendsReport")
+		if "X-Cache" in response.headers:
+			METRICS.cache("proxy", response.headers["X-Cache"] != "MISS")
+
+		if response.headers["content-type"] == 'text/csv; charset=UTF-8':
+			try:
+				lines = list(response.iter_lines())
+			finally:
+				response.close() # hand the streamed connection back to the pool
+			METRICS.inc("bytes_received_total", sum(len(x) + 1 for x in lines), endpoint="trendsReport")
+			if sys.version_info.major==3:
+				return [x.decode('utf-8') for x in lines]
+			else:
+				return lines
+
+	# .content reads the whole body, which releases the connection
+	METRICS.inc("bytes_received_total", len(response.content), endpoint="trendsReport")
+	return _check_response(response.headers.get("content-type"), response.text, params)
+
+
+def _check_response(content_type, text, params):
+	"""Handles trendsReport responses that are not CSV: raises QuotaException or
+	FormatException, or returns an empty series for 'currently unavailable' pages."""
+	if content_type and 'text/html' in content_type:
+		if "quota" in text.strip().lower():
+			METRICS.inc("quota_errors_total", endpoint="trendsReport")
 			raise QuotaException("\n\nThe request quota has been reached. " +
 					"This may be either the daily quota (~500 queries?) or the rate limiting quota. " +
 					"Try adding the --throttle argument to avoid rate limiting problems.")
 
-		elif "currently unavailable" in response.text.strip().lower():
-			print('\n', response.text.strip())
-			print("\nNo interest for this category--'currently unavailable' " +
-				"\n==> content type: {}... returning 0\n\n".format(
-					response.headers["content-type"]))
+		elif "currently unavailable" in text.strip().lower():
+			logger.debug(text.strip())
+			logger.warning("No interest for this category--'currently unavailable' " +
+				"(content type: {}), returning 0".format(content_type))
 
 			qdate = params["date"].split(' ')[0]
 			qdate = arrow.get(qdate, 'MM/YYYY').strftime('%b %Y')
@@ -361,30 +728,76 @@ def _get_response(url, params, cookies, session):
 			return [topic, "Worldwide; " + qdate, ""]
 
 		else:
-			print('\n', response.text.strip().lower(), '\n')
+			logger.debug(text.strip())
 			raise FormatException(("\n\nUnexpected content type {0}. " +
-				"Maybe an invalid category or date was supplied".format(
-					response.headers["content-type"])))
+				"Maybe an invalid category or date was supplied").format(content_type),
+				params=params, body=text)
 	else:
-		from IPython import embed; embed()
+		raise FormatException("Unexpected content type {0}".format(content_type),
+			params=params, body=text)
 
 
+@timed_function
 def _process_response(response_data):
 	"Filters raw response.get data for dates and interest over time counts."
-	try:
-		start_row = response_data.index(INTEREST_OVER_TIME_HEADER)
-	except (AttributeError, ValueError) as e:
-		return response_data # handle in check_no_data()
-
-	formatted_data = []
-	for line in response_data[start_row+1:]:
-		if line.strip() == "":
-			break # reached end of interest over time
+	with METRICS.timed("parse"):
+		try:
+			start_row = response_data.index(INTEREST_OVER_TIME_HEADER)
+		except (AttributeError, ValueError) as e:
+			return response_data # handle in check_no_data()
+
+		formatted_data = []
+		for line in response_data[start_row+1:]:
+			if line.strip() == "":
+				break # reached end of interest over time
+			else:
+				formatted_data.append(line.strip().split(','))
+		return formatted_data
+
+
+@timed_function
+def _process_sections(response_data):
+	"""Splits a trendsReport export into its blank-line separated sections.
+	Returns {section title: [row, ...]} for the sections after "Interest over time"
+	(regional breakdown, top and rising related searches), without header rows."""
+	sections = {}
+	if not isinstance(response_data, list):
+		return sections
+	title, rows = None, []
+	for line in response_data + [""]:
+		line = line.strip()
+		if line == "":
+			if title and title != INTEREST_OVER_TIME_HEADER:
+				sections[title] = rows
+			title, rows = None, []
+		elif title is None:
+			title = line
 		else:
-			formatted_data.append(line.strip().split(','))
-	return formatted_data
+			row = [x.strip() for x in line.rsplit(',', 1)]
+			if not rows and len(row) == 2 and not _section_value(row[1]):
+				continue # header row, e.g. "Subregion,facebook"
+			rows.append(row)
+	return sections
+
+
+def _section_value(value):
+	"True for values found in data rows: 0-100, '+250%' or 'Breakout'."
+	return value.isdigit() or value.endswith('%') or value.lower() == 'breakout'
 
 
+def _add_sections(keywords, sections):
+	"Assigns regional and related-query sections to KeywordData objects."
+	for title, rows in sections.items():
+		for prefix, attribute in EXTRA_SECTIONS:
+			if not title.startswith(prefix):
+				continue
+			# joint queries have one section per topic: "Top cities for <title>"
+			matches = [k for k in keywords if k.title and title.endswith(k.title)]
+			for kw in (matches or keywords[:1]):
+				getattr(kw, attribute).extend(tuple(r) for r in rows if len(r) == 2)
+
+
+@timed_function
 def _check_data(keywords, formatted_data):
 	"Check if query is empty. If so, format data accordingly."
 	if 'Worldwide; ' in formatted_data[1] and formatted_data[2]=="":
@@ -397,7 +810,7 @@ def _check_data(keywords, formatted_data):
 			date = arrow.get(date, 'YYYY')
 			no_data = [date, 0]
 			pass
-		print("Zero interest for '{0}'".format(keywords[0].title))
+		logger.info("Zero interest for '{0}'".format(keywords[0].title))
 		return [no_data]
 	else:
 		return formatted_data[1:]
@@ -416,13 +829,12 @@ def aligned_weekly(query_data, all_data):
 		q2 = arrow.get(q2[-10:])
 
 	if abs((q2 - q1).days) > 1:
-		if DEBUG: print(
-		"""\nWARNING: Weekly dates not matched with last query's end-date:
-		When trends returns weekly data, it does not guarantee that
-		the first week begins on the 1st day of the month.
-		This means the first few days may be truncated if the
-		previous query was not also in weekly format.\n""")
-		print("\t=> Encountered weekly dates! aligning daily and monthly dates...\n")
+		# When trends returns weekly data, it does not guarantee that
+		# the first week begins on the 1st day of the month.
+		# This means the first few days may be truncated if the
+		# previous query was not also in weekly format.
+		logger.debug("Weekly dates not matched with last query's end-date: {0} vs {1}".format(q1, q2))
+		logger.info("Encountered weekly dates! aligning daily and monthly dates...")
 		return False
 	return True
 
@@ -439,67 +851,98 @@ def weekly_date(date, last_date='last'):
 
 
 
-def quarterly_queries(keywords, category, cookies, session, domain, throttle, filing_date, ggplot, month_offset=[-12, 12], trends_url=DEFAULT_TRENDS_URL):
+@timed_function
+def quarterly_queries(keywords, category, cookies, session, domain, throttle, filing_date, ggplot, month_offset=[-12, 12], trends_url=DEFAULT_TRENDS_URL, journal=None, merge='anchor', overlap_months=DEFAULT_OVERLAP_MONTHS, deadline=None, grid=False):
 	"""Gets interest data (quarterly) for the 12 months before and 12 months after specified date, then gets interest data for the whole period and merges this data.
 
 		month_offset: [no. month back, no. months forward] to query
+		journal: optional WindowJournal, windows already in it are not re-queried
+		merge: 'anchor' rescales windows with the overall period query,
+			'overlap' requests windows overlapping by overlap_months and chains them
+			together on the overlapping days (no overall or realignment queries;
+			the sections come from the last window)
+		deadline: optional time.time() by which the keyword must finish, checked
+			before every window and used to cut request timeouts and retries
+		grid: query calendar quarter windows (and a matching overall period)
+			and cut the merged series back to the requested period, so the
+			journal can serve the windows to every keyword of the same topic
 	Returns daily data over the period.
 	"""
-
-	aw_range = arrow.Arrow.range
-	begin_period = aget(filing_date).replace(months=month_offset[0])
-	ended_period = aget(filing_date).replace(months=month_offset[1])
-
-	# Set up date ranges to iterate queries across
-	start_range = aw_range('month', YYYY_MM(begin_period),
-									YYYY_MM(ended_period))
-	ended_range = aw_range('month', YYYY_MM(begin_period).replace(months=3),
-									YYYY_MM(ended_period).replace(months=3))
-
-	start_range = [r.datetime for r in start_range][::3]
-	ended_range = [r.datetime for r in ended_range][::3]
-
-	# Fix last date if incomplete quarter (offset -1 week from today)
+	return run_steps(quarterly_steps(keywords, category, cookies, session, domain, throttle,
+						filing_date, ggplot, month_offset, trends_url, journal, merge, overlap_months, deadline, grid))
+
+
+def quarterly_steps(keywords, category, cookies, session, domain, throttle, filing_date, ggplot, month_offset=[-12, 12], trends_url=DEFAULT_TRENDS_URL, journal=None, merge='anchor', overlap_months=DEFAULT_OVERLAP_MONTHS, deadline=None, grid=False):
+	"""The query plan behind quarterly_queries(), without any I/O. Yields
+	('throttle', seconds) and ('get', response_args) steps, is sent the response
+	lines for each 'get' (or has the request's exception thrown in), and ends
+	with ('result', data). Driven by run_steps() here and by async_trends."""
+	topic = ", ".join(k.topic for k in keywords)
+	begin_period, start_range, ended_range = quarter_windows(filing_date, month_offset)
+	span = None
+	if grid and start_range:
+		# window ends are exclusive
+		span = (start_range[0].date(), arrow.get(ended_range[-1]).replace(days=-1).date())
+		begin_period, start_range, ended_range = grid_windows(start_range, ended_range)
+	if merge == 'overlap':
+		start_range, ended_range = overlap_windows(start_range, ended_range, overlap_months)
+	querycount_dates = [d.date() for d in start_range]
 	last_week = arrow.utcnow().replace(weeks=-1).datetime
-	start_range = [d for d in start_range if d < last_week]
-	ended_range = [d for d in ended_range if d < last_week]
-	if len(ended_range) < len(start_range):
-		ended_range += [last_week]
 
 	# Iterate attention queries through each quarter
 	all_data = []
 	missing_queries = []    # use this to scale IoT later.
+	previous_window = None
+	sections = {}           # --merge overlap: the last window's sections
 	for start, end in zip(start_range, ended_range):
 		if start > last_week:
 			break
 
-		print("Querying period: {s} ~ {e}".format(s=start.date(),
-												  e=end.date()))
-		throttle_rate(throttle)
+		window = (start, end)
+		journalled = journal.get(topic, category, *window) if journal else None
+		if journalled:
+			logger.info("Journalled period: {s} ~ {e}".format(s=start.date(), e=end.date()))
+			query_data, label = journalled
+			if merge == 'overlap':
+				sections = journal.extras(topic, category, *window) or {}
+			all_data.append(query_data)
+			missing_queries.append(label)
+			previous_window = window
+			continue
+
+		_check_deadline(deadline, topic)
+		logger.info("Querying period: {s} ~ {e}".format(s=start.date(), e=end.date()))
+		yield 'throttle', throttle
 
 		response_args = {'url': trends_url.format(domain=domain),
 						'params': _query_parameters(start, end, keywords, category),
 						'cookies': cookies,
-						'session': session}
+						'session': session,
+						'deadline': deadline}
 
-		query_data = _check_data(keywords,
-						_process_response(
-							_get_response(**response_args)))
+		response_data = yield 'get', response_args
+		if merge == 'overlap':
+			# every window is the same export, so the sections cost no extra request
+			sections = _process_sections(response_data)
+		query_data = _check_data(keywords, _process_response(response_data))
 
 		# from IPython import embed; embed()
 		if query_data[1] == '':
-			query_data = [[date, '0'] for date in arrow.Arrow.range('day', start, end)]
+			query_data = RunSeries.constant(arrow.get(start), arrow.get(end), '0')
 			missing_queries.append('missing')
-		if all(int(vals)==0 for date,vals in query_data):
-			query_data = [[date, '0'] for date in arrow.Arrow.range('day', start, end)]
+		elif all(int(vals)==0 for date,vals in query_data):
+			query_data = RunSeries.constant(arrow.get(start), arrow.get(end), '0')
 			missing_queries.append('missing')
 		elif len(query_data[0][0]) > 10:
 			missing_queries.append('weekly')
 		else:
 			missing_queries.append('daily')
 
+		trimmed_previous = False
 		try:
-			if not aligned_weekly(query_data, all_data):
+			if merge == 'overlap':
+				pass # overlapping days are used for scaling, no realignment
+			elif not aligned_weekly(query_data, all_data):
 				## Workaround: shift filing date
 				q1 = weekly_date(all_data[-1][-1][0])
 				q2 = weekly_date(query_data[0][0])
@@ -508,12 +951,11 @@ def quarterly_queries(keywords, category, cookies, session, domain, throttle, fi
 					start = arrow.get(start).replace(months=-1)
 					response_args['params'] = _query_parameters(start, end, keywords, category)
 					## Do a new 4month query, overlap/replace previous month.
-					query_data = _check_data(keywords,
-									_process_response(
-										_get_response(**response_args)))
+					query_data = _check_data(keywords, _process_response((yield 'get', response_args)))
 					if all_data[:-1] != []:
 						q2 = weekly_date(query_data[0][0], 'start')
 						all_data[-1] = [d for d in all_data[-1] if q2 > weekly_date(d[0])]
+						trimmed_previous = True
 
 				elif q1 >= q2:
 					# if q1 > 1st date in query_data, remove the first few entries
@@ -521,34 +963,71 @@ def quarterly_queries(keywords, category, cookies, session, domain, throttle, fi
 
 		except IndexError:
 			pass
-		except:
-			from IPython import embed; embed()
+		except (ValueError, TypeError, arrow.parser.ParserError) as e:
+			# unparseable dates; request failures thrown in at the yield pass through
+			raise FormatException("Could not align {0} ~ {1} with the previous window: {2!r}".format(
+					start, end, e),
+				params=response_args['params'], body=query_data)
 
 		finally:
 			all_data.append(query_data)
 
-
+		if journal:
+			journal.put(topic, category, window[0], window[1],
+						query_data, missing_queries[-1], extras=sections if merge == 'overlap' else None)
+			if trimmed_previous:
+				journal.put(topic, category, previous_window[0], previous_window[1],
+							all_data[-2], missing_queries[-2])
+		previous_window = window
+
+
+
+	if merge == 'overlap':
+		# windows scale each other, no overall period
+		_add_sections(keywords, sections)
+		merge_t0 = time.time()
+		adj_all_data, restarts = _constant_windows(all_data), []
+		if adj_all_data is None:
+			adj_all_data, restarts = stitch_overlap(all_data)
+		METRICS.observe("stage_seconds", time.time() - merge_t0, stage="merge")
+		# windows after a zero overlap are on their own scale, mark where
+		keywords[0].querycounts = sorted(list(zip(querycount_dates, missing_queries)) +
+										 [(d.date(), 'restart') for d in restarts],
+										 key=lambda q: q[0])
+		yield 'result', _with_heading(["Date", keywords[0].title], _in_span(adj_all_data, span))
+		return
 
 	# Get overall long-term trend data across entire queried period
-	s = begin_period.replace(weeks=-2).datetime
-	e1 = arrow.get(ended_range[-1]).replace(months=+1).datetime
-	e2 = arrow.utcnow().replace(weeks=-1).datetime
-	e = min(e1,e2)
-	print("\n=> Merging with overall period: {s} ~ {e}".format(s=s.date(), e=e.date()))
+	s, e = overall_period(begin_period, ended_range)
+	logger.info("Merging with overall period: {s} ~ {e}".format(s=s.date(), e=e.date()))
 
 	response_args = {
 		'url': trends_url.format(domain=domain),
 		'params': _query_parameters(s, e, keywords, category),
 		'cookies': cookies,
-		'session': session
+		'session': session,
+		'deadline': deadline
 		}
 
-	query_data = _check_data(keywords,
-					_process_response(
-						_get_response(**response_args)))
-
+	journalled = journal.get(topic, category, s, e) if journal else None
+	if not journalled:
+		_check_deadline(deadline, topic)
+	if journalled:
+		query_data = journalled[0]
+		_add_sections(keywords, journal.extras(topic, category, s, e) or {})
+	else:
+		# the overall period also carries the regional and related-query
+		# sections, keep them instead of spending quota on separate queries
+		response_data = yield 'get', response_args
+		sections = _process_sections(response_data)
+		_add_sections(keywords, sections)
+		query_data = _check_data(keywords, _process_response(response_data))
+		if journal:
+			journal.put(topic, category, s, e, query_data, 'overall', extras=sections)
+
+	merge_t0 = time.time()
 	if query_data[1] == '':
-		adj_all_data = [[str(date.date()), int(zero)] for date, zero in zip(*interpolate_ioi(*zip(*sum(all_data,[]))))]
+		adj_all_data = _merge_unanchored(all_data)
 
 	elif len(query_data) > 1:
 		# compute changes in IoI (interest over time) per quarter
@@ -572,9 +1051,14 @@ def quarterly_queries(keywords, category, cookies, session, domain, throttle, fi
 		try:
 			ydate = [date[-10:] if len(date) > 10 else date for date, ioi in query_data]
 			yIoI  = [float(ioi) for date, ioi in query_data]
-		except:
-			from IPython import embed; embed()
-			yIoI = [float(ioi) for date, ioi in query_data[:-1]]
+		except ValueError:
+			# last row of an incomplete period may be blank
+			try:
+				ydate = [date[-10:] if len(date) > 10 else date for date, ioi in query_data[:-1]]
+				yIoI  = [float(ioi) for date, ioi in query_data[:-1]]
+			except ValueError as e:
+				raise FormatException("Unparseable overall period data: {0}".format(e),
+					params=response_args['params'], body=query_data)
 		ydate, yIoI = interpolate_ioi(ydate, yIoI)
 
 		# match quarterly and yearly dates and get correct delta IoI
@@ -589,78 +1073,50 @@ def quarterly_queries(keywords, category, cookies, session, domain, throttle, fi
 		adj_IoI = [ioi*mult for ioi,mult in zip(y_ioi, delta_ioi)]
 
 		adj_all_data = [[str(date.date()), round(ioi, 2)] for date,ioi in zip(common_date, adj_IoI)]
+		if ggplot:
+			# rendered after the batch by render.py, never on the query path
+			keywords[0].plot_series = [[str(d.date()), w, m, q] for d, w, m, q
+									   in zip(common_date, y_ioi, adj_IoI, qdat_interp)]
 	else:
-		adj_all_data = [[str(date.date()), int(zero)] for date, zero in zip(*interpolate_ioi(*zip(*sum(all_data,[]))))]
+		adj_all_data = _merge_unanchored(all_data)
+
+	METRICS.observe("stage_seconds", time.time() - merge_t0, stage="merge")
 
 	# from IPython import embed; embed()
 	heading = ["Date", keywords[0].title]
-	querycounts = list(zip((d.date() for d in start_range), missing_queries))
+	querycounts = list(zip(querycount_dates, missing_queries))
 	keywords[0].querycounts = querycounts
 
-	if not ggplot:
-		return [heading] + adj_all_data
-
-	## GGplot Only
-	else:
-		# GGPLOT MERGED GTRENDS PLOTS:
-		import pandas as pd
-		from ggplot import ggplot, geom_line, ggtitle, ggsave, scale_colour_manual, ylab, xlab, aes
-		try:
-			ydat = pd.DataFrame(list(zip(common_date, y_ioi)), columns=["Date", 'Weekly series'])
-			mdat = pd.DataFrame(list(zip(common_date, adj_IoI)), columns=['Date', 'Merged series'])
-			qdat = pd.DataFrame(list(zip(common_date, qdat_interp)), columns=['Date', 'Daily series'])
-			ddat = ydat.merge(mdat, on='Date').merge(qdat,on='Date')
-			ddat['Date'] = list(map(pd.to_datetime, ddat['Date']))
-
-			ydat['Date'] = list(map(pd.to_datetime, ydat['Date']))
-			mdat['Date'] = list(map(pd.to_datetime, mdat['Date']))
-			qdat['Date'] = list(map(pd.to_datetime, qdat['Date']))
-		except UnboundLocalError as e:
-			raise(UnboundLocalError("No Interest-over-time to plot"))
-
-		# meltkeys = ['Date','Weekly series','Merged series','Daily series']
-		# melt = pd.melt(ddat[meltkeys], id_vars='Date')
-
-		colors = [
-				'#77bde0', # blue
-				'#b47bc6',   # purple
-				'#d55f5f'    # red
-				]
-
-		entity_type = keywords[0].desc
-
-		g = ggplot(aes(x='Date', y='Daily series' ), data=ddat) + \
-			geom_line(aes(x='Date', y='Daily series'), data=qdat, alpha=0.5, color=colors[0]) + \
-			geom_line(aes(x='Date', y='Merged series'), data=mdat, alpha=0.9, color=colors[1]) + \
-			geom_line(aes(x='Date', y='Weekly series'), data=ydat, alpha=0.5, color=colors[2], size=1.5) + \
-			ggtitle("Interest over time for '{}' ({})".format(keywords[0].keyword, entity_type)) + \
-			ylab("Interest Over Time") + xlab("Date")
-
-		# from IPython import embed; embed()
-
-		print(g)
-		# ggsave(BASEDIR + "/iot_{}.png".format(keywords[0].keyword), width=15, height=5)
-		return [heading] + adj_all_data
+	yield 'result', _with_heading(heading, _in_span(adj_all_data, span))
 
 
 
 
 
+@timed_function
 def single_query(keywords, category, cookies, session, domain, throttle,
-			start_date, end_date, trends_url=DEFAULT_TRENDS_URL, ggplot=False):
+			start_date, end_date, trends_url=DEFAULT_TRENDS_URL, ggplot=False, deadline=None):
 	"Single period queries"
+	return run_steps(single_steps(keywords, category, cookies, session, domain, throttle,
+					start_date, end_date, trends_url, ggplot, deadline))
+
+
+def single_steps(keywords, category, cookies, session, domain, throttle,
+			start_date, end_date, trends_url=DEFAULT_TRENDS_URL, ggplot=False, deadline=None):
+	"Query plan behind single_query(), see quarterly_steps()."
 
 	try:
 		response_args = {
 			'url': trends_url.format(domain=domain),
 			'params': _query_parameters(start_date, end_date, keywords, category),
 			'cookies': cookies,
-			'session': session
+			'session': session,
+			'deadline': deadline
 			}
 
-		query_data = _check_data(keywords,
-						_process_response(
-							_get_response(**response_args)))
+		response_data = yield 'get', response_args
+		_add_sections(keywords, _process_sections(response_data))
+		query_data = _check_data(keywords, _process_response(response_data))
 
 	except (FormatException, AttributeError, ValueError):
 		query_data = [[arrow.get(str(x), 'YYYY'), 0] for x in range(2004,2015)]
@@ -668,11 +1124,88 @@ def single_query(keywords, category, cookies, session, domain, throttle,
 	heading  = ["Date", keywords[0].title]
 	query_data = [heading] + query_data
 
-	return query_data
+	yield 'result', query_data
+
+
+
+def _constant_windows(all_data):
+	"""The merged series of windows that are each one run of the same value
+	(a keyword without any interest): a single RunSeries run over the whole
+	period, or None if any window has data."""
+	if not all_data or not all(isinstance(w, RunSeries) and w.is_constant for w in all_data):
+		return None
+	if len(set(w.runs[0][2] for w in all_data)) != 1:
+		return None
+	return RunSeries.constant(all_data[0].start().date(), all_data[-1].end().date(),
+							  int(all_data[0].runs[0][2]))
+
+
+def _merge_unanchored(all_data):
+	"Daily windows joined without an overall period to rescale them with."
+	constant = _constant_windows(all_data)
+	if constant is not None:
+		return constant
+	rows = [row for window in all_data for row in window]
+	return [[str(date.date()), int(zero)] for date, zero in zip(*interpolate_ioi(*zip(*rows)))]
+
+
+def _in_span(data, span):
+	"Merged rows (or RunSeries) within the (first, last) dates of span, if any."
+	if span is None:
+		return data
+	if isinstance(data, RunSeries):
+		return data.between(*span)
+	first, last = str(span[0]), str(span[1])
+	return [row for row in data if first <= row[0][:10] <= last]
+
+
+def _with_heading(heading, data):
+	"""[heading] + rows for a query plan result; a RunSeries stays a single
+	item after the heading so it is never expanded, see add_interest()."""
+	if isinstance(data, RunSeries):
+		return [heading, data]
+	return [heading] + data
+
+
+def add_interest(keywords, all_data):
+	"Assigns the rows of a query plan result to its KeywordData objects."
+	body = all_data[1:]
+	if len(body) == 1 and isinstance(body[0], RunSeries):
+		keywords[0].interest.extend(body[0]) # run by run
+		return
+	for row in body:
+		date, counts = parse_ioi_row(row)
+		for i in range(len(keywords)):
+			keywords[i].add_interest_data(date, counts[i])
+
+
+def _check_deadline(deadline, topic):
+	if deadline is not None and time.time() >= deadline:
+		raise DeadlineException("Keyword deadline passed for '{0}'".format(topic))
+
+
+def run_steps(steps):
+	"""Drives a query plan (quarterly_steps, single_steps) with blocking
+	requests and sleeps. Returns the plan's result."""
+	reply, error = None, None
+	while True:
+		op, arg = steps.throw(error) if error else steps.send(reply)
+		reply, error = None, None
+		if op == 'get':
+			try:
+				reply = _get_response(**arg)
+			except Exception as e:
+				error = e
+		elif op == 'throttle':
+			throttle_rate(arg)
+		else:
+			steps.close()
+			return arg
 
 
 
 
+@timed_function
 def parse_ioi_row(row):
 	""" Formats a row of interest-over-time data (ioi).
 		Arguments: row -- A list of strings
@@ -692,35 +1225,28 @@ def parse_ioi_row(row):
 	return (date, counts)
 
 
-def throttle_rate(seconds):
-	"""Throttles query speed in seconds. Try --throttle "random" (1~2 seconds)"""
-	if str(seconds).isdigit() and seconds > 0:
-		sleep(float(seconds))
-	elif seconds=="random":
-		sleep(float(random.randint(2,3)))
-
+def throttle_interval(seconds):
+	"Least number of seconds throttle_rate() waits between requests."
+	if str(seconds).isdigit():
+		return float(seconds)
+	elif seconds == "random":
+		return 2.0
+	return 0.0
 
-def YYYY_MM(date_obj):
-	"""Removes day. Formats dates from YYYY-MM-DD to YYYY-MM. Also turns date objects into Arrow objects."""
-	date_obj = arrow.get(date_obj)
-	return arrow.get(date_obj.format("YYYY-MM"))
 
+def throttle_rate(seconds):
+	"""Throttles query speed in seconds. Try --throttle "random" (1~2 seconds)"""
+	with METRICS.timed("throttle"):
+		if str(seconds).isdigit() and seconds > 0:
+			sleep(float(seconds))
+		elif seconds=="random":
+			sleep(float(random.randint(2,3)))
 
-def aget(date):
-	import re
-	if re.search(r'[-/]\d{4}$', date):
-		# US date: M-D-YYYY
-		return arrow.get(date[:3]+date[-4:].replace('/', '-'), 'M-YYYY')
-	elif re.search(r'^\d{4}[-/]', date):
-		return arrow.get(date.replace('/', '-'), 'YYYY-M')
-	else:
-		return arrow.get(date)
 
 
 
 
 if __name__ == "__main__":
 	main()
-	print("="*60)
-	print("OK. Done.")
+	logger.info("OK. Done.")
 
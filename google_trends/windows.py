@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Date helpers and the quarterly query window plan shared by quarterly_queries()
+and the tools that need to know which windows a keyword will cost.
+"""
+
+import re
+import arrow
+
+DEFAULT_OVERLAP_MONTHS = 1  # --merge overlap: months each window shares with the previous one
+
+
+def YYYY_MM(date_obj):
+    """Removes day. Formats dates from YYYY-MM-DD to YYYY-MM. Also turns date objects into Arrow objects."""
+    date_obj = arrow.get(date_obj)
+    return arrow.get(date_obj.format("YYYY-MM"))
+
+
+def aget(date):
+    if re.search(r'[-/]\d{4}$', date):
+        # US date: M-D-YYYY
+        return arrow.get(date[:3]+date[-4:].replace('/', '-'), 'M-YYYY')
+    elif re.search(r'^\d{4}[-/]', date):
+        return arrow.get(date.replace('/', '-'), 'YYYY-M')
+    else:
+        return arrow.get(date)
+
+
+def quarter_windows(filing_date, month_offset=[-12, 12]):
+    """Quarterly query windows around a filing date.
+    Returns (begin_period, start_range, ended_range), windows are zip(start_range, ended_range)."""
+    aw_range = arrow.Arrow.range
+    begin_period = aget(filing_date).replace(months=month_offset[0])
+    ended_period = aget(filing_date).replace(months=month_offset[1])
+
+    # Set up date ranges to iterate queries across
+    start_range = aw_range('month', YYYY_MM(begin_period),
+                                    YYYY_MM(ended_period))
+    ended_range = aw_range('month', YYYY_MM(begin_period).replace(months=3),
+                                    YYYY_MM(ended_period).replace(months=3))
+
+    start_range = [r.datetime for r in start_range][::3]
+    ended_range = [r.datetime for r in ended_range][::3]
+
+    # Fix last date if incomplete quarter (offset -1 week from today)
+    last_week = arrow.utcnow().replace(weeks=-1).datetime
+    start_range = [d for d in start_range if d < last_week]
+    ended_range = [d for d in ended_range if d < last_week]
+    if len(ended_range) < len(start_range):
+        ended_range += [last_week]
+    return begin_period, start_range, ended_range
+
+
+def snap_to_quarter(date):
+    "First day of the calendar quarter `date` falls in."
+    date = YYYY_MM(date)
+    return date.replace(month=3 * ((date.month - 1) // 3) + 1)
+
+
+def grid_windows(start_range, ended_range):
+    """Calendar quarter windows (Jan, Apr, Jul, Oct) covering the windows of
+    quarter_windows(), so keywords with different filing dates request the
+    same windows. Returns (begin_period, start_range, ended_range).
+
+    Window ends are exclusive, so the last cell is the one holding the last
+    day before ended_range[-1]. When the windows do not start on a calendar
+    quarter, the grid needs one cell more than quarter_windows()."""
+    last_week = arrow.utcnow().replace(weeks=-1).datetime
+    last_day = arrow.get(ended_range[-1]).replace(days=-1).date()
+    cell = snap_to_quarter(start_range[0])
+    starts, ends = [], []
+    while cell.date() <= last_day:
+        starts.append(cell.datetime)
+        ends.append(min(cell.replace(months=3).datetime, last_week))
+        cell = cell.replace(months=3)
+    return arrow.get(starts[0]), starts, ends
+
+
+def overlap_windows(start_range, ended_range, overlap_months=DEFAULT_OVERLAP_MONTHS):
+    """Three month windows over the same period as quarter_windows(), each
+    starting `overlap_months` before the previous one ends, so adjacent
+    windows share days and every window stays short enough to come back
+    daily. Query dates are sent as MM/YYYY, so the overlap is in whole months
+    and must be 1 or 2; it costs extra windows, not longer ones.
+    Returns (start_range, ended_range)."""
+    step = 3 - int(overlap_months)
+    if not 0 < step < 3:
+        raise ValueError("overlap must be 1 or 2 months, got {0}".format(overlap_months))
+    last = ended_range[-1]
+    start = arrow.get(start_range[0])
+    starts, ends = [], []
+    while True:
+        end = start.replace(months=3)
+        starts.append(start.datetime)
+        ends.append(min(end.datetime, last))
+        if end.datetime >= last:
+            return starts, ends
+        start = start.replace(months=step)
+
+
+def overall_period(begin_period, ended_range):
+    "Long-term period spanning all quarterly windows, used to rescale them."
+    s = begin_period.replace(weeks=-2).datetime
+    e1 = arrow.get(ended_range[-1]).replace(months=+1).datetime
+    e2 = arrow.utcnow().replace(weeks=-1).datetime
+    return s, min(e1,e2)
@@ -67,7 +67,7 @@ for ccode, category in categories:
 #         --username $GMAIL_USER \
 #         --password justfortesting! \
 #         --throttle "random" \
-#         --quiet-io "true" \
+#         --quiet \
 #         --cik-file $base_dir/ipo-uw/ipo-uw.csv  \
 #         --output $base_dir/ipo-uw/{category} \
 #         --category {ccode}""".format(category=category, ccode=ccode)
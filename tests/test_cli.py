@@ -0,0 +1,19 @@
+"""Smoke checks for the command line entry points."""
+
+import os, sys, subprocess
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "google_trends")
+NEEDS_ARROW = ("trends.py", "coordinator.py", "entity_index.py")
+
+
+@pytest.mark.parametrize("script", ["trends.py", "coordinator.py", "summary.py",
+                                    "entity_index.py", "runs.py", "categories.py"])
+def test_help(script):
+    if script in NEEDS_ARROW:
+        pytest.importorskip("arrow")
+    proc = subprocess.run([sys.executable, script, "--help"], cwd=SRC,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert proc.returncode == 0, proc.stderr.decode("utf-8", "replace")
+    assert b"usage:" in proc.stdout
@@ -0,0 +1,35 @@
+"""Leases and per-account quota on the coordinator."""
+
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "google_trends"))
+
+pytest.importorskip("arrow")
+from coordinator import Coordinator
+
+
+@pytest.fixture
+def coordinator(tmp_path):
+    c = Coordinator(["a", "b", "c", "d"], str(tmp_path), daily_budget=5)
+    c.estimator.planned_cost = lambda job: 2
+    return c
+
+
+def test_leased_cost_holds_budget_across_nodes(coordinator):
+    first = coordinator.lease("node1", "acct", size=2)
+    assert first["jobs"] == ["a", "b"]
+    second = coordinator.lease("node2", "acct", size=2)
+    assert second["jobs"] == [] and not second["quota_exhausted"]
+
+    coordinator.complete(first["lease"], "a", "a.csv", "Date,a\n2014-01-01,1\n", requests=1)
+    coordinator.fail(first["lease"], "b", requests=1)
+    # 2 requests spent, nothing leased: one more job fits
+    assert coordinator.lease("node2", "acct", size=2)["jobs"] == ["c"]
+
+
+def test_expired_lease_releases_its_cost(coordinator):
+    coordinator.lease_ttl = -1
+    assert coordinator.lease("node1", "acct", size=2)["jobs"] == ["a", "b"]
+    assert coordinator.lease("node2", "acct", size=2)["jobs"] == ["a", "b"]
@@ -0,0 +1,39 @@
+"""Hedged requests keep to the throttle."""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "google_trends"))
+
+from hedge import HedgePolicy
+
+
+def _policy(min_interval):
+    policy = HedgePolicy(max_ratio=1.0, min_samples=1, min_interval=min_interval)
+    policy.call(lambda: None)                   # one fast sample, threshold ~0
+    return policy
+
+
+def test_hedge_waits_for_throttle():
+    policy = _policy(min_interval=0.3)
+    sent = []
+
+    def slow():
+        sent.append(time.time())
+        time.sleep(0.5)
+
+    policy.call(slow)
+    time.sleep(0.6)                             # let the hedge finish
+    assert len(sent) == 2
+    assert sent[1] - sent[0] >= 0.29
+
+
+def test_no_hedge_when_answer_arrives_within_throttle():
+    policy = _policy(min_interval=0.5)
+    sent = []
+
+    def slowish():
+        sent.append(time.time())
+        time.sleep(0.2)
+
+    policy.call(slowish)
+    assert len(sent) == 1
@@ -0,0 +1,28 @@
+"""Merging quarterly windows."""
+
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "google_trends"))
+
+pytest.importorskip("arrow")
+from interpolate import stitch_overlap
+
+
+def _window(first, values):
+    return [["2014-01-{0:02d}".format(first + i), str(v)] for i, v in enumerate(values)]
+
+
+def test_stitch_scales_on_the_overlap():
+    rows, restarts = stitch_overlap([_window(1, [10, 20, 40]), _window(3, [20, 10])])
+    assert rows == [["2014-01-01", 25.0], ["2014-01-02", 50.0], ["2014-01-03", 100.0],
+                    ["2014-01-04", 50.0]]
+    assert restarts == []
+
+
+def test_stitch_restarts_after_a_zero_overlap():
+    rows, restarts = stitch_overlap([_window(1, [10, 20, 30]), _window(3, [0, 0, 0]),
+                                     _window(5, [0, 5, 10])])
+    assert [str(d.date()) for d in restarts] == ["2014-01-05"]
+    assert rows[-1] == ["2014-01-07", 33.33] # own scale, not the first window's ratio
@@ -0,0 +1,87 @@
+"""Resuming a batch in an output directory that already has results."""
+
+import os, sys
+from datetime import date, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "google_trends"))
+
+from output import AtomicWriter, scan
+from google_class import KeywordData
+
+SERIES = "Date,Goldman Sachs\n2014-06-01,3\n2014-06-02,5\n"
+
+
+def test_scan_leaves_side_files(tmp_path):
+    out = str(tmp_path)
+    with open(os.path.join(out, "event_windows.csv"), "w") as f:
+        f.write("cik,keyword\n")
+    with open(os.path.join(out, "remaining_plan.csv"), "w") as f:
+        f.write("keyword,cost\n")
+    writer = AtomicWriter(out)
+    writer.write("0000000001.csv", SERIES)
+    writer.close()
+
+    complete = scan(out, skip=["event_windows.csv", "remaining_plan.csv"])
+    assert complete == set(["0000000001.csv"])
+    assert sorted(os.listdir(out)) == [".complete.jsonl", ".writers.lock", "0000000001.csv",
+                                       "event_windows.csv", "remaining_plan.csv"]
+
+
+def test_scan_leaves_another_workers_files(tmp_path):
+    out = str(tmp_path)
+    other = AtomicWriter(out)           # a running worker, batch not synced yet
+    other.write("0000000001.csv", SERIES)
+    open(os.path.join(out, ".0000000002.csv.tmp"), "w").close()
+
+    assert scan(out) == set()
+    assert os.path.exists(os.path.join(out, "0000000001.csv"))
+    assert os.path.exists(os.path.join(out, ".0000000002.csv.tmp"))
+
+    other.close()
+    assert scan(out) == set(["0000000001.csv"])
+    assert not os.path.exists(os.path.join(out, ".0000000002.csv.tmp"))
+
+
+def _keyword(cik):
+    kw = KeywordData("Goldman Sachs")
+    kw.cik = cik
+    kw.filing_date = "2014-06-15"
+    for i in range(-60, 60):
+        kw.add_interest_data(date(2014, 6, 15) + timedelta(days=i), str(10 + (i > 0) * 5))
+    return kw
+
+
+def test_two_pass_resume(tmp_path):
+    pytest.importorskip("arrow")
+    from events import EventSummary, EVENTS_FILENAME
+
+    out = str(tmp_path)
+    events_path = os.path.join(out, EVENTS_FILENAME)
+
+    # first pass: one keyword synced, the second killed before its fsync batch
+    scan(out, skip=[EVENTS_FILENAME])
+    writer = AtomicWriter(out, fsync_every=2)
+    events = EventSummary(events_path)
+    writer.write("0000000001.csv", SERIES)
+    events.add(_keyword("0000000001"))
+    writer.sync()
+    writer.write("0000000002.csv", SERIES)
+    events.add(_keyword("0000000002"))
+    events.close()
+    if writer.dir_lock is not None:
+        writer.dir_lock.close()         # the killed process's lock goes with it
+
+    # second pass, as trends.py starts it
+    complete = scan(out, skip=[EVENTS_FILENAME])
+    assert complete == set(["0000000001.csv"])
+    assert os.path.exists(os.path.join(out, "0000000002.csv.incomplete"))
+    assert os.path.exists(events_path)
+
+    events = EventSummary(events_path)
+    assert events.done == set(["0000000001", "0000000002"])
+    assert events.add(_keyword("0000000002")) is None   # requeried, not written twice
+    events.close()
+    with open(events_path) as f:
+        assert len(f.read().splitlines()) == 3
@@ -0,0 +1,27 @@
+"""Quarterly window plans."""
+
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "google_trends"))
+
+arrow = pytest.importorskip("arrow")
+from windows import quarter_windows, overlap_windows
+
+
+@pytest.mark.parametrize("overlap", [1, 2])
+def test_overlap_windows_stay_three_months(overlap):
+    begin, starts, ends = quarter_windows("2014-05", [-12, 12])
+    ostarts, oends = overlap_windows(starts, ends, overlap)
+    assert ostarts[0] == starts[0] and oends[-1] == ends[-1]
+    for start, end in zip(ostarts, oends):
+        assert arrow.get(end) <= arrow.get(start).replace(months=3)
+    for previous_end, start in zip(oends, ostarts[1:]):
+        assert arrow.get(start).replace(months=overlap) == arrow.get(previous_end)
+
+
+def test_overlap_windows_need_room_for_new_days():
+    begin, starts, ends = quarter_windows("2014-05", [-12, 12])
+    with pytest.raises(ValueError):
+        overlap_windows(starts, ends, 3)